@@ -8,15 +8,58 @@ from copy import copy
 from itertools import product
 from operator import itemgetter
 
-from limpyd.utils import make_key, unique_key
+from limpyd.utils import unique_key, merge_sorted
 from limpyd.exceptions import *
 from limpyd.fields import SingleValueField
+from limpyd.indexes import EqualIndex, NumberRangeIndex, TextRangeIndex
 
 ParsedFilter = namedtuple('ParsedFilter', ['index', 'suffix', 'extra_field_parts', 'value', 'related_filters'])
 
+# a filter on the fields of the instances pointed by a related field, like `group__name`
+JoinFilter = namedtuple('JoinFilter', ['index', 'related_model', 'related_key', 'value'])
+
 
 NONE_SLICE = slice(None, None, None)
 
+# lua helpers for scripts working on the final set of a collection, passed as
+# KEYS[1]: `members` returns its members whatever its type, `get_value`
+# returns the value of a field for a pk, given the parts of its sort wildcard,
+# `get_pattern_value` does the same for a "get" pattern passed as 4 args from
+# the position `i` of `args` (see `CollectionManager._get_lua_pattern_args`),
+# and `store` saves the given values in a list like SORT STORE does
+LUA_FINAL_SET_HELPERS = """
+    local function members(key)
+        local key_type = redis.call('type', key)['ok']
+        if key_type == 'zset' then
+            return redis.call('zrange', key, 0, -1)
+        elseif key_type == 'list' then
+            return redis.call('lrange', key, 0, -1)
+        end
+        return redis.call('smembers', key)
+    end
+    local function get_value(prefix, suffix, hash_field, pk)
+        if hash_field == '' then
+            return redis.call('get', prefix .. pk .. suffix)
+        end
+        return redis.call('hget', prefix .. pk .. suffix, hash_field)
+    end
+    local function get_pattern_value(args, i, pk)
+        if args[i] == 'pk' then
+            return pk
+        elseif args[i] == 'score' then
+            return false
+        end
+        return get_value(args[i+1], args[i+2], args[i+3], pk)
+    end
+    local function store(key, values)
+        redis.call('del', key)
+        for _, value in ipairs(values) do
+            redis.call('rpush', key, value or '')
+        end
+        return #values
+    end
+"""
+
 
 class CollectionResults(object):
     def __init__(self, data, func=None):
@@ -125,6 +168,116 @@ class CollectionManager(object):
     # time between a first call to __len__ followed by a collection retrieval
     FINAL_SET_TTL = 300
 
+    # number of instances deleted at once by `delete`
+    DELETE_CHUNK_SIZE = 500
+
+    # number of instances updated at once by `update`
+    UPDATE_CHUNK_SIZE = 500
+
+    scripts = {
+        'sort_by_fields': {
+            # return the members of KEYS[1] (the final set of the collection, a
+            # set, zset or list) sorted by many fields. ARGV: desc (to reverse
+            # the whole order), start, num, the number of fields, then for each
+            # one its desc and alpha flags and 4 args for its "get" pattern (see
+            # `_get_lua_pattern_args`), and finally 4 args for each value to
+            # get, as with SORT GET.
+            # Missing values and ties are handled like SORT does. If KEYS[2] is
+            # given, the result is stored in this list and its length returned
+            'lua': LUA_FINAL_SET_HELPERS + """
+                local reverse = ARGV[1] == '1'
+                local start, num = tonumber(ARGV[2]), tonumber(ARGV[3])
+                local last_sort_arg = 4 + tonumber(ARGV[4]) * 6
+                local sort_args = {}
+                for i = 5, last_sort_arg, 6 do
+                    table.insert(sort_args, i)
+                end
+                local entries = {}
+                for _, pk in ipairs(members(KEYS[1])) do
+                    local entry = {pk = pk}
+                    for _, i in ipairs(sort_args) do
+                        local value = get_pattern_value(ARGV, i + 2, pk)
+                        if ARGV[i + 1] ~= '1' then
+                            if value then
+                                value = tonumber(value)
+                                if not value then
+                                    return redis.error_reply("One or more scores can't be converted into double")
+                                end
+                            else
+                                value = 0
+                            end
+                        end
+                        table.insert(entry, value)
+                    end
+                    table.insert(entries, entry)
+                end
+                table.sort(entries, function(a, b)
+                    for position, i in ipairs(sort_args) do
+                        local x, y = a[position], b[position]
+                        if x ~= y then
+                            local before
+                            if x == false then
+                                before = true
+                            elseif y == false then
+                                before = false
+                            else
+                                before = x < y
+                            end
+                            if (ARGV[i] == '1') ~= reverse then
+                                return not before
+                            end
+                            return before
+                        end
+                    end
+                    if reverse then
+                        return a.pk > b.pk
+                    end
+                    return a.pk < b.pk
+                end)
+                local stop = #entries
+                if num >= 0 and start + num < stop then
+                    stop = start + num
+                end
+                local result = {}
+                for position = start + 1, stop do
+                    local pk = entries[position].pk
+                    if #ARGV > last_sort_arg then
+                        for i = last_sort_arg + 1, #ARGV, 4 do
+                            table.insert(result, get_pattern_value(ARGV, i, pk))
+                        end
+                    else
+                        table.insert(result, pk)
+                    end
+                end
+                if KEYS[2] then
+                    return store(KEYS[2], result)
+                end
+                return result
+            """,
+        },
+        'union_join': {
+            # store in KEYS[2] the union of the sets of the equal index of a
+            # related field for all the pks in KEYS[1] (a set, zset or list),
+            # each key being ARGV[1] followed by the pk. Sets are unioned by
+            # chunks to avoid too many arguments in a call
+            'lua': LUA_FINAL_SET_HELPERS + """
+                local chunk = {KEYS[2]}
+                redis.call('del', KEYS[2])
+                for _, pk in ipairs(members(KEYS[1])) do
+                    table.insert(chunk, ARGV[1] .. pk)
+                    if #chunk > 1000 then
+                        redis.call('sunionstore', KEYS[2], unpack(chunk))
+                        chunk = {KEYS[2]}
+                    end
+                end
+                if #chunk > 1 then
+                    redis.call('sunionstore', KEYS[2], unpack(chunk))
+                end
+                return redis.call('scard', KEYS[2])
+            """,
+        },
+    }
+
     def __init__(self, model):
         self.model = model
         self._lazy_collection = {  # Store infos to make the requested collection
@@ -153,10 +306,16 @@ class CollectionManager(object):
         self._final_set = None  # when __len__ alone is called, the final set is computed and
                                 # its key stored here, to have fast access during FINAL_SET_TTL
                                 # seconds if followed by a collection retrieval
+        self._final_set_is_tmp = False  # if the final set read by `_final_redis_call` and
+                                        # `_collection_length` is a temporary key, so it must
+                                        # not be read from a replica, where it may not exist yet
         self._final_set_deletable = False  # if the key stored in _final_set must have an expire
                                            # applied, and deleted after the collection retrieval is
                                            # done
 
+        self._after = None  # when `after` is called, a dict with the cursor to start after
+        self.next_cursor = None  # when `after` was called, the cursor to get the next results
+
     @property
     def connection(self):
         return self.model.get_connection()
@@ -173,7 +332,9 @@ class CollectionManager(object):
         new._collection_cache = None
         new._cache_iterator_function = None
         new._final_set = None
+        new._final_set_is_tmp = False
         new._final_set_deletable = False
+        new._after = self._after.copy() if self._after is not None else None
         return new
 
     def _get_from_results_cache(self, apply_slice=None):
@@ -287,6 +448,9 @@ class CollectionManager(object):
             if optimized and start is None and count is None and python_slice == NONE_SLICE:
                 return []
 
+            if self._after is not None and (rev or not optimized or count is None and python_slice.stop is not None):
+                raise ValueError('Only positive slicing is allowed when using a cursor')
+
             if start is not None or count is not None:
                 self._sort_limits['start'] = start or 0
                 self._sort_limits['num'] = -1 if count is None else count
@@ -304,6 +468,8 @@ class CollectionManager(object):
             # data transfer and use the fast redis offset system
             start = arg
             self._sort_limits['num'] = 1  # one element
+            if start < 0 and self._after is not None:
+                raise ValueError('Only positive indexing is allowed when using a cursor')
             if start >= 0:
                 self._sort_limits['start'] = start
                 self._fetch_collection()
@@ -383,6 +549,10 @@ class CollectionManager(object):
         if self._collection_cache is not None:
             return
 
+        if self.model.database.sharded:
+            self._fetch_sharded_collection(apply_slice=apply_slice)
+            return
+
         conn = self.connection
         self._len = 0
 
@@ -410,6 +580,7 @@ class CollectionManager(object):
             final_set, delete_set_later = self._get_final_set(
                                                 self._lazy_collection['sets'],
                                                 pk, sort_options)
+        self._final_set_is_tmp = delete_set_later
         try:
             # fill the collection
             if final_set is None:
@@ -443,26 +614,150 @@ class CollectionManager(object):
         self._collection_cache, self._cache_iterator_function = self._prepare_results(collection, apply_slice=apply_slice)
         self._len = len(self._collection_cache)
 
+    def _fetch_sharded_collection(self, apply_slice=None):
+        """
+        Retrieve data according to lazy_collection on a sharded database: the
+        collection is computed on all the shards in parallel (only on the one
+        of the pk if filtered by pk), then the results are merged.
+        If sorted, each shard returns its results up to the end of the wanted
+        slice, with the values used to sort, so they are merged in order with
+        a k-way merge, and the slice is then applied.
+        """
+        database = self.model.database
+        self._len = 0
+
+        try:
+            pk = self._get_pk()
+        except ValueError:
+            self._cache_empty_collection()
+            return
+        else:
+            if pk is not None and not self.model.get_field('pk').exists(pk):
+                self._cache_empty_collection()
+                return
+
+        sort_options = self._prepare_sort_options(bool(pk))
+        if self._after is not None or sort_options is not None and (
+                isinstance(sort_options.get('by'), list) or sort_options.get('store')):
+            raise ImplementationError('Cursors, sorts by many fields and stored collections '
+                                      'are not supported on a sharded database')
+
+        start, num, sorted_by = 0, -1, None
+        shard_sort_options = None
+        if sort_options is not None:
+            shard_sort_options = dict(sort_options)
+            start = shard_sort_options.pop('start', 0)
+            num = shard_sort_options.pop('num', -1)
+            if num >= 0:
+                shard_sort_options.update(start=0, num=start + num)
+            if shard_sort_options.get('by') != 'nosort':
+                # get the value used to sort and the pk (to compare equal values, as SORT does)
+                # before the wanted values, to merge the results of the shards
+                sorted_by = shard_sort_options.get('get') or []
+                shard_sort_options['get'] = [shard_sort_options.get('by') or '#', '#'] + sorted_by
+
+        def fetch():
+            final_set, delete_set_later = self._get_final_set(
+                                                self._lazy_collection['sets'],
+                                                pk, shard_sort_options)
+            try:
+                if final_set is None:
+                    # only a pk (collection not fetched on other shards), or nothing
+                    if pk and not self._lazy_collection['sets']:
+                        return 1 if self._len_mode else [pk]
+                    return 0 if self._len_mode else []
+                if self._len_mode:
+                    return self._collection_length(final_set)
+                return list(self._final_redis_call(final_set, shard_sort_options))
+            finally:
+                if delete_set_later:
+                    self.connection.delete(final_set)
+
+        results = database.map_shards(fetch, None if pk is None else [database.get_shard_index(pk)])
+
+        if self._len_mode:
+            self._len = sum(results)
+            return
+
+        if sorted_by is None:
+            collection = [entry for shard_results in results for entry in shard_results]
+        else:
+            size = len(shard_sort_options['get'])
+            alpha = shard_sort_options.get('alpha')
+
+            def sort_key(entry):
+                value, entry_pk = entry[0], entry[1]
+                if alpha:
+                    return (value is not None, value or ''), entry_pk
+                return float(value or 0), entry_pk
+
+            collection = []
+            for entry in merge_sorted(
+                    [zip(*([iter(shard_results)] * size)) for shard_results in results],
+                    key=sort_key, reverse=bool(shard_sort_options.get('desc'))):
+                collection.extend(entry[2:] if sorted_by else entry[1:2])
+
+        if num >= 0:
+            collection = collection[start:start + num]
+        elif start:
+            collection = collection[start:]
+
+        # Format return values if needed
+        self._collection_cache, self._cache_iterator_function = self._prepare_results(collection, apply_slice=apply_slice)
+        self._len = len(self._collection_cache)
+
     def _final_redis_call(self, final_set, sort_options):
         """
         The final redis call to obtain the values to return from the "final_set"
         with some sort options.
         """
 
-        conn = self.connection
-        if sort_options is not None:
+        if self._after is not None:
+            # walk the index of the sort field, starting after the cursor
+            return self._walk_sort_index(final_set, sort_options)
+        elif sort_options is not None and isinstance(sort_options.get('by'), list):
+            # a sort on many fields, done by a lua script
+            return self._sort_by_fields(final_set, sort_options)
+        elif sort_options is not None:
+            # only the first results sorted by a field with a range index: read
+            # them from the index if possible
+            results = self._get_top_from_sort_index(final_set, sort_options)
+            if results is not None:
+                return results
             # a sort, or values, call the SORT command on the set
-            return conn.sort(final_set, **sort_options)
+            return self._get_read_connection(sort_options).sort(final_set, **sort_options)
         else:
             # no sort, nor values, simply return the full set
-            return conn.smembers(final_set)
+            return self._get_read_connection().smembers(final_set)
+
+    def _get_read_connection(self, sort_options=None):
+        """
+        Return the connection to use to read the final set in the final redis
+        call: a read replica (see ``RedisDatabase.read_connection``) if the
+        final set is not a temporary key and nothing is stored, else the main
+        connection
+        """
+        if self._final_set_is_tmp or (sort_options or {}).get('store'):
+            return self.connection
+        return self.model.database.read_connection
 
     def _collection_length(self, final_set):
         """
         Return the length of the final collection, directly asking redis for the
         count without calling sort
         """
-        return self.connection.scard(final_set)
+        if self._after is not None:
+            # we have to walk the whole index after the cursor
+            return len(self._get_sort_range_index().walk(
+                final_set, self._after['cursor'], desc=bool(self._sort.get('desc'))))
+        return getattr(self._get_read_connection(), self._get_length_command())(final_set)
+
+    def _get_length_command(self):
+        """
+        Return the name of the redis command giving the length of the final
+        set, when no cursor is used
+        """
+        return 'scard'
 
     def _to_instance(self, pk):
         meth = self.model.lazy_connect if self._lazy_instances else self.model
@@ -530,6 +825,10 @@ class CollectionManager(object):
                     final_sets.add(index_key)
                     if is_tmp:
                         tmp_keys.add(index_key)
+            elif isinstance(set_, JoinFilter):
+                join_key = self._get_join_filter_key(set_)
+                final_sets.add(join_key)
+                tmp_keys.add(join_key)
             else:
                 raise ValueError('Invalid filter type')
 
@@ -686,6 +985,62 @@ class CollectionManager(object):
         self.connection.sinterstore(final_set, list(sets))
         return final_set
 
+    def _call_on_final_set(self, func):
+        """
+        Compute the final set of the collection, without sorting it, and return
+        the result of `func` called with the key of this set, or with ``None``
+        if the collection is empty. Temporary keys are deleted after the call.
+        """
+        try:
+            pk = self._get_pk()
+        except ValueError:
+            return func(None)
+        if pk is not None and not self.model.get_field('pk').exists(pk):
+            return func(None)
+
+        final_set, delete_set_later = self._get_final_set(
+                                            self._lazy_collection['sets'], pk, None)
+        if final_set is None and pk is not None:
+            # only a pk: no set is computed in this case
+            final_set, delete_set_later = self._unique_key('tmp'), True
+            self.connection.sadd(final_set, pk)
+
+        try:
+            return func(final_set)
+        finally:
+            if delete_set_later:
+                self.connection.delete(final_set)
+
+    def _get_join_filter_key(self, join_filter):
+        """
+        Return the key of a temporary set with the pks of the instances whose
+        related field holds the pk of one of the instances of the related
+        model matching the given join filter (see `_parse_join_filter_key`).
+        The final set of the collection of the related model is computed in
+        redis, then the sets of the equal index of the related field for all
+        its pks are unioned by a lua script, so no pk leaves redis.
+        """
+        join_key = self._unique_key('join')
+        # the index key for a pk is this prefix followed by the pk
+        prefix = join_filter.index.get_storage_key('', transform_value=False)
+
+        def union(final_set):
+            if final_set is None:
+                return 0
+            return self.model.database.call_script(
+                # be sure to use the script dict at the class level
+                # to avoid registering it many times
+                script_dict=self.__class__.scripts['union_join'],
+                keys=[final_set, join_key],
+                args=[prefix]
+            )
+
+        related_collection = join_filter.related_model.collection(
+            **{join_filter.related_key: join_filter.value})
+        related_collection._call_on_final_set(union)
+
+        return join_key
+
     def __call__(self, **filters):
         return self.clone()._add_filters(**filters)
 
@@ -746,6 +1101,52 @@ class CollectionManager(object):
 
         return index_to_use, index_suffix, other_field_parts
 
+    def _parse_join_filter_key(self, key):
+        """
+        If the given filter key is in the form "field__relatedfield", with
+        "field" a related field (see `limpyd.contrib.related`) and
+        "relatedfield" a field of the related model (with its own suffixes and
+        sub-parts if any, like "group__name__in"), return the equal index of
+        the related field, the related model, and the filter key to use on
+        this model. Else return None.
+        """
+        field_name, _, related_key = key.partition('__')
+        if not related_key or not self.model.has_field(field_name):
+            return None
+        field = self.model.get_field(field_name)
+        if not getattr(field, 'related_to', None) or not field.indexable:
+            return None
+        if any(index.can_handle_suffix(related_key) for index in field._indexes):
+            # a suffix of the related field itself, like "group__in"
+            return None
+
+        related_model = field.database._models[field.related_to]
+        related_field_name = related_key.split('__')[0]
+        if not related_model.has_field(related_field_name) and not related_model._field_is_pk(related_field_name):
+            return None
+
+        for index in field._indexes:
+            if isinstance(index, EqualIndex):
+                return index, related_model, related_key
+
+        raise ImplementationError(
+            'No equal index found to manage filter "%s" for field %s.%s' % (
+                key, field._model.__name__, field.name
+            )
+        )
+
+    def _make_filter(self, key, value):
+        """
+        Return the filter to store in `_lazy_collection['sets']` for the given
+        key and value: a `JoinFilter` for a filter on the fields of related
+        instances, else a `ParsedFilter`
+        """
+        join = self._parse_join_filter_key(key)
+        if join is not None:
+            return JoinFilter(*join, value=value)
+        index, suffix, extra_field_parts = self._parse_filter_key(key)
+        return ParsedFilter(index, suffix, extra_field_parts, value, None)
+
     def _add_filters(self, **filters):
         """Define self._lazy_collection according to filters."""
         for key, value in filters.items():
@@ -755,9 +1156,7 @@ class CollectionManager(object):
             else:
                 # store the info to call the index later, in ``_prepare_sets``
                 # (to avoid doing extra work if the collection is never called)
-                index, suffix, extra_field_parts = self._parse_filter_key(key)
-                parsed_filter = ParsedFilter(index, suffix, extra_field_parts, value, None)
-                self._lazy_collection['sets'].append(parsed_filter)
+                self._lazy_collection['sets'].append(self._make_filter(key, value))
 
         return self
 
@@ -827,6 +1226,25 @@ class CollectionManager(object):
     def _coerce_by_parameter(self, parameters):
         if "by" in parameters:
             by = parameters['by']
+            if isinstance(by, (list, tuple)) and len(by) == 1:
+                by = parameters['by'] = by[0]
+            if isinstance(by, (list, tuple)):
+                # many fields, each one with its own order: save them as a list
+                # of tuples (wildcard, desc, alpha), the pk being represented by
+                # "#". `alpha` can be a list of the names to sort lexicographically
+                alpha = parameters.pop('alpha', False)
+                parameters['by'] = []
+                for name in by:
+                    desc = name.startswith('-')
+                    if desc:
+                        name = name[1:]
+                    name_alpha = name in alpha if isinstance(alpha, (list, tuple)) else bool(alpha)
+                    if self.model._field_is_pk(name):
+                        name = '#'
+                    elif self.model.has_field(name):
+                        name = self.model.get_field(name).sort_wildcard
+                    parameters['by'].append((name, desc, name_alpha))
+                return parameters
             # Manage desc option
             if by.startswith('-'):
                 parameters['desc'] = True
@@ -845,7 +1263,11 @@ class CollectionManager(object):
         Parameters:
         `by`: pass either a field name or a wildcard string to sort on
               prefix with `-` to make a desc sort.
+              Pass a list of them to sort on many fields, each one with its
+              own order (the sort is then done by a lua script).
         `alpha`: set it to True to sort lexicographically instead of numerically.
+                 When sorting on many fields, it can also be a list of the
+                 ones to sort lexicographically.
         """
         parameters = self._coerce_by_parameter(parameters)
         self._sort = parameters
@@ -854,6 +1276,221 @@ class CollectionManager(object):
     def sort(self, **parameters):
         return self.clone()._apply_sort(**parameters)
 
+    def after(self, cursor=None):
+        """
+        Ask the collection to only return results after the given cursor. The
+        collection must be sorted by a field with a `NumberRangeIndex` (or a
+        `TextRangeIndex` when sorting with `alpha=True`): instead of sorting
+        the whole collection, the sorted set of this index is walked from the
+        cursor, so the cost of a page does not depend on its depth.
+        Pass no cursor to get the first results. Once the collection is
+        fetched, the cursor to pass to get the next results is available in
+        the `next_cursor` attribute.
+        Entries with the same value are ordered by pk.
+        Note that `len()` of such a collection walks all the index after the
+        cursor, so only use it on small collections.
+        """
+        clone = self.clone()
+        clone._after = {'cursor': cursor}
+        return clone
+
+    def _find_sort_range_index(self):
+        """
+        Return the range index of the field used to sort the collection (a
+        `TextRangeIndex` if sorted with `alpha=True`, else a `NumberRangeIndex`),
+        without transform, that can be walked to get the collection in order.
+        Return None if there is no such index.
+        """
+        by = (self._sort or {}).get('by')
+        index_class = TextRangeIndex if (self._sort or {}).get('alpha') else NumberRangeIndex
+        if by:
+            for field in self.model.get_fields():
+                if field.indexable and field.sort_wildcard == by:
+                    for index in field._indexes:
+                        if isinstance(index, index_class) and not index.transform:
+                            return index
+        return None
+
+    def _get_sort_range_index(self):
+        """
+        Return the range index of the field used to sort the collection, that
+        is used to walk the collection in order when `after` is called.
+        Raise a ValueError if there is no such index.
+        """
+        index = self._find_sort_range_index()
+        if index is None:
+            raise ValueError('To use a cursor, the collection must be sorted by a field with a '
+                             'NumberRangeIndex, or a TextRangeIndex if sorted with alpha=True')
+        return index
+
+    def _walk_sort_index(self, final_set, sort_options):
+        """
+        Return the pks of the final set after the cursor passed to `after`, in
+        the order of the index of the sort field, and save the cursor to use to
+        get the next results.
+        If values are asked (`get` in `sort_options`), return them instead.
+        """
+        results = self._get_sort_range_index().walk(
+            final_set,
+            self._after['cursor'],
+            desc=bool(sort_options.get('desc')),
+            start=sort_options.get('start', 0),
+            num=sort_options.get('num', -1),
+        )
+        self.next_cursor = results[-1][1] if results else self._after['cursor']
+        return self._get_sorted_pks_values([pk for pk, cursor in results], sort_options)
+
+    def _get_top_from_sort_index(self, final_set, sort_options):
+        """
+        If only the first results of a collection sorted by a field with a
+        `NumberRangeIndex` are wanted (a slice with a stop), return them by
+        walking the sorted set of this index from the top, keeping the pks that
+        are in the final set, instead of sorting the whole final set.
+        Return None if the index cannot be used: if a pk has no value for the
+        field (it's not in the index but SORT would return it), or if the final
+        set is too small compared to the index for the walk to be faster.
+        """
+        num = sort_options.get('num', -1)
+        if num < 0 or sort_options.get('alpha') or sort_options.get('store'):
+            return None
+        index = self._find_sort_range_index()
+        if index is None:
+            return None
+
+        with self.connection.pipeline(transaction=False) as pipe:
+            pipe.zcard(index.get_storage_key(None))
+            pipe.scard(self.model.get_field('pk').collection_key)
+            getattr(pipe, self._get_length_command())(final_set)
+            index_len, nb_pks, final_len = pipe.execute()
+        if index_len != nb_pks:
+            return None
+        # about `index_len / final_len` entries of the index are read to find
+        # one in the final set, compared to sorting the whole final set
+        start = sort_options.get('start', 0)
+        if (start + num) * index_len > final_len * final_len:
+            return None
+
+        results = index.walk(final_set, desc=bool(sort_options.get('desc')), start=start, num=num)
+        return self._get_sorted_pks_values([pk for pk, cursor in results], sort_options)
+
+    def _get_sorted_pks_values(self, pks, sort_options):
+        """
+        Return the given pks, already sorted, or the values asked for them
+        (`get` in `sort_options`), in the same order
+        """
+        if not pks or not sort_options.get('get'):
+            return pks
+
+        # use a temporary list to get the values, keeping the order
+        tmp_key = self._unique_key('tmp')
+        try:
+            self.connection.rpush(tmp_key, *pks)
+            return self.connection.sort(tmp_key, by='nosort', get=sort_options['get'])
+        finally:
+            self.connection.delete(tmp_key)
+
+    @staticmethod
+    def _get_pattern_parts(pattern):
+        """
+        Return the parts of a sort wildcard (or any pattern usable with the
+        `by` or `get` arguments of the SORT command), to be used in lua scripts
+        to get the value for a pk: the part before the pk, the part after, and
+        the name of the field in the hash for an `InstanceHashField` (or an
+        empty string)
+        """
+        key, _, hash_field = pattern.partition('->')
+        prefix, _, suffix = key.partition('*')
+        return [prefix, suffix, hash_field]
+
+    def _get_lua_pattern_args(self, pattern):
+        """
+        Return the 4 args to pass to a lua script to get the value of a pattern
+        for a pk with the `get_pattern_value` lua helper: its kind ("pk" for
+        "#", else "field"), and its parts (see `_get_pattern_parts`)
+        """
+        if pattern == '#':
+            return ['pk', '', '', '']
+        return ['field'] + self._get_pattern_parts(pattern)
+
+    def _sort_by_fields(self, final_set, sort_options):
+        """
+        Return the members of the final set sorted by the many fields saved in
+        the `by` sort option, as a list of tuples (wildcard, desc, alpha), with
+        the other sort options (desc, start, num, get, store) applied as with
+        the SORT command.
+        All is done in a lua script, getting the values of the fields for all
+        the members and sorting them, so only the wanted slice is returned.
+        """
+        args = [
+            1 if sort_options.get('desc') else 0,
+            sort_options.get('start', 0),
+            sort_options.get('num', -1),
+            len(sort_options['by']),
+        ]
+        for pattern, desc, alpha in sort_options['by']:
+            args.extend([1 if desc else 0, 1 if alpha else 0])
+            args.extend(self._get_lua_pattern_args(pattern))
+        for pattern in sort_options.get('get') or []:
+            args.extend(self._get_lua_pattern_args(pattern))
+
+        keys = [final_set]
+        if sort_options.get('store'):
+            keys.append(sort_options['store'])
+
+        return self.model.database.call_script(
+            # use the script dict of this class, not the one of a subclass
+            script_dict=self.__class__.scripts['sort_by_fields'],
+            keys=keys,
+            args=args
+        )
+
+    def delete(self, chunk_size=None):
+        """
+        Delete all the instances matching the collection, by chunks of
+        `chunk_size` instances (`DELETE_CHUNK_SIZE` by default). Each chunk
+        costs a few round trips, whatever its size: one to retrieve the values
+        to deindex, and one MULTI/EXEC to update indexes and delete the keys.
+        Instances of a ``RelatedModel`` are first removed from the related
+        fields pointing to them.
+        Return the number of deleted instances.
+        """
+        chunk_size = chunk_size or self.DELETE_CHUNK_SIZE
+        pks = list(self.primary_keys())
+        for start in range(0, len(pks), chunk_size):
+            self.model._delete_instances([
+                self.model.lazy_connect(pk) for pk in pks[start:start + chunk_size]
+            ])
+        return len(pks)
+
+    def update(self, chunk_size=None, **values):
+        """
+        Set the given values (`StringField` and `InstanceHashField` only) to all
+        the instances matching the collection, by chunks of `chunk_size`
+        instances (`UPDATE_CHUNK_SIZE` by default). Each chunk costs a few round
+        trips, whatever its size: one to retrieve the current values of the
+        indexed fields, and one MULTI/EXEC to move the pks between index
+        entries (all the pks sharing the same old value at once) and to write
+        the values.
+        Return the number of updated instances.
+        A `UniquenessError` is raised without updating anything if a unique
+        field is updated for many instances.
+        """
+        chunk_size = chunk_size or self.UPDATE_CHUNK_SIZE
+        pks = list(self.primary_keys())
+        if len(pks) > 1:
+            for field_name in values:
+                if self.model.get_field(field_name).unique:
+                    raise UniquenessError(
+                        'Field "%s" is unique and cannot be updated for %s instances' % (
+                            field_name, len(pks)
+                        )
+                    )
+        for start in range(0, len(pks), chunk_size):
+            self.model._update_instances([
+                self.model.lazy_connect(pk) for pk in pks[start:start + chunk_size]
+            ], values)
+        return len(pks)
+
     def _unique_key(self, prefix=None):
         """
         Create a unique key.
@@ -863,5 +1500,5 @@ class CollectionManager(object):
             prefix_parts.append(prefix)
         return unique_key(
             self.connection,
-            prefix=make_key(*prefix_parts)
+            prefix=self.model.make_key(*prefix_parts)
         )
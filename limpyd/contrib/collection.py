@@ -4,20 +4,31 @@ from future.builtins import str
 from future.builtins import zip
 from future.builtins import object
 
-from itertools import islice, chain
-from collections import namedtuple
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from collections import namedtuple, OrderedDict
 from copy import copy, deepcopy
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
 from limpyd.model import RedisModel
-from limpyd.collection import CollectionManager, ParsedFilter
+from limpyd.collection import CollectionManager, ParsedFilter, JoinFilter, LUA_FINAL_SET_HELPERS
 from limpyd.fields import (SetField, ListField, SortedSetField, MultiValuesField,
-                           RedisField, SingleValueField)
-from limpyd.exceptions import DoesNotExist
-from limpyd.contrib.database import PipelineDatabase
-from limpyd.utils import make_key
+                           RedisField, SingleValueField, StringField)
+from limpyd.exceptions import DoesNotExist, ImplementationError
+from limpyd.indexes import EqualIndex
+from limpyd.utils import to_number
 
 SORTED_SCORE = 'sorted_score'
 DEFAULT_STORE_TTL = 60
+AGGREGATES = ('count', 'sum', 'min', 'max', 'avg')
 
 
 RawFilter = namedtuple('RawFilter', ['name', 'value'])
@@ -27,7 +38,7 @@ class ExtendedCollectionManager(CollectionManager):
 
     _accepted_key_types = {'set', 'zset', 'list'}  # Type of keys indexes are allowed to return
 
-    scripts = {
+    scripts = dict(CollectionManager.scripts, **{
         'list_to_set': {
             # add all members of the list in a new set
             'lua': """
@@ -38,7 +49,209 @@ class ExtendedCollectionManager(CollectionManager):
                 return 1
             """,
         },
-    }
+        'list_to_zset': {
+            # replace the list by a sorted set with the same members, with
+            # their position in the list as score
+            'lua': """
+                local members = redis.call('lrange', KEYS[1], 0, -1)
+                redis.call('del', KEYS[1])
+                for i, member in ipairs(members) do
+                    redis.call('zadd', KEYS[1], i, member)
+                end
+                return #members
+            """,
+        },
+        'refresh_stored_zset': {
+            # remove from the stored sorted set KEYS[1] the members not in
+            # KEYS[2] (the final set of the collection, a set, zset or list),
+            # and add the members of KEYS[2] not in KEYS[1] to the set KEYS[3].
+            # Return the number of removed members
+            'lua': LUA_FINAL_SET_HELPERS + """
+                local lookup = {}
+                for _, pk in ipairs(members(KEYS[2])) do
+                    lookup[pk] = true
+                    if not redis.call('zscore', KEYS[1], pk) then
+                        redis.call('sadd', KEYS[3], pk)
+                    end
+                end
+                local removed = 0
+                for _, pk in ipairs(redis.call('zrange', KEYS[1], 0, -1)) do
+                    if not lookup[pk] then
+                        removed = removed + redis.call('zrem', KEYS[1], pk)
+                    end
+                end
+                return removed
+            """,
+        },
+        'count_by': {
+            # count the members of the set for each value of a field. Return
+            # the number of members without value, then pairs of value/count
+            'lua': LUA_FINAL_SET_HELPERS + """
+                local counts, values, missing = {}, {}, 0
+                for _, pk in ipairs(members(KEYS[1])) do
+                    local value = get_value(ARGV[1], ARGV[2], ARGV[3], pk)
+                    if value then
+                        if not counts[value] then
+                            counts[value] = 0
+                            table.insert(values, value)
+                        end
+                        counts[value] = counts[value] + 1
+                    else
+                        missing = missing + 1
+                    end
+                end
+                local result = {missing}
+                for _, value in ipairs(values) do
+                    table.insert(result, value)
+                    table.insert(result, counts[value])
+                end
+                return result
+            """,
+        },
+        'aggregate': {
+            # for each field (3 args by field, the parts of its sort wildcard),
+            # return the count, sum, min and max of its numeric values, as
+            # strings to not lose floats: min and max are the stored values,
+            # and the sum is formatted with all the digits of a double
+            'lua': LUA_FINAL_SET_HELPERS + """
+                local pks = members(KEYS[1])
+                local result = {}
+                for i = 1, #ARGV, 3 do
+                    local count, sum, min, max, min_raw, max_raw = 0, 0, nil, nil, '', ''
+                    for _, pk in ipairs(pks) do
+                        local raw = get_value(ARGV[i], ARGV[i+1], ARGV[i+2], pk)
+                        local value = tonumber(raw)
+                        if value then
+                            count = count + 1
+                            sum = sum + value
+                            if min == nil or value < min then min, min_raw = value, raw end
+                            if max == nil or value > max then max, max_raw = value, raw end
+                        end
+                    end
+                    table.insert(result, tostring(count))
+                    table.insert(result, string.format('%.17g', sum))
+                    table.insert(result, min_raw)
+                    table.insert(result, max_raw)
+                end
+                return result
+            """,
+        },
+        'sort_by_score': {
+            # return the members of KEYS[1] (the final set of the collection, a
+            # set, zset or list) sorted by their score in the zset KEYS[2],
+            # computed in the temporary zset KEYS[3] (members not in KEYS[2]
+            # come first, as with a score of -inf). ARGV: desc, start, num,
+            # then 4 args for each value to get, as with SORT GET (see
+            # `_get_lua_pattern_args`). If KEYS[4] is given, the result is stored in this list
+            # and its length is returned
+            'lua': LUA_FINAL_SET_HELPERS + """
+                local final_key, score_key, tmp_key = KEYS[1], KEYS[2], KEYS[3]
+                local final_type = redis.call('type', final_key)['ok']
+                if final_type == 'list' then
+                    -- zinterstore only accepts sets and zsets
+                    for _, pk in ipairs(members(final_key)) do
+                        redis.call('zadd', tmp_key, 0, pk)
+                    end
+                    final_key = tmp_key
+                end
+                local total
+                if final_type == 'set' then
+                    total = redis.call('scard', final_key)
+                else
+                    total = redis.call('zcard', final_key)
+                end
+                redis.call('zinterstore', tmp_key, 2, final_key, score_key, 'weights', 0, 1)
+                if redis.call('zcard', tmp_key) < total then
+                    for _, pk in ipairs(members(KEYS[1])) do
+                        if not redis.call('zscore', tmp_key, pk) then
+                            redis.call('zadd', tmp_key, '-inf', pk)
+                        end
+                    end
+                end
+                local start, num = tonumber(ARGV[2]), tonumber(ARGV[3])
+                local pks, scores = {}, {}
+                if num ~= 0 then
+                    local stop = num < 0 and -1 or start + num - 1
+                    local command = ARGV[1] == '1' and 'zrevrange' or 'zrange'
+                    local members = redis.call(command, tmp_key, start, stop, 'withscores')
+                    for i = 1, #members, 2 do
+                        table.insert(pks, members[i])
+                        table.insert(scores, members[i+1])
+                    end
+                end
+                redis.call('del', tmp_key)
+                local result = pks
+                if #ARGV > 3 then
+                    result = {}
+                    for j, pk in ipairs(pks) do
+                        for i = 4, #ARGV, 4 do
+                            if ARGV[i] == 'score' then
+                                -- read from the temporary zset, to have -inf for missing members
+                                table.insert(result, scores[j])
+                            else
+                                table.insert(result, get_pattern_value(ARGV, i, pk))
+                            end
+                        end
+                    end
+                end
+                if KEYS[4] then
+                    return store(KEYS[4], result)
+                end
+                return result
+            """,
+        },
+        'facets': {
+            # return the cardinality of the set KEYS[1] (the final set of the
+            # collection, a set, zset or list), then the cardinality of its
+            # intersection with each other given key (sets). SINTERCARD is used
+            # if available (redis 7+) and the final set is a set
+            'lua': """
+                local final_key = KEYS[1]
+                local final_type = redis.call('type', final_key)['ok']
+                local has_sintercard = final_type == 'set'
+                    and type(redis.pcall('sintercard', 1, final_key)) == 'number'
+                local result, lookup, total = {}, nil, 0
+                if final_type == 'set' then
+                    total = redis.call('scard', final_key)
+                else
+                    local members
+                    if final_type == 'zset' then
+                        members = redis.call('zrange', final_key, 0, -1)
+                    else
+                        members = redis.call('lrange', final_key, 0, -1)
+                    end
+                    lookup = {}
+                    for _, member in ipairs(members) do
+                        if not lookup[member] then
+                            lookup[member] = true
+                            total = total + 1
+                        end
+                    end
+                end
+                table.insert(result, total)
+                for i = 2, #KEYS do
+                    local count = 0
+                    if has_sintercard then
+                        count = redis.call('sintercard', 2, final_key, KEYS[i])
+                    elseif lookup then
+                        for _, member in ipairs(redis.call('smembers', KEYS[i])) do
+                            if lookup[member] then count = count + 1 end
+                        end
+                    else
+                        local small, big = KEYS[i], final_key
+                        if redis.call('scard', small) > total then
+                            small, big = big, small
+                        end
+                        for _, member in ipairs(redis.call('smembers', small)) do
+                            count = count + redis.call('sismember', big, member)
+                        end
+                    end
+                    table.insert(result, count)
+                end
+                return result
+            """,
+        },
+    })
 
     def __init__(self, model):
         super(ExtendedCollectionManager, self).__init__(model)
@@ -51,8 +264,12 @@ class ExtendedCollectionManager(CollectionManager):
         self._store = False
         self.stored_key = False
         self._stored_len = None
+        self._stored_type = None  # type of the stored key, "list" or "zset"
+        self._stored_source = None  # collection stored by `store`, to refresh
 
         self._values = None  # Will store parameters used to retrieve values
+        self._select_related = None  # Will store names of foreign keys to fetch with instances
+        self._prefetch_related = None  # Will store names of M2M fields to fetch with instances
 
     def clone(self):
         new = super(ExtendedCollectionManager, self).clone()
@@ -61,7 +278,11 @@ class ExtendedCollectionManager(CollectionManager):
         new._store = self._store
         new.stored_key = self.stored_key
         new._stored_len = self._stored_len
+        new._stored_type = self._stored_type
+        new._stored_source = self._stored_source
         new._values = {key: copy(value) for key, value in self._values.items()} if self._values is not None else None
+        new._select_related = copy(self._select_related)
+        new._prefetch_related = copy(self._prefetch_related)
         return new
 
     def _list_to_set(self, list_key, set_key):
@@ -92,6 +313,9 @@ class ExtendedCollectionManager(CollectionManager):
             self._sort = None
             self._sort_by_sortedset['desc'] = not self._sort_by_sortedset.get('desc', False)
 
+        if self._sort_by_sortedset and self.model.database.sharded:
+            raise ImplementationError('Sorting by score is not supported on a sharded database')
+
         super(ExtendedCollectionManager, self)._fetch_collection(apply_slice=apply_slice)
 
     def _prepare_sets(self, sets):
@@ -153,6 +377,8 @@ class ExtendedCollectionManager(CollectionManager):
             elif isinstance(set_, ParsedFilter):
                 for index_key, key_type, is_tmp in self._prepare_parsed_filter(set_):
                     add_key(index_key, key_type, is_tmp)
+            elif isinstance(set_, JoinFilter):
+                add_key(self._get_join_filter_key(set_), 'set', True)
             elif isinstance(set_, SetField):
                 # Use the set key. If we need to intersect, we'll use
                 # sunionstore, and if not, store accepts set
@@ -161,7 +387,9 @@ class ExtendedCollectionManager(CollectionManager):
                 # Use the sorted set key. If we need to intersect, we'll use
                 # zinterstore, and if not, store accepts zset
                 add_key(set_.key, 'zset')
-            elif isinstance(set_, (ListField, _StoredCollection)):
+            elif isinstance(set_, _StoredCollection):
+                add_key(set_.key, set_.key_type)
+            elif isinstance(set_, ListField):
                 add_key(set_.key, 'list')
             elif isinstance(set_, tuple) and len(set_):
                 # if we got a list or set, create a redis set to hold its values
@@ -220,7 +448,8 @@ class ExtendedCollectionManager(CollectionManager):
                                  'limpyd multi-values field ('
                                  'SetField, ListField or SortedSetField), or '
                                  'real python set, list or tuple' % set_)
-            if isinstance(set_, SortedSetField):
+            if isinstance(set_, SortedSetField) or \
+                    isinstance(set_, _StoredCollection) and set_.key_type == 'zset':
                 self._has_sortedsets = True
             sets_.add(set_)
 
@@ -250,58 +479,46 @@ class ExtendedCollectionManager(CollectionManager):
         options, call zrange on the final set wich is the result of a call to
         zinterstore.
         """
-        conn = self.connection
+        # we have to sort by the score of a sorted set
+        if self._sort_by_sortedset:
+            return self._sort_by_score(final_set, sort_options)
 
         # we have a sorted set without need to sort, use zrange
         if self._has_sortedsets and sort_options is None:
 
-            return conn.zrange(final_set, 0, -1)
+            return self._get_read_connection().zrange(final_set, 0, -1)
 
         # we have a stored collection, without other filter, and no need to
-        # sort, use lrange
+        # sort, use lrange (or zrange if stored as a sorted set)
         if self.stored_key and not self._lazy_collection['sets']\
                 and len(self._lazy_collection['intersects']) == 1\
                 and (sort_options is None or sort_options == {'by': 'nosort'}):
 
-            return conn.lrange(final_set, 0, -1)
+            if self._stored_type == 'zset':
+                return self._get_read_connection().zrange(final_set, 0, -1)
+            return self._get_read_connection().lrange(final_set, 0, -1)
 
-        keys_to_delete_after = set()
-        try:
-            if final_set and self._sort_by_sortedset_before:
-                # TODO: if we have filters, maybe apply _zet_to_keys to only
-                #       intersected values
-                base_tmp_key, tmp_keys = self._prepare_sort_by_score(None, sort_options)
-                # new keys have to be deleted once the final sort is done
-                keys_to_delete_after.add(base_tmp_key)
-                keys_to_delete_after |= tmp_keys
-
-            # normal call
-            return super(ExtendedCollectionManager, self)._final_redis_call(
-                                                            final_set, sort_options)
-
-        finally:
-            if keys_to_delete_after:
-                conn.delete(*keys_to_delete_after)
+        # normal call
+        return super(ExtendedCollectionManager, self)._final_redis_call(
+                                                        final_set, sort_options)
 
-    def _collection_length(self, final_set):
+    def _get_length_command(self):
         """
-        Return the length of the final collection, directly asking redis for the
-        count without calling sort
+        Return the name of the redis command giving the length of the final
+        set, depending on its type
         """
-        conn = self.connection
-
         # we have a sorted set without need to sort, use zcard
         if self._has_sortedsets:
-            return conn.zcard(final_set)
+            return 'zcard'
 
         # we have a stored collection, without other filter, use llen
         elif self.stored_key and not self._lazy_collection['sets']\
                 and len(self._lazy_collection['intersects']) == 1:
 
-            return conn.llen(final_set)
+            return 'llen'
 
         # normal call
-        return super(ExtendedCollectionManager, self)._collection_length(final_set)
+        return super(ExtendedCollectionManager, self)._get_length_command()
 
     def _apply_sort(self, **parameters):
         """
@@ -336,6 +553,9 @@ class ExtendedCollectionManager(CollectionManager):
             by = parameters.get('by')
             if by and isinstance(by, RedisField):
                 parameters['by'] = by.name
+            elif by and isinstance(by, (list, tuple)):
+                parameters['by'] = [name.name if isinstance(name, RedisField) else name
+                                    for name in by]
 
         super(ExtendedCollectionManager, self)._apply_sort(**parameters)
 
@@ -345,115 +565,50 @@ class ExtendedCollectionManager(CollectionManager):
 
         return self
 
-    def _zset_to_keys(self, key, values=None, alpha=False):
+    def _sort_by_score(self, final_set, sort_options):
         """
-        Convert a redis sorted set to a list of keys, to be used by sort.
-        Each key is on the following format, for each value in the sorted set:
-            ramdom_string:value-in-the-sorted-set => score-of-the-value
-        The random string is the same for all keys.
-        If values is not None, only these values from the sorted set are saved
-        as keys.
-        If a value in values is not on the sorted set, it's still saved as a key
-        but with a default value ('' is alpha is True, else '-inf')
+        Return the members of the final set sorted by their score in the sorted
+        set referenced in self._sort_by_sortedset, with the limits, values to
+        get and key to store the result from the sort options.
+        All is done in a lua script, intersecting the final set with the sorted
+        set in a temporary zset to read the wanted range from it, so no key
+        is created for each member to sort on.
         """
-        conn = self.connection
-        default = '' if alpha else '-inf'
-        if values is None:
-            # no values given, we get scores from the whole sorted set
-            result = conn.zrange(key, start=0, end=-1, withscores=True)
-            values = list(islice(chain.from_iterable(result), 0, None, 2))
-        else:
-            # we have values, we'll get only their scores
-
-            if isinstance(self.model.database, PipelineDatabase):
-                # if available, use the pipeline of our database to get all
-                # scores in one redis call
-                with self.model.database.pipeline(transaction=False) as pipe:
-                    for value in values:
-                        pipe.zscore(key, value)
-                    scores = pipe.execute()
-            else:
-                # no pipeline, we have to do a call for each value
-                scores = []
-                for value in values:
-                    scores.append(conn.zscore(key, value))
-
-            # combine values and scores in one list
-            result = []
-            for index, value in enumerate(values):
-                score = scores[index]
-                if score is None:
-                    score = default
-                result.append((value, score))
-
-        # create a temporary key for each (value,score) tuple
-        base_tmp_key = self._unique_key('tmp')
-        conn.set(base_tmp_key, 'working...')  # only to "reserve" the main tmp key
-        tmp_keys = set()
-        # use a mapping dict (tmp_key_with_value=>score) to use in mset
-        mapping = {}
-        for value, score in result:
-            tmp_key = make_key(base_tmp_key, value)
-            tmp_keys.add(tmp_key)
-            mapping[tmp_key] = score
-        # set all keys in one call
-        conn.mset(mapping)
-
-        return base_tmp_key, tmp_keys
-
-    def _prepare_sort_by_score(self, values, sort_options):
-        """
-        Create the key to sort on the sorted set references in
-        self._sort_by_sortedset and adapte sort options
-        """
-        # create the keys
-        base_tmp_key, tmp_keys = self._zset_to_keys(
-                                    key=self._sort_by_sortedset['by'],
-                                    values=values,
-                                    )
-        # ask to sort on our new keys
-        sort_options['by'] = '%s:*' % base_tmp_key
-
-        # retrieve original sort parameters
-        for key in ('desc', 'alpha', 'get', 'store'):
-            if key in self._sort_by_sortedset:
-                sort_options[key] = self._sort_by_sortedset[key]
-
-        # if we want to get the score with values/values_list
-        if sort_options.get('get'):
-            try:
-                pos = sort_options['get'].index(SORTED_SCORE)
-            except:
-                pass
-            else:
-                sort_options['get'][pos] = '%s:*' % base_tmp_key
+        sort_options = sort_options or {}
+        get = sort_options.get('get') or []
+        keys = [final_set, self._sort_by_sortedset['by'], self._unique_key('tmp')]
+        if sort_options.get('store'):
+            keys.append(sort_options['store'])
+
+        args = [
+            1 if self._sort_by_sortedset.get('desc') else 0,
+            sort_options.get('start', 0),
+            sort_options.get('num', -1),
+        ]
+        for pattern in get:
+            args.extend(self._get_lua_pattern_args(pattern))
+
+        results = self.model.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=self.__class__.scripts['sort_by_score'],
+            keys=keys,
+            args=args
+        )
+
+        if SORTED_SCORE in get and not sort_options.get('store'):
+            # scores are returned as strings by redis, keep the float format
+            results = list(results)
+            for index in range(get.index(SORTED_SCORE), len(results), len(get)):
+                if results[index] is not None:
+                    results[index] = str(float(results[index]))
 
-        return base_tmp_key, tmp_keys
+        return results
 
     def _prepare_results(self, results, apply_slice=None):
         """
-        Sort results by score if not done before (faster, if we have no values to
-        retrieve, or slice)
+        Regroup values by entry if needed, and apply the python slice
         """
-        # if we want a result sorted by a score, and if we have a full result
-        # (no slice), we can do it know, by creating keys for each values with
-        # the sorted set score, and sort on them
-        if self._sort_by_sortedset_after and (len(results) > 1 or self._values):
-            conn = self.connection
-
-            sort_params = {}
-            base_tmp_key, tmp_keys = self._prepare_sort_by_score(results, sort_params)
-
-            # compose the set to sort
-            final_set = '%s_final_set' % base_tmp_key
-            conn.sadd(final_set, *results)
-
-            # apply the sort
-            results = list(conn.sort(final_set, **sort_params))
-
-            # finally delete all temporary keys
-            conn.delete(*(tmp_keys | {final_set, base_tmp_key}))
-
         if self._store:
             # if store, redis doesn't return result, so don't return anything here
             _len_hint = 0
@@ -462,9 +617,15 @@ class ExtendedCollectionManager(CollectionManager):
         else:
             results = list(results)
 
-            if self._values and self._values['mode'] != 'flat':
-                # regroup results by tuples when we have many values by entry
-                results = list(zip(*([iter(results)] * len(self._values['fields']['names']))))
+            if self._values:
+                results = self._resolve_related_values(results, self._values['fields'])
+                if self._values['mode'] != 'flat':
+                    # regroup results by tuples when we have many values by entry
+                    results = list(zip(*([iter(results)] * len(self._values['fields']['names']))))
+
+            elif self._instances and (self._select_related or self._prefetch_related):
+                # regroup the pk and the values of the foreign keys of each entry
+                results = list(zip(*([iter(results)] * (len(self._select_related or []) + 1))))
 
             if apply_slice is not None:
                 results = results[apply_slice]
@@ -474,44 +635,197 @@ class ExtendedCollectionManager(CollectionManager):
 
         if self._values and self._values['mode'] == 'dicts':
             iterator_function = self._to_values_dict
+        elif self._instances and (self._select_related or self._prefetch_related) and not self._store:
+            results, iterator_function = self._to_instances_with_related(results), None
 
         return results, iterator_function
 
     def _to_values_dict(self, collection_entry):
         return dict(zip(self._values['fields']['names'], collection_entry))
 
-    @property
-    def _sort_by_sortedset_before(self):
+    def _resolve_related_values(self, results, fields):
         """
-        Return True if we have to sort by set and do the stuff *before* asking
-        redis for the sort
+        Replace, in the flat list of values returned by redis, the pks fetched
+        for the "fk__field" names of `fields` (see `_coerce_fields_parameters`)
+        by the values of the fields of the related instances, all read in a
+        single pipeline
         """
-        return self._sort_by_sortedset and self._sort_limits and (not self._lazy_collection['pks']
-                                                            or self._want_score_value)
+        if not fields.get('related') or not results:
+            return results
+
+        results = list(results)
+        width = len(fields['names'])
+        to_read = OrderedDict()
+        for position, (related_model, field_name) in fields['related'].items():
+            if field_name is None:
+                # the pk of the related instance is the value of the foreign key
+                continue
+            for index in range(position, len(results), width):
+                if results[index] is not None:
+                    to_read.setdefault((related_model, field_name, results[index]), None)
+
+        if not to_read:
+            return results
+
+        with self.model.database.connection.pipeline(transaction=False) as pipe:
+            for related_model, field_name, pk in to_read:
+                prefix, suffix, hash_field = self._get_pattern_parts(
+                    related_model.get_field(field_name).sort_wildcard)
+                if hash_field:
+                    pipe.hget(prefix + pk + suffix, hash_field)
+                else:
+                    pipe.get(prefix + pk + suffix)
+            to_read = dict(zip(to_read, pipe.execute()))
 
-    @property
-    def _sort_by_sortedset_after(self):
+        for position, (related_model, field_name) in fields['related'].items():
+            if field_name is None:
+                continue
+            for index in range(position, len(results), width):
+                if results[index] is not None:
+                    results[index] = to_read[(related_model, field_name, results[index])]
+
+        return results
+
+    def _get_related_field(self, name, many=False):
         """
-        Return True if we have to sort by set and do the stuff *after* asking
-        redis for the sort
+        Return the field of the model with the given name, and the model it is
+        related to, if it is a foreign key (a related field holding a single
+        value, like `FKStringField`), or a M2M field (like `M2MSetField`) if
+        `many` is True, else raise a ValueError
         """
-        return self._sort_by_sortedset and not self._sort_limits and (not self._lazy_collection['pks']
-                                                                or self._want_score_value)
-
-    @property
-    def _want_score_value(self):
+        field = self.model.get_field(name) if self.model.has_field(name) else None
+        if not isinstance(field, MultiValuesField if many else SingleValueField) \
+                or not getattr(field, 'related_to', None):
+            raise ValueError("%s is not a %s of %s" % (
+                name, 'M2M field' if many else 'foreign key', self.model.__name__))
+        return field, field.database._models[field.related_to]
+
+    def _check_existence(self, models_and_pks):
+        """
+        Return a dict with, for each (model, pk) tuple of the given list, if
+        the instance exists, all checked in a single pipeline
+        """
+        if not models_and_pks:
+            return {}
+        with self.model.database.connection.pipeline(transaction=False) as pipe:
+            for model, pk in models_and_pks:
+                pipe.sismember(model.get_field('pk').collection_key, pk)
+            return dict(zip(models_and_pks, pipe.execute()))
+
+    def _to_instances_with_related(self, entries):
         """
-        Return True if we want the score of the sorted set used to sort in the
-        results from values/values_list
+        Return the instances for the given entries (tuples with a pk and the
+        values of the foreign keys in `_select_related`), with their related
+        instances attached to the foreign keys in `_select_related`, and to
+        the M2M fields in `_prefetch_related`.
+        A first pipeline checks the existence of the instances (if not lazy)
+        and of the ones related by the foreign keys, reads the values of the
+        single value fields of the latter (returned by their getters without
+        calling redis), and reads the members of the M2M fields. A second one
+        checks the existence of these members, each distinct one being
+        checked, and created, only once.
         """
-        return self._values and SORTED_SCORE in self._values['fields']['names']
+        foreign_keys = [self._get_related_field(name) for name in self._select_related or []]
+        m2m_fields = [self._get_related_field(name, many=True) for name in self._prefetch_related or []]
+
+        to_check = OrderedDict()
+        to_prefetch = OrderedDict()
+        for entry in entries:
+            if not self._lazy_instances:
+                to_check.setdefault((self.model, entry[0]), None)
+            for (field, related_model), pk in zip(foreign_keys, entry[1:]):
+                if pk is not None:
+                    to_check.setdefault((related_model, pk), None)
+                    to_prefetch.setdefault((related_model, pk), None)
+
+        instances = [self.model.lazy_connect(entry[0]) for entry in entries]
+        related_instances = {}
+
+        results, prefetched_fields = [], []
+        if to_check or (m2m_fields and instances):
+            with self.model.database.connection.pipeline(transaction=False) as pipe:
+                for model, pk in to_check:
+                    pipe.sismember(model.get_field('pk').collection_key, pk)
+                prefetched_fields = [
+                    self._pipeline_prefetch_values(
+                        pipe, self._get_related_instance(related_instances, model, pk))
+                    for model, pk in to_prefetch
+                ]
+                for instance in instances:
+                    for field, related_model in m2m_fields:
+                        instance.get_field(field.name)._pipeline_proxy_get(pipe)
+                results = pipe.execute()
+        exist = dict(zip(to_check, results))
+        results = results[len(to_check):]
+
+        for (model, pk), (hash_names, string_names) in zip(to_prefetch, prefetched_fields):
+            values = []
+            if hash_names:
+                values.extend(results.pop(0))
+            values.extend(results[:len(string_names)])
+            results = results[len(string_names):]
+            if exist[(model, pk)]:
+                related_instances[(model, pk)]._prefetched_values = dict(
+                    zip(hash_names + string_names, values))
+
+        members = results
+        if members:
+            to_check = OrderedDict()
+            for index, pks in enumerate(members):
+                related_model = m2m_fields[index % len(m2m_fields)][1]
+                for pk in pks:
+                    if (related_model, pk) not in exist:
+                        to_check.setdefault((related_model, pk), None)
+            exist.update(self._check_existence(list(to_check)))
+
+        for position, (entry, instance) in enumerate(zip(entries, instances)):
+            if not self._lazy_instances and not exist[(self.model, entry[0])]:
+                raise DoesNotExist("No %s found with pk %s" % (self.model.__name__, entry[0]))
+            instance._connected = not self._lazy_instances
+            for (field, related_model), pk in zip(foreign_keys, entry[1:]):
+                if pk is not None and exist[(related_model, pk)]:
+                    instance.get_field(field.name)._related_cache = \
+                        self._get_related_instance(related_instances, related_model, pk)
+            for index, (field, related_model) in enumerate(m2m_fields):
+                instance.get_field(field.name)._related_cache = [
+                    self._get_related_instance(related_instances, related_model, pk)
+                    for pk in members[position * len(m2m_fields) + index]
+                    if exist[(related_model, pk)]
+                ]
+
+        return instances
+
+    @staticmethod
+    def _pipeline_prefetch_values(pipe, instance):
+        """
+        Add to the pipeline the commands to read the values of the single
+        value fields of the given instance: one HMGET for its
+        ``InstanceHashField``, and one GET by ``StringField``. Return a tuple
+        with the names of these two kinds of fields.
+        """
+        hash_names = list(instance._instancehash_fields)
+        string_names = [name for name in instance._fields
+                        if isinstance(instance.get_field(name), StringField)]
+        if hash_names:
+            pipe.hmget(instance.key, hash_names)
+        for name in string_names:
+            pipe.get(instance.get_field(name).key)
+        return hash_names, string_names
+
+    @staticmethod
+    def _get_related_instance(related_instances, model, pk):
+        """
+        Return the connected instance of the model with the given pk, created
+        only once by (model, pk) in the given `related_instances` dict
+        """
+        if (model, pk) not in related_instances:
+            related_instances[(model, pk)] = model.lazy_connect(pk)
+            related_instances[(model, pk)]._connected = True
+        return related_instances[(model, pk)]
 
     def _prepare_sort_options(self, has_pk):
         """
         Prepare sort options for _values attributes.
-        If we manager sort by score after getting the result, we do not want to
-        get values from the first sort call, but only from the last one, after
-        converting results in zset into keys
         """
         sort_options = super(ExtendedCollectionManager, self)._prepare_sort_options(has_pk)
 
@@ -522,16 +836,13 @@ class ExtendedCollectionManager(CollectionManager):
                 sort_options = {}
             sort_options['get'] = self._values['fields']['keys']
 
-        if self._sort_by_sortedset_after:
-            for key in ('get', 'store'):
-                if key in self._sort_by_sortedset:
-                    del self._sort_by_sortedset[key]
-            if sort_options and (not has_pk or self._want_score_value):
-                for key in ('get', 'store'):
-                    if key in sort_options:
-                        self._sort_by_sortedset[key] = sort_options.pop(key)
+        elif self._instances and self._select_related:
+            # get the values of the foreign keys with the pks
             if not sort_options:
-                sort_options = None
+                sort_options = {'by': 'nosort'}
+            sort_options['get'] = ['#'] + [self.model.get_field(name).sort_wildcard
+                                           for name in self._select_related]
+
         return sort_options
 
     def _get_final_set(self, sets, pk, sort_options):
@@ -586,10 +897,8 @@ class ExtendedCollectionManager(CollectionManager):
                     raw_filter = RawFilter(key, value)
                     self._lazy_collection['pks'].add(raw_filter)
                 else:
-                    # create an ParsedFilter which will be used in _prepare_sets
-                    index, suffix, extra_field_parts = self._parse_filter_key(key)
-                    parsed_filter = ParsedFilter(index, suffix, extra_field_parts, value, None)
-                    self._lazy_collection['sets'].append(parsed_filter)
+                    # create an ParsedFilter (or JoinFilter) which will be used in _prepare_sets
+                    self._lazy_collection['sets'].append(self._make_filter(key, value))
 
                 string_filters.pop(key)
 
@@ -628,6 +937,13 @@ class ExtendedCollectionManager(CollectionManager):
         a name to retrieve.
         If finally the result is not sorted by score, the value for this part
         will be None
+        A name can also be "fk__field", with "fk" the name of a foreign key (a
+        related field holding a single value, like `FKStringField`) and
+        "field" the name of a simple value field (or the pk) of the related
+        model: the pk of the related instance is retrieved by the sort command,
+        then replaced by the value of the field (see `_resolve_related_values`).
+        Such names are saved, by position, in a third entry, 'related', with
+        the related model and the name of the field (None for the pk).
         """
         try:
             sorted_score_pos = fields.index(SORTED_SCORE)
@@ -637,11 +953,24 @@ class ExtendedCollectionManager(CollectionManager):
             fields = list(fields)
             fields.pop(sorted_score_pos)
 
-        final_fields = {'names': [], 'keys': []}
+        final_fields = {'names': [], 'keys': [], 'related': {}}
+        related = {}
         for field_name in fields:
             if self._field_is_pk(field_name):
                 final_fields['names'].append(field_name)
                 final_fields['keys'].append('#')
+            elif '__' in field_name and not self.model.has_field(field_name):
+                fk_name, related_name = field_name.split('__', 1)
+                field, related_model = self._get_related_field(fk_name)
+                if related_model._field_is_pk(related_name):
+                    related_name = None
+                elif not related_model.has_field(related_name) or \
+                        not isinstance(related_model.get_field(related_name), SingleValueField):
+                    raise ValueError("%s if not a valid field to get from collection"
+                                     " for %s" % (field_name, self.model.__name__))
+                related[field_name] = (related_model, related_name)
+                final_fields['names'].append(field_name)
+                final_fields['keys'].append(field.sort_wildcard)
             else:
                 if not self.model.has_field(field_name):
                     raise ValueError("%s if not a valid field to get from collection"
@@ -657,9 +986,13 @@ class ExtendedCollectionManager(CollectionManager):
             final_fields['names'].insert(sorted_score_pos, SORTED_SCORE)
             final_fields['keys'].insert(sorted_score_pos, SORTED_SCORE)
 
+        for position, field_name in enumerate(final_fields['names']):
+            if field_name in related:
+                final_fields['related'][position] = related[field_name]
+
         return final_fields
 
-    def store(self, key=None, ttl=DEFAULT_STORE_TTL):
+    def store(self, key=None, ttl=DEFAULT_STORE_TTL, as_zset=False):
         """
         Will call the collection and store the result in Redis, and return a new
         collection based on this stored result. Note that only primary keys are
@@ -670,6 +1003,10 @@ class ExtendedCollectionManager(CollectionManager):
         The ttl is the time redis will keep the new key. By default its
         DEFAULT_STORE_TTL, which is 60 secondes. You can pass None if you don't
         want expiration.
+        The result is stored in a list, or, if `as_zset` is True, in a sorted
+        set with the position of each pk as score: it's cheaper to intersect
+        with other sets when filtering the new collection, and this one can
+        be updated with `refresh`.
         """
         clone = self.clone()
         clone._store = True
@@ -682,6 +1019,8 @@ class ExtendedCollectionManager(CollectionManager):
         if clone._values is not None:
             values = clone._values
             clone._values = None
+        clone._select_related, select_related = None, clone._select_related
+        clone._prefetch_related, prefetch_related = None, clone._prefetch_related
 
         # create a key for storage
         store_key = key or clone._unique_key('store')
@@ -698,8 +1037,18 @@ class ExtendedCollectionManager(CollectionManager):
         clone._len_mode = False
         clone._fetch_collection()
 
+        if as_zset:
+            self.model.database.call_script(
+                script_dict=self.__class__.scripts['list_to_zset'],
+                keys=[store_key]
+            )
+
         # create the new collection
-        stored_collection = clone.__class__(clone.model).from_stored(store_key)
+        stored_collection = clone.__class__(clone.model)._from_stored(
+                                        store_key, 'zset' if as_zset else 'list')
+        if as_zset:
+            # keep the original collection to be able to refresh the stored one
+            stored_collection._stored_source = self.clone()
 
         # apply ttl if needed
         if ttl is not None:
@@ -708,6 +1057,8 @@ class ExtendedCollectionManager(CollectionManager):
         # set choices about instances/values from the current to the new collection
         for attr in ('_instances', '_lazy_instances', '_values'):
             setattr(stored_collection, attr, deepcopy(getattr(clone, attr)))
+        stored_collection._select_related = select_related
+        stored_collection._prefetch_related = prefetch_related
 
         # finally return the new collection
         return stored_collection
@@ -717,6 +1068,14 @@ class ExtendedCollectionManager(CollectionManager):
         Set the current collection as based on a stored one. The key argument
         is the key off the stored collection.
         """
+        key_type = self.connection.type(key)
+        return self._from_stored(key, 'zset' if key_type == 'zset' else 'list')
+
+    def _from_stored(self, key, key_type):
+        """
+        Do the work of `from_stored`, with the type of the stored key ("list"
+        or "zset") given, as the key does not exist if the collection is empty
+        """
         clone = self.clone()
 
         # only one stored key allowed
@@ -724,16 +1083,135 @@ class ExtendedCollectionManager(CollectionManager):
             raise ValueError('This collection is already based on a stored one')
 
         # prepare the collection
+        conn = clone.model.get_connection()
         clone.stored_key = key
-        clone._apply_intersect(_StoredCollection(clone.model.get_connection(), key))
+        clone._stored_type = key_type
+        clone._apply_intersect(_StoredCollection(conn, key, clone._stored_type))
         clone._apply_sort(by='nosort')  # keep stored order
 
         # count the number of results to manage empty result (to not behave like
         # expired key)
-        clone._stored_len = clone.model.get_connection().llen(key)
+        if clone._stored_type == 'zset':
+            clone._stored_len = conn.zcard(key)
+        else:
+            clone._stored_len = conn.llen(key)
 
         return clone
 
+    def refresh(self):
+        """
+        Update a collection returned by `store` called with `as_zset=True`
+        (only in the same process), to match the current state of the stored
+        collection, without running it again: its final set is computed, but
+        not sorted, and compared to the stored one. Primary keys not matching
+        anymore are removed, and new ones are sorted, then inserted at their
+        position among the existing ones, using the values of the sort field
+        (the order of the existing ones is not updated). Collections sorted by
+        many fields or by score cannot be refreshed.
+        Return a tuple with the numbers of removed and added primary keys.
+        """
+        if self._stored_source is None or self._stored_type != 'zset':
+            raise ValueError('Only a collection returned by `store` with `as_zset=True` '
+                             'can be refreshed')
+        sort_options = self._stored_source._sort or {}
+        if self._stored_source._sort_by_sortedset is not None \
+                or isinstance(sort_options.get('by'), list):
+            raise ValueError('A collection sorted by many fields or by score cannot be refreshed')
+        # pattern to get the values the collection is sorted on, None if not sorted
+        sort_pattern = None
+        if self._stored_source._sort is not None and sort_options.get('by') != 'nosort':
+            sort_pattern = sort_options.get('by') or '#'
+
+        new_key = self._unique_key('tmp')
+        try:
+            def refresh(final_set):
+                if final_set is None:
+                    # the collection is now empty
+                    removed = self.connection.zcard(self.stored_key)
+                    self.connection.delete(self.stored_key)
+                    return removed
+                return self.model.database.call_script(
+                    script_dict=self.__class__.scripts['refresh_stored_zset'],
+                    keys=[self.stored_key, final_set, new_key]
+                )
+
+            removed = self._stored_source._call_on_final_set(refresh)
+
+            # sort the new pks like the stored collection
+            added = []
+            if self.connection.exists(new_key):
+                new_pks = self.__class__(self.model)._apply_intersect(new_key)
+                new_pks._sort = deepcopy(self._stored_source._sort)
+                added = list(new_pks)
+                if sort_pattern:
+                    new_values = self.connection.sort(new_key, by='nosort', get=['#', sort_pattern])
+                    new_values = dict(zip(new_values[::2], new_values[1::2]))
+        finally:
+            self.connection.delete(new_key)
+
+        if added:
+            existing = self.connection.zrange(self.stored_key, 0, -1, withscores=True)
+            if sort_pattern and existing:
+                # the values of a sorted set are returned in its order by SORT with BY nosort
+                existing_values = self.connection.sort(self.stored_key, by='nosort', get=sort_pattern)
+                scores = self._get_inserted_scores(
+                    [score for pk, score in existing], existing_values,
+                    [new_values.get(pk) for pk in added], sort_options)
+            else:
+                position = existing[-1][1] if existing else 0
+                scores = [position + index for index in range(1, len(added) + 1)]
+            self.connection.zadd(self.stored_key, dict(zip(added, scores)))
+
+        # reset the cache of the collection
+        self._collection_cache = self._cache_iterator_function = self._len = None
+        self._stored_len = self.connection.zcard(self.stored_key)
+
+        return removed, len(added)
+
+    @staticmethod
+    def _get_inserted_scores(scores, values, new_values, sort_options):
+        """
+        Return the scores to give to new entries, already sorted, with the
+        given `new_values`, to insert them at their position in a sorted set
+        having the given `scores`, with `values` in the same order, sorted as
+        defined by `sort_options` (``desc`` and ``alpha``). Entries with the
+        same value are inserted after the existing ones.
+        """
+        alpha, desc = sort_options.get('alpha'), sort_options.get('desc')
+
+        def as_key(value):
+            # like the SORT command, missing values are 0 or empty strings
+            if alpha:
+                return value or ''
+            return to_number(value) if value is not None else 0
+
+        ascending_keys = [as_key(value) for value in values]
+        if desc:
+            ascending_keys.reverse()
+
+        # the new entries to insert before each existing one (the last list is for the end)
+        slots = [[] for __ in range(len(scores) + 1)]
+        for new_index, value in enumerate(new_values):
+            key = as_key(value)
+            if desc:
+                position = len(scores) - bisect_left(ascending_keys, key)
+            else:
+                position = bisect_right(ascending_keys, key)
+            slots[position].append(new_index)
+
+        new_scores = [None] * len(new_values)
+        for position, new_indexes in enumerate(slots):
+            if not new_indexes:
+                continue
+            previous = scores[position - 1] if position else scores[0] - 1
+            if position == len(scores):
+                step = 1
+            else:
+                step = float(scores[position] - previous) / (len(new_indexes) + 1)
+            for index, new_index in enumerate(new_indexes, 1):
+                new_scores[new_index] = previous + step * index
+        return new_scores
+
     def stored_key_exists(self):
         """
         Check the existence of the stored key (useful if the collection is based
@@ -747,8 +1225,39 @@ class ExtendedCollectionManager(CollectionManager):
         previous "instances" or "values" call)
         """
         self._values = None
+        self._select_related = self._prefetch_related = None
         return super(ExtendedCollectionManager, self)._reset_result_type()
 
+    def instances(self, lazy=False, select_related=None, prefetch_related=None):
+        """
+        Ask the collection to return a list of instances.
+        If lazy is set to True, the instances returned by the
+        collection won't have their primary key checked for existence.
+        `select_related` can be a list of names of foreign keys (related
+        fields holding a single value, like `FKStringField`): their values
+        are retrieved with the primary keys by the sort command, and the
+        existence of all the related instances (and of the instances if not
+        lazy) is checked, and the values of their single value fields read,
+        in one pipeline. The related instances are then attached to the
+        foreign keys, so calling `instance()` on them, and the getters of
+        their single value fields (until updated), does not call redis.
+        `prefetch_related` can be a list of names of M2M fields (like
+        `M2MSetField`): their members, for all the instances, are read in
+        the same pipeline, and their existence checked in another one. The
+        related instances are then attached to the M2M fields, so calling
+        `instances()` on them does not call redis.
+        """
+        clone = super(ExtendedCollectionManager, self).instances(lazy=lazy)
+        if select_related:
+            for name in select_related:
+                clone._get_related_field(name)
+            clone._select_related = list(select_related)
+        if prefetch_related:
+            for name in prefetch_related:
+                clone._get_related_field(name, many=True)
+            clone._prefetch_related = list(prefetch_related)
+        return clone
+
     def _apply_values(self, *fields):
         """
         Ask the collection to return a list of dict of given fields for each
@@ -795,13 +1304,309 @@ class ExtendedCollectionManager(CollectionManager):
     def values_list(self, *fields, **kwargs):
         return self.clone()._apply_values_list(*fields, **kwargs)
 
+    def to_arrays(self, fields=None, dtypes=None, chunk_size=1000):
+        """
+        Return an ordered dict with, for each field name in `fields` (all
+        "simple value" fields if not given, the pk can be asked too), a numpy
+        array holding the values of this field for all the entries of the
+        collection, in order.
+        The collection is stored (see `store`), then read by chunks of
+        `chunk_size` entries with a `sort ... get` command, and each column
+        of a chunk is written into an array allocated once at its final size.
+        By default, arrays hold the strings returned by redis (dtype
+        `object`), but `dtypes` can be a dict with field names as keys and
+        numpy dtypes as values, to convert a whole column of a chunk at once.
+        Missing values are `None` in `object` arrays, `nan` in float ones,
+        an empty string in string ones, and are not allowed for other dtypes.
+        Requires numpy.
+        """
+        if numpy is None:
+            raise ImportError('numpy is needed to call `to_arrays`')
+
+        names = self._coerce_fields_parameters(fields or self._get_simple_fields())['names']
+        if SORTED_SCORE in names:
+            raise ValueError('%s cannot be used in `to_arrays`' % SORTED_SCORE)
+        fields_parameters = self._coerce_fields_parameters(names)
+        keys = fields_parameters['keys']
+        dtypes = dtypes or {}
+
+        stored = self.store(ttl=None)  # deleted below, must not expire during a long export
+        try:
+            length = stored._stored_len
+            arrays = OrderedDict(
+                (name, numpy.empty(length, dtype=dtypes.get(name, object)))
+                for name in names
+            )
+
+            for start in range(0, length, chunk_size):
+                results = self.connection.sort(stored.stored_key, by='nosort',
+                                               start=start, num=chunk_size, get=keys)
+                results = self._resolve_related_values(results, fields_parameters)
+                for position, (name, array) in enumerate(arrays.items()):
+                    column = self._to_column(results[position::len(keys)], array.dtype, name)
+                    array[start:start + len(column)] = column
+        finally:
+            self.connection.delete(stored.stored_key)
+
+        return arrays
+
+    @staticmethod
+    def _to_column(values, dtype, name):
+        """
+        Convert the given values of a column, as returned by redis, to a numpy
+        array of the given dtype, at once for all the values
+        """
+        column = numpy.array(values, dtype=object)
+        if dtype == object:
+            return column
+
+        missing = numpy.equal(column, None)
+        if missing.any():
+            if dtype.kind in 'fc':
+                column[missing] = 'nan'
+            elif dtype.kind in 'SU':
+                column[missing] = ''
+            else:
+                raise ValueError('Some values are missing for %s, it cannot be '
+                                 'converted to %s' % (name, dtype))
+        return column.astype(dtype)
+
+    def to_dataframe(self, fields=None, dtypes=None, chunk_size=1000):
+        """
+        Return a pandas DataFrame with a column for each field name in
+        `fields`, built from the arrays returned by `to_arrays`, called with
+        the same arguments.
+        Requires numpy and pandas.
+        """
+        if pandas is None:
+            raise ImportError('pandas is needed to call `to_dataframe`')
+
+        arrays = self.to_arrays(fields, dtypes, chunk_size)
+        return pandas.DataFrame(arrays, columns=list(arrays))
+
+    def _get_aggregable_field(self, field_name):
+        """
+        Return the field with the given name, if it is a single value field
+        that can be used to count or aggregate values, else raise a ValueError
+        """
+        if self._field_is_pk(field_name) or not self.model.has_field(field_name):
+            raise ValueError("%s is not a valid field to aggregate for %s"
+                             % (field_name, self.model.__name__))
+        field = self.model.get_field(field_name)
+        if not isinstance(field, SingleValueField):
+            raise ValueError("It's not possible to aggregate a MultiValuesField"
+                             " (asked: %s)" % field_name)
+        return field
+
+    def _get_wildcard_parts(self, field):
+        """
+        Return the parts of the sort wildcard of the given field, to be used in
+        lua scripts to get the value of the field for a pk
+        """
+        return self._get_pattern_parts(field.sort_wildcard)
+
+    def _get_lua_pattern_args(self, pattern):
+        """
+        Add the "score" kind for SORTED_SCORE, to get the score of the sorted
+        set used to sort the collection
+        """
+        if pattern == SORTED_SCORE:
+            return ['score', '', '', '']
+        return super(ExtendedCollectionManager, self)._get_lua_pattern_args(pattern)
+
+    def _get_counting_index(self, field):
+        """
+        Return the index of the given field that stores a set of pks for each
+        value, so the values counts can be read from its keys, or ``None``.
+        Only a simple ``EqualIndex`` without prefix, key or transform, being
+        the only index of the field, can be used.
+        """
+        if not field.indexable or len(field._indexes) != 1:
+            return None
+        index = field._indexes[0]
+        if not isinstance(index, EqualIndex) or not index.handle_bulk \
+                or index.prefix or index.key or index.transform:
+            return None
+        return index
+
+    def _get_index_keys_by_value(self, field):
+        """
+        Return a dict with the keys of the counting index of the given field
+        (see ``_get_counting_index``), with the values they are used for as keys.
+        The keys are found by scanning the database, so it depends on the total
+        number of keys, and only sets are kept, as other keys of the model may
+        share the prefix of the index keys.
+        """
+        prefix = self.model.make_key(self.model._name, field.name, '')
+        return {
+            key[len(prefix):]: key
+            for key in self.model.database.scan_keys(prefix + '*', key_type='set')
+        }
+
+    @property
+    def _is_filtered(self):
+        return bool(self._lazy_collection['sets'] or self._lazy_collection['pks']
+                    or self._lazy_collection['intersects'])
+
+    def _count_by_index_keys(self, fields):
+        """
+        Return the number of instances in the collection, and, for each given
+        field, a dict with the number of instances in the collection for each
+        value, using the keys of their counting index (see
+        ``_get_counting_index``).
+        If the collection is not filtered, they are the cardinalities of these
+        keys, else the cardinalities of their intersections with the final set
+        of the collection, computed in one lua script.
+        """
+        keys_by_field = [(field.name, self._get_index_keys_by_value(field)) for field in fields]
+        all_keys = [key for name, keys in keys_by_field for key in keys.values()]
+
+        if not self._is_filtered:
+            with self.connection.pipeline(transaction=False) as pipe:
+                pipe.scard(self.model.get_field('pk').collection_key)
+                for key in all_keys:
+                    pipe.scard(key)
+                counts = pipe.execute()
+        else:
+            def count(final_set):
+                if final_set is None:
+                    return [0] * (len(all_keys) + 1)
+                return self.model.database.call_script(
+                    script_dict=self.__class__.scripts['facets'],
+                    keys=[final_set] + all_keys,
+                )
+            counts = self._call_on_final_set(count)
+
+        total, counts = counts[0], dict(zip(all_keys, counts[1:]))
+        return total, {
+            name: {value: counts[key] for value, key in keys.items() if counts[key]}
+            for name, keys in keys_by_field
+        }
+
+    def facets(self, *field_names):
+        """
+        Return a dict with, for each given field, a dict with the number of
+        instances in the collection for each value of this field. Values not
+        used in the collection are not returned.
+        Fields must be single value fields with a simple ``EqualIndex`` (see
+        ``_get_counting_index``): the counts are the cardinalities of the
+        intersections of the keys of this index with the collection, computed
+        in one lua script (using SINTERCARD if available), without retrieving
+        any pk.
+        """
+        fields = []
+        for field_name in field_names:
+            field = self._get_aggregable_field(field_name)
+            if self._get_counting_index(field) is None:
+                raise ValueError("Field %s must have a simple EqualIndex to be used in facets"
+                                 % field_name)
+            fields.append(field)
+
+        if not fields:
+            return {}
+
+        return self._count_by_index_keys(fields)[1]
+
+    def count_by(self, field_name):
+        """
+        Return a dict with, for each value of the given field (a single value
+        field) in the collection, the number of instances having it. Instances
+        without value are counted with ``None`` as key.
+        If the field has a simple ``EqualIndex``, counts are computed from the
+        keys of this index (like ``facets``), else they are computed in a lua
+        script over the collection, so in both cases, only the counts are
+        returned by redis.
+        """
+        field = self._get_aggregable_field(field_name)
+
+        if self._get_counting_index(field) is not None:
+            total, counts = self._count_by_index_keys([field])
+            counts = counts[field.name]
+            missing = total - sum(counts.values())
+            if missing > 0:
+                counts[None] = missing
+            return counts
+
+        def count_by(final_set):
+            if final_set is None:
+                return {}
+            result = self.model.database.call_script(
+                script_dict=self.__class__.scripts['count_by'],
+                keys=[final_set],
+                args=self._get_wildcard_parts(field)
+            )
+            counts = dict(zip(result[1::2], result[2::2]))
+            if result[0]:
+                counts[None] = result[0]
+            return counts
+
+        return self._call_on_final_set(count_by)
+
+    def aggregate(self, **aggregates):
+        """
+        Compute aggregates of the numeric values of some single value fields
+        for the whole collection, in a lua script, to only get the results from
+        redis. Keyword arguments are the aggregates to compute (``count``,
+        ``sum``, ``min``, ``max`` or ``avg``), with a field name (or a list of
+        field names) as value.
+        Return a dict with "fieldname__aggregate" as keys.
+        Values that are not numbers are ignored (like instances without value).
+        """
+        fields_by_aggregate = {}
+        for aggregate, field_names in aggregates.items():
+            if aggregate not in AGGREGATES:
+                raise ValueError("%s is not a valid aggregate. Valid ones are: %s"
+                                 % (aggregate, ', '.join(AGGREGATES)))
+            if not isinstance(field_names, (list, tuple, set)):
+                field_names = [field_names]
+            fields_by_aggregate[aggregate] = [
+                self._get_aggregable_field(field_name).name
+                for field_name in field_names
+            ]
+
+        field_names = sorted(set(chain(*fields_by_aggregate.values())))
+        if not field_names:
+            return {}
+
+        def aggregate(final_set):
+            if final_set is None:
+                return [('0', '0', '', '')] * len(field_names)
+            args = []
+            for field_name in field_names:
+                args.extend(self._get_wildcard_parts(self.model.get_field(field_name)))
+            result = self.model.database.call_script(
+                script_dict=self.__class__.scripts['aggregate'],
+                keys=[final_set],
+                args=args
+            )
+            return [result[i:i + 4] for i in range(0, len(result), 4)]
+
+        results = {}
+        for field_name, (count, total, minimum, maximum) in zip(field_names, self._call_on_final_set(aggregate)):
+            count, total = int(count), to_number(total)
+            results[field_name] = {
+                'count': count,
+                'sum': total,
+                'min': to_number(minimum) if minimum else None,
+                'max': to_number(maximum) if maximum else None,
+                'avg': float(total) / count if count else None,
+            }
+
+        return {
+            '%s__%s' % (field_name, aggregate): results[field_name][aggregate]
+            for aggregate, field_names in fields_by_aggregate.items()
+            for field_name in field_names
+        }
+
 
 class _StoredCollection(object):
     """
     Simple object to store the key of a stored collection, to be used in
     ExtendedCollectionManager based on a stored collection.
-    The stored key is a list, so it's managed as a ListField (but we only need its key)
+    The stored key is a list (managed as a ListField, but we only need its key),
+    or a sorted set if stored with `as_zset=True`
     """
-    def __init__(self, connection, key):
+    def __init__(self, connection, key, key_type='list'):
         self.connection = connection
         self.key = key
+        self.key_type = key_type
@@ -1,13 +1,25 @@
 # -*- coding:utf-8 -*-
 from __future__ import unicode_literals
+from future.builtins import str
 
+from bisect import bisect
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from zlib import crc32
+import os
 import threading
 
 from redis.client import Pipeline
 from redis.exceptions import WatchError
 
-from limpyd.database import RedisDatabase
-from limpyd.fields import RedisField
+try:
+    from redis.cluster import RedisCluster
+except ImportError:  # redis-py < 4.1
+    RedisCluster = None
+
+from limpyd.database import RedisDatabase, WritesBatch
+from limpyd.exceptions import ImplementationError
+from limpyd.fields import PKField, RedisField
 
 
 class PipelineDatabase(RedisDatabase):
@@ -141,3 +153,299 @@ class _Pipeline(Pipeline):
     def __exit__(self, exc_type, exc_value, traceback):
         self._database._connection = self._original_connection
         super(_Pipeline, self).__exit__(exc_type, exc_value, traceback)
+
+
+class RedisClusterDatabase(RedisDatabase):
+    """
+    A database to use with a redis cluster. The connection settings are the
+    arguments of ``redis.cluster.RedisCluster`` (``host`` and ``port`` of one
+    of the nodes, or ``startup_nodes``...), and no ``db`` can be used.
+    All the keys of a model are in the same slot, thanks to hash tags (see
+    ``RedisModel.get_key_prefix``), so collections, indexes and lua scripts,
+    that use many keys of a model, work as on a single redis server. Models
+    using keys of other ones (via related fields for example) must share the
+    same ``hash_tag`` to be stored in the same slot.
+    Note that redis 7 is needed to sort collections by a field, as before it
+    the patterns of the ``SORT`` command are not allowed on a cluster.
+    Requires redis-py 4.1 or later.
+    """
+
+    hash_tags = True
+    connection_class = RedisCluster
+
+    def __init__(self, *args, **kwargs):
+        if RedisCluster is None:
+            raise ImportError('redis-py >= 4.1 is needed to use `RedisClusterDatabase`')
+        super(RedisClusterDatabase, self).__init__(*args, **kwargs)
+
+    @property
+    def redis_version(self):
+        """Return the lowest redis version of the nodes of the cluster, as a tuple"""
+        if not hasattr(self, '_redis_version'):
+            infos = self.connection.info(target_nodes=RedisCluster.ALL_NODES)
+            self._redis_version = min(
+                tuple(map(int, info['redis_version'].split('.')[:3]))
+                for info in infos.values()
+            )
+        return self._redis_version
+
+    def call_script(self, script_dict, keys=None, args=None):
+        """Call a redis script with keys and args
+
+        As ``EVALSHA`` cannot be used in a pipeline on a cluster, when writes
+        are batched (see ``RedisDatabase.batch_writes``), the whole script is
+        queued with ``EVAL``.
+
+        For the parameters, see ``RedisDatabase.call_script``
+
+        """
+        connection = self.connection
+        if isinstance(connection, WritesBatch):
+            keys, args = list(keys or []), list(args or [])
+            return connection.writes_pipeline.execute_command(
+                'EVAL', script_dict['lua'], len(keys), *(keys + args))
+        return super(RedisClusterDatabase, self).call_script(script_dict, keys, args)
+
+    def scan_keys(self, match=None, count=None, key_type=None):
+        """Iter on all the keys of all the primary nodes matching the given pattern
+
+        For the parameters, see ``RedisDatabase.scan_keys``
+
+        """
+        scan_type = self._get_scan_type(key_type)
+        for key in self.connection.scan_iter(match=match, count=count, _type=scan_type):
+            if key_type and not scan_type and self.connection.type(key) != key_type:
+                continue
+            yield key
+
+
+class ShardedRedisDatabase(RedisDatabase):
+    """
+    A database spreading the instances of its models over many standalone
+    redis servers, the shards, without a redis cluster. The only argument,
+    `shards`, is a list with the connection settings of each shard (the
+    arguments of ``redis.Redis``), and `replicas` is the number of points of
+    each shard on the ring used to find the shard of a pk (consistent hashing,
+    so adding a shard at the end of the list only moves a part of the
+    instances).
+    All the keys of an instance, and its entries in the indexes, are stored
+    on the shard of its pk: each shard has its own indexes, so uniqueness
+    could only be checked in a shard and unique fields or indexes are refused.
+    The counters of the auto-incremented pks are all stored on the first
+    shard, so pks are unique in all the shards.
+    Collections are computed on all the shards in parallel, in threads, then
+    their results merged (see ``CollectionManager._fetch_sharded_collection``).
+    """
+
+    sharded = True
+    replicas = 100
+
+    def __init__(self, shards, replicas=None):
+        if replicas is not None:
+            self.replicas = replicas
+        self._shard_connections = {}  # Instance level cache, by shard
+        self._shard_connections_pid = None  # id of the process that created them
+        self._pool = None  # threads used to run commands on all the shards in parallel
+        self._pool_pid = None
+        super(ShardedRedisDatabase, self).__init__(shards=shards)
+
+    def reset(self, shards):
+        """
+        Set the connection settings of the shards, compute the ring used to
+        find the shard of a pk, and reset the connections caches.
+        The first shard is used when no pk is concerned.
+        The threads used by ``map_shards`` are stopped, as they may not be
+        enough for the new shards.
+        """
+        if not shards:
+            raise ImplementationError('A ShardedRedisDatabase needs at least one shard')
+        self.close_pool()
+        self.shards = [dict(settings) for settings in shards]
+        self.connection_settings = self.shards[0]
+        self._connection = None
+        self._shard_connections = {}
+
+        ring = sorted(
+            (crc32(('%s-%s' % (index, replica)).encode('utf-8')) & 0xffffffff, index)
+            for index in range(len(self.shards))
+            for replica in range(self.replicas)
+        )
+        self._ring_hashes = [point for point, index in ring]
+        self._ring_shards = [index for point, index in ring]
+
+    def _check_model(self, model):
+        """
+        Refuse models with unique fields (other than the pk) or unique
+        indexes, as uniqueness could only be checked in the shard of an
+        instance, not in all the shards.
+        """
+        for field in model.get_fields():
+            if isinstance(field, PKField):
+                continue
+            if field.unique or any(getattr(index, 'unique', False) for index in field._indexes):
+                raise ImplementationError(
+                    'The field %s.%s cannot be unique on a ShardedRedisDatabase, as uniqueness '
+                    'cannot be checked in all the shards' % (model.__name__, field.name))
+
+    def get_shard_index(self, pk):
+        """
+        Return the position, in ``shards``, of the shard holding the instance
+        with the given pk, or of the first one if the pk is None.
+        """
+        if pk is None:
+            return 0
+        point = crc32(str(pk).encode('utf-8')) & 0xffffffff
+        return self._ring_shards[bisect(self._ring_hashes, point) % len(self._ring_shards)]
+
+    def get_shard_connection(self, index):
+        """
+        Return the connection to the shard at the given position, created if
+        needed (a new one in a forked process)
+        """
+        if self._shard_connections_pid != os.getpid():
+            self._shard_connections = {}
+            self._shard_connections_pid = os.getpid()
+        if index not in self._shard_connections:
+            self._shard_connections[index] = self.connect(**self.shards[index])
+        return self._shard_connections[index]
+
+    @contextmanager
+    def using_shard(self, index):
+        """
+        Send all the redis commands of the block, in the current thread, to
+        the shard at the given position
+        """
+        previous = getattr(self._local, 'shard', None)
+        self._local.shard = index
+        try:
+            yield
+        finally:
+            self._local.shard = previous
+
+    @contextmanager
+    def using_shard_of(self, pk):
+        """
+        Send all the redis commands of the block, in the current thread, to
+        the shard of the given pk (see ``get_shard_index``)
+        """
+        with self.using_shard(self.get_shard_index(pk)):
+            yield
+
+    def iter_shards(self):
+        """
+        Yield the position of each shard, one after the other, with all the
+        redis commands of the current thread sent to this shard until the
+        next one is yielded (see ``using_shard``)
+        """
+        for index in range(len(self.shards)):
+            with self.using_shard(index):
+                yield index
+
+    @property
+    def connection(self):
+        """
+        Return the connection to the shard used in the current thread (see
+        ``using_shard``), the first one by default. If writes are batched,
+        the batch of this shard is returned instead.
+        """
+        index = getattr(self._local, 'shard', None) or 0
+        batches = getattr(self._local, 'writes_batches', None)
+        if batches is not None:
+            if index not in batches:
+                batches[index] = WritesBatch(self.get_shard_connection(index),
+                                             transaction=self._local.writes_transaction)
+            return batches[index]
+        return self.get_shard_connection(index)
+
+    @contextmanager
+    def batch_writes(self, transaction=True):
+        """Send all the write commands of a block to redis with one pipeline by shard.
+
+        It works like ``RedisDatabase.batch_writes``, but a batch is created
+        for each shard used in the block. They are executed one after the
+        other when the block is exited, so with ``transaction=True``, writes
+        are only atomic in each shard.
+
+        Yields
+        ------
+        dict
+            The batches (``WritesBatch`` objects), with the positions of their
+            shard as keys
+
+        """
+        batches = getattr(self._local, 'writes_batches', None)
+        if batches is not None:
+            yield batches
+            return
+
+        batches = self._local.writes_batches = {}
+        self._local.writes_transaction = transaction
+        try:
+            yield batches
+        except:
+            for batch in batches.values():
+                batch.writes_pipeline.reset()
+            raise
+        else:
+            for index in sorted(batches):
+                batches[index].execute()
+        finally:
+            self._local.writes_batches = None
+
+    def map_shards(self, func, indexes=None):
+        """
+        Call `func`, without arguments, for each shard (or only for the ones
+        at the given positions), with its commands sent to the shard, and
+        return the list of the results, in the order of the shards.
+        Shards are used in parallel, in threads, except if the current thread
+        already uses a specific shard.
+        """
+        if indexes is None:
+            indexes = list(range(len(self.shards)))
+
+        def call(index):
+            with self.using_shard(index):
+                return func()
+
+        if len(indexes) == 1 or getattr(self._local, 'shard', None) is not None:
+            return [call(index) for index in indexes]
+
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPool(len(self.shards))
+            self._pool_pid = os.getpid()
+        return self._pool.map(call, indexes)
+
+    def close_pool(self):
+        """
+        Stop the threads used by ``map_shards``, waiting for the running calls
+        to finish. They will be started again if needed.
+        """
+        pool, self._pool = self._pool, None
+        if pool is not None and self._pool_pid == os.getpid():
+            # a pool created by a parent process has no threads in this one
+            pool.close()
+            pool.join()
+
+    @property
+    def redis_version(self):
+        """Return the lowest redis version of the shards, as a tuple"""
+        if not hasattr(self, '_redis_version'):
+            self._redis_version = min(
+                tuple(map(int, self.get_shard_connection(index).info()['redis_version'].split('.')[:3]))
+                for index in range(len(self.shards))
+            )
+        return self._redis_version
+
+    def scan_keys(self, match=None, count=None, key_type=None):
+        """Iter on all the keys of all the shards matching the given pattern
+
+        For the parameters, see ``RedisDatabase.scan_keys``
+
+        """
+        scan_type = self._get_scan_type(key_type)
+        for index in range(len(self.shards)):
+            connection = self.get_shard_connection(index)
+            for key in connection.scan_iter(match=match, count=count, _type=scan_type):
+                if key_type and not scan_type and connection.type(key) != key_type:
+                    continue
+                yield key
@@ -0,0 +1,322 @@
+# -*- coding:utf-8 -*-
+"""
+Dump all the instances of a model to a NDJSON or CSV stream, and load them
+back, by chunks, with pipelines, to handle a lot of instances in bounded
+memory.
+
+    >>> with open('boats.ndjson', 'w') as stream:
+    ...     dump(Boat, stream)
+    >>> with open('boats.ndjson') as stream:
+    ...     load(Boat, stream)
+"""
+from __future__ import unicode_literals
+from future.builtins import str
+
+import csv
+import json
+from collections import defaultdict
+
+from limpyd.fields import (InstanceHashField, SetField, ListField, SortedSetField,
+                           HashField, SingleValueField)
+from limpyd.utils import unique_key
+
+__all__ = ['dump', 'load', 'FORMATS']
+
+FORMATS = ('ndjson', 'csv')
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _get_fields(model, field_names=None):
+    """
+    Return the fields of the model (all but the pk), in the order of their
+    declaration, or the ones with the given names
+    """
+    if field_names is None:
+        field_names = [name for name in model._fields if not model._field_is_pk(name)]
+
+    fields = []
+    for name in field_names:
+        if model._field_is_pk(name) or not model.has_field(name):
+            raise ValueError("%s is not a valid field to dump/load for %s" % (name, model.__name__))
+        fields.append(model.get_field(name))
+    return fields
+
+
+def _field_key(model, pk, field):
+    """
+    Return the key of the given field for the instance with the given pk,
+    without creating the instance
+    """
+    if isinstance(field, InstanceHashField):
+        return model.make_key(model._name, pk, 'hash')
+    return model.make_key(model._name, pk, field.name)
+
+
+def _read_chunk(model, pks, fields):
+    """
+    Return a list with, for each given pk, a dict with the values of the given
+    fields, all read in a single pipeline. Sorted sets are dicts with members
+    as keys and scores as values.
+    """
+    hash_fields = [field for field in fields if isinstance(field, InstanceHashField)]
+    other_fields = [field for field in fields if not isinstance(field, InstanceHashField)]
+
+    with model.database.connection.pipeline(transaction=False) as pipe:
+        for pk in pks:
+            if hash_fields:
+                pipe.hmget(_field_key(model, pk, hash_fields[0]),
+                           [field.name for field in hash_fields])
+            for field in other_fields:
+                key = _field_key(model, pk, field)
+                if isinstance(field, SetField):
+                    pipe.smembers(key)
+                elif isinstance(field, ListField):
+                    pipe.lrange(key, 0, -1)
+                elif isinstance(field, SortedSetField):
+                    pipe.zrange(key, 0, -1, withscores=True)
+                elif isinstance(field, HashField):
+                    pipe.hgetall(key)
+                else:
+                    pipe.get(key)
+        results = iter(pipe.execute())
+
+    records = []
+    for pk in pks:
+        values = {}
+        if hash_fields:
+            values.update(zip([field.name for field in hash_fields], next(results)))
+        for field in other_fields:
+            value = next(results)
+            if isinstance(field, SetField):
+                value = sorted(value)
+            elif isinstance(field, SortedSetField):
+                value = dict(value)
+            values[field.name] = value
+        records.append(values)
+    return records
+
+
+def _chunks(iterable, chunk_size):
+    """
+    Yield lists of at most `chunk_size` entries of the given iterable
+    """
+    chunk = []
+    for entry in iterable:
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def dump(model, stream, format='ndjson', fields=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write all the instances of the model in the given text stream, with all
+    the fields (or only the ones in `fields`), and return the number of
+    instances written.
+    Primary keys are read with SSCAN, then values by chunks of `chunk_size`
+    instances, each in a single pipeline.
+    With the "ndjson" format, each instance is a JSON object on its own line,
+    with the field names as keys (the pk first), empty multi-values fields
+    being empty lists/objects (sorted sets are objects with members as keys
+    and scores as values).
+    With the "csv" format, the first row has the field names, and the values
+    of multi-values fields are encoded in JSON. Missing values of simple
+    fields are empty cells.
+    """
+    if format not in FORMATS:
+        raise ValueError("Invalid format %s, must be one of %s" % (format, ', '.join(FORMATS)))
+
+    fields = _get_fields(model, fields)
+    pk_name = model.get_field('pk').name
+    names = [pk_name] + [field.name for field in fields]
+    multi_values = {field.name for field in fields if not isinstance(field, SingleValueField)}
+
+    if format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(names)
+
+    count = 0
+    for __ in model.database.iter_shards():
+        connection = model.get_connection()
+        pks_iterator = connection.sscan_iter(model.get_field('pk').collection_key, count=chunk_size)
+        for pks in _chunks(pks_iterator, chunk_size):
+            for pk, values in zip(pks, _read_chunk(model, pks, fields)):
+                values[pk_name] = pk
+                if format == 'csv':
+                    writer.writerow([
+                        json.dumps(values[name]) if name in multi_values
+                        else ('' if values[name] is None else values[name])
+                        for name in names
+                    ])
+                else:
+                    stream.write(json.dumps(dict((name, values[name]) for name in names)) + '\n')
+            count += len(pks)
+
+    return count
+
+
+def _iter_records(stream, format):
+    """
+    Yield a dict for each instance read from the stream in the given format.
+    Values from csv are decoded in the ``_write_chunk`` function.
+    """
+    if format == 'csv':
+        reader = csv.reader(stream)
+        names = next(reader, None)
+        for row in reader:
+            if row:
+                yield dict(zip(names, row))
+    else:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _write_chunk(model, records, fields_by_name, loaded_key, format):
+    """
+    Write the values of the given records in a single pipeline (one by shard
+    if the database is sharded), and add their pks to the set `loaded_key` (if
+    any), in their shard. Return the pks of the records.
+    """
+    pk_field = model.get_field('pk')
+    pks = []
+
+    with model.database.batch_writes(transaction=False):
+        for record in records:
+            record = dict(record)
+            pk = record.pop(pk_field.name, None)
+            if pk is None or pk == '':
+                raise ValueError('An instance of %s to load has no pk' % model.__name__)
+            pk = pk_field.normalize(pk)
+            pks.append(pk)
+
+            with model.database.using_shard_of(pk):
+                _write_record(model, pk, record, fields_by_name, loaded_key, format)
+
+    return pks
+
+
+def _write_record(model, pk, record, fields_by_name, loaded_key, format):
+    """
+    Queue the writes of the values of the given record, in the current writes
+    batch (see ``_write_chunk``)
+    """
+    connection = model.database.connection
+    pk_field = model.get_field('pk')
+
+    hash_values = {}
+    for name, value in record.items():
+        if name not in fields_by_name:
+            raise ValueError("%s is not a valid field to load for %s" % (name, model.__name__))
+        field = fields_by_name[name]
+        if format == 'csv':
+            if isinstance(field, SingleValueField):
+                value = value if value != '' else None
+            else:
+                value = json.loads(value) if value else None
+        if value is None or value == [] or value == {}:
+            continue
+
+        key = _field_key(model, pk, field)
+        if isinstance(field, InstanceHashField):
+            hash_values[name] = value
+        elif isinstance(field, SetField):
+            connection.sadd(key, *value)
+        elif isinstance(field, ListField):
+            connection.rpush(key, *value)
+        elif isinstance(field, SortedSetField):
+            connection.zadd(key, value)
+        elif isinstance(field, HashField):
+            connection.hmset(key, value)
+        else:
+            connection.set(key, value)
+
+    if hash_values:
+        connection.hmset(model.make_key(model._name, pk, 'hash'), hash_values)
+    connection.sadd(pk_field.collection_key, pk)
+    if loaded_key:
+        connection.sadd(loaded_key, pk)
+
+
+def _index_chunk(model, pks, fields):
+    """
+    Index the values of the given indexable fields for the given pks, read in
+    one pipeline. All the index updates are sent in one pipeline too, with the
+    pks having the same value added at once (see ``BaseIndex.add_many``).
+    Uniqueness is not checked.
+    """
+    records = _read_chunk(model, pks, fields)
+
+    try:
+        with model.database.batch_writes(transaction=False):
+            for field in fields:
+                pks_by_parts = defaultdict(list)
+                for pk, values in zip(pks, records):
+                    value = values[field.name]
+                    if value is None:
+                        continue
+                    if isinstance(field, SortedSetField):
+                        value = list(value)
+                    for parts in field._prepare_index_data(pk, [value] if isinstance(field, SingleValueField) else value):
+                        if parts[-1] is not None:
+                            pks_by_parts[parts].append(pk)
+
+                for index in field._indexes:
+                    for parts, parts_pks in pks_by_parts.items():
+                        index.add_many(parts_pks, *parts, check_uniqueness=False)
+    finally:
+        for field in fields:
+            for pk in pks:
+                field._reset_indexes_rollback_caches(pk)
+
+
+def load(model, stream, format='ndjson', chunk_size=DEFAULT_CHUNK_SIZE, index=True):
+    """
+    Read instances of the model from the given text stream, written by
+    ``dump`` in the same format, and return the number of instances loaded.
+    Instances are written by chunks of `chunk_size`, each in a single
+    pipeline, without updating indexes nor checking uniqueness.
+    If `index` is True (the default), the indexes of all the loaded instances
+    are updated at the end, by chunks too (the pks are kept meanwhile in a
+    temporary redis set, not in memory, in each shard if the database is
+    sharded).
+    The instances must not already exist: their values are not deleted before
+    writing the loaded ones.
+    """
+    if format not in FORMATS:
+        raise ValueError("Invalid format %s, must be one of %s" % (format, ', '.join(FORMATS)))
+
+    fields_by_name = {field.name: field for field in _get_fields(model)}
+    indexable = [field for field in _get_fields(model) if field._indexed]
+    connection = model.get_connection()
+    loaded_key = unique_key(connection, model.make_key(model._name, 'loading')) if indexable and index else None
+
+    count = 0
+    max_pk = 0
+    try:
+        for records in _chunks(_iter_records(stream, format), chunk_size):
+            pks = _write_chunk(model, records, fields_by_name, loaded_key, format)
+            max_pk = max([max_pk] + [int(pk) for pk in pks if pk.isdigit()])
+            count += len(pks)
+
+        # new instances created with an auto-increment pk must not use a loaded one
+        if max_pk and model.get_field('pk')._auto_increment:
+            max_pk_key = model.make_key(model._name, 'max_pk')
+            if int(connection.get(max_pk_key) or 0) < max_pk:
+                connection.set(max_pk_key, max_pk)
+
+        if loaded_key:
+            for __ in model.database.iter_shards():
+                pks_iterator = model.get_connection().sscan_iter(loaded_key, count=chunk_size)
+                for pks in _chunks(pks_iterator, chunk_size):
+                    _index_chunk(model, pks, indexable)
+
+    finally:
+        if loaded_key:
+            for __ in model.database.iter_shards():
+                model.get_connection().delete(loaded_key)
+
+    return count
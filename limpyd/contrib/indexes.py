@@ -389,6 +389,7 @@ class ScoredEqualIndex(EqualIndex):
 
     key = 'equal-scored'
     supported_key_types = {'zset'}
+    handle_bulk = False
 
     score_field = None
     configurable_attrs = EqualIndex.configurable_attrs | {'score_field'}
@@ -614,6 +615,7 @@ class EqualIndexWith(_MultiFieldsIndexMixin, EqualIndex):
     key = 'equal-with'
     handled_suffixes = {None, 'eq', 'in'}
     supported_key_types = {'set', 'zset'}
+    handle_bulk = False
     other_fields = {}
     configurable_attrs = (EqualIndex.configurable_attrs | {'other_fields', 'unique'})
 
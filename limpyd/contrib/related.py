@@ -10,6 +10,7 @@ from copy import copy
 
 from limpyd import model, fields
 from limpyd.exceptions import *
+from limpyd.indexes import EqualIndex
 from limpyd.contrib.collection import ExtendedCollectionManager
 
 # used to validate a related_name
@@ -68,73 +69,298 @@ class RelatedCollection(object):
         filters[self.related_field.name] = self.instance._pk
         return self.related_field._model.collection(**filters)
 
-    def remove_instance(self):
+    def count(self):
+        """
+        Return the number of instances related to the instance. If the related
+        field was declared with `count_related=True`, it's a single HGET on the
+        counters maintained with the index, else the related collection is
+        retrieved to be counted.
+        """
+        if self.related_field.count_related:
+            index = self.related_field.get_index(RelatedCountIndex)
+            return index.get_count(self.instance._pk)
+        return len(self())
+
+    def remove_instance(self, chunk_size=1000):
         """
         Remove the instance from the related fields (delete the field if it's
         a simple one, or remove the instance from the field if it's a set/list/
         sorted_set)
+        The related instances are processed by chunks of `chunk_size`, the
+        related field being locked only while a chunk is processed, so other
+        writes on this field are not blocked during the whole operation.
+        This is repeated until the related collection is empty, to handle
+        instances related meanwhile.
+        """
+        while True:
+            related_pks = list(self())
+            if not related_pks:
+                break
+            removed = 0
+            for start in range(0, len(related_pks), chunk_size):
+                with fields.FieldLock(self.related_field):
+                    removed += self._remove_instance_from_chunk(related_pks[start:start + chunk_size])
+            if not removed:
+                # the related collection only returned stale pks
+                break
+
+    def _remove_instance_from_chunk(self, related_pks):
+        """
+        Remove the instance from the related field of all the given related
+        instances, and return how many were updated. For a simple field, its
+        values are checked in one round trip to only delete the ones still
+        holding the instance. Then all the indexes are updated, for all the
+        related instances at once (see ``BaseIndex.remove_many``), and the
+        values removed, in a single MULTI/EXEC.
+        """
+        field = self.related_field
+        model = field._model
+        pk = self.instance._pk
+        related_fields = [model.lazy_connect(related_pk).get_field(field.name)
+                          for related_pk in related_pks]
+
+        if isinstance(field, fields.SingleValueField):
+            # keep only fields still holding the instance, as the lock was not held
+            # when the related collection was read
+            with model.database.connection.pipeline(transaction=False) as pipe:
+                for related_field in related_fields:
+                    if isinstance(related_field, fields.InstanceHashField):
+                        pipe.hget(related_field.key, related_field.name)
+                    else:
+                        pipe.get(related_field.key)
+                values = pipe.execute()
+            related_fields = [related_field for related_field, value in zip(related_fields, values)
+                              if value == pk]
+
+        if not related_fields:
+            return 0
+
+        related_pks = [related_field._instance._pk for related_field in related_fields]
+        try:
+            with model.database.batch_writes():
+                for parts in field._prepare_index_data(None, [pk]):
+                    for index in field._indexes:
+                        index.remove_many(related_pks, *parts)
+
+                connection = model.get_connection()
+                for related_field in related_fields:
+                    if isinstance(related_field, fields.InstanceHashField):
+                        connection.hdel(related_field.key, related_field.name)
+                    elif isinstance(related_field, fields.ListField):
+                        connection.lrem(related_field.key, 0, pk)
+                    elif isinstance(related_field, fields.MultiValuesField):
+                        getattr(connection, related_field._related_remover)(related_field.key, pk)
+                    else:
+                        connection.delete(related_field.key)
+        finally:
+            for related_pk in related_pks:
+                field._reset_indexes_rollback_caches(related_pk)
+
+        return len(related_fields)
+
+
+class RelatedCollectionDescriptor(object):
+    """
+    Set on a related model for each of its relations, with the related_name
+    as name. The related collection is only created when accessed from an
+    instance, and then saved on it for the next accesses. So creating an
+    instance of a related model doesn't create all its related collections.
+    """
+
+    def __init__(self, related_name):
+        self.related_name = related_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        related_field = instance._get_related_field(self.related_name)
+        if related_field is None:
+            raise AttributeError("%s has no related collection named %s" % (
+                                 owner.__name__, self.related_name))
+        collection = related_field.related_collection_class(instance, related_field)
+        instance.__dict__[self.related_name] = collection
+        return collection
+
+
+class RelatedCountIndex(EqualIndex):
+    """
+    An EqualIndex that also maintains, in a hash with the related pks as keys,
+    the number of instances related to each of them. The counters are updated
+    with the index, in the same lua script, and only when an instance is
+    really added/removed from the index set, so adding twice the same link
+    (or one link many times in a list) counts once.
+    It is used instead of the EqualIndex for related fields declared with
+    `count_related=True`.
+    """
+
+    lua_update_script = {
+        # add (if ARGV[1] is '1') or remove the pks (ARGV[3] and next) from the
+        # index set KEYS[1], then update the counter of the related pk ARGV[2]
+        # in the hash KEYS[2] with the number of pks really added/removed
+        'lua': """
+            local count_key, related_pk = KEYS[2], ARGV[2]
+            local changed
+            if ARGV[1] == '1' then
+                changed = redis.call('sadd', KEYS[1], unpack(ARGV, 3))
+            else
+                changed = -redis.call('srem', KEYS[1], unpack(ARGV, 3))
+            end
+            if changed ~= 0 and redis.call('hincrby', count_key, related_pk, changed) <= 0 then
+                redis.call('hdel', count_key, related_pk)
+            end
+            return changed
+        """
+    }
+
+    def get_count_key(self):
+        """
+        Return the key of the hash holding the counters
+        """
+        return self.field.make_key(self.model._name, '__count__', self.field.name)
+
+    def get_count(self, related_pk):
+        """
+        Return the number of instances related to the given pk
         """
-        with fields.FieldLock(self.related_field):
-            related_pks = self()
-            for pk in related_pks:
+        return int(self.connection.hget(self.get_count_key(), self.normalize_value(related_pk)) or 0)
 
-                # get the real related field
-                related_instance = self.related_field._model(pk)
-                related_field = getattr(related_instance, self.related_field.name)
+    def _update(self, pks, args, add):
+        """
+        Add or remove the pks from the index set for the given "value" (via
+        `args`), and update the counter of this value, in one script call
+        """
+        self.model.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=RelatedCountIndex.lua_update_script,
+            keys=[self.get_storage_key(*args), self.get_count_key()],
+            args=[1 if add else 0, self.normalize_value(list(args)[-1])] + pks,
+        )
+        cache_key = 'indexed_values' if add else 'deindexed_values'
+        for pk in pks:
+            self._get_rollback_cache(pk)[cache_key].add(tuple(args))
 
-                # check if we have a dedicated remove method
-                remover = getattr(related_field, '_related_remover', None)
+    def add(self, pk, *args, **kwargs):
+        """
+        Add the instance to the index and update the counter if it was not
+        already in it. See ``EqualIndex.add``
+        """
+        if self.field.unique and kwargs.get('check_uniqueness', True):
+            self.check_uniqueness(pk, *args)
+        self._update([pk], args, True)
 
-                # then remove the instance from the related field
-                if remover is not None:
-                    # if we have a remover method, it wants the instance as argument
-                    # (the related field may be a set/list/sorted_set)
-                    getattr(related_field, remover)(self.instance._pk)
-                else:
-                    # no remover method, simple delete the field
-                    related_field.delete()
+    def remove(self, pk, *args, **kwargs):
+        """
+        Remove the instance from the index and update the counter if it was
+        in it. See ``EqualIndex.remove``
+        """
+        self._update([pk], args, False)
+
+    def add_many(self, pks, *args, **kwargs):
+        """
+        Add many instances to the index, and update the counter, in one script
+        call. See ``EqualIndex.add_many``
+        """
+        pks = list(pks)
+        if len(pks) < 2 or self.field.unique:
+            return super(RelatedCountIndex, self).add_many(pks, *args, **kwargs)
+        self._update(pks, args, True)
 
+    def remove_many(self, pks, *args, **kwargs):
+        """
+        Remove many instances from the index, and update the counter, in one
+        script call. See ``EqualIndex.remove_many``
+        """
+        pks = list(pks)
+        if len(pks) < 2:
+            return super(RelatedCountIndex, self).remove_many(pks, *args, **kwargs)
+        self._update(pks, args, False)
 
-class RelatedModel(model.RedisModel):
+    def get_all_storage_keys(self):
+        """
+        Return the keys of the index sets and the one of the counters, to
+        remove them all on `clear` in aggressive mode
+        """
+        keys = super(RelatedCountIndex, self).get_all_storage_keys()
+        keys.add(self.get_count_key())
+        return keys
+
+
+class RelatedModelMetaclass(model.MetaRedisModel):
+    """
+    Metaclass for RelatedModel that adds on each new model the descriptors of
+    the related collections for the relations already declared to it (the
+    ones declared later are added when the related fields are attached to
+    their model)
+    """
+
+    def __new__(mcs, name, base, attrs):
+        it = super(RelatedModelMetaclass, mcs).__new__(mcs, name, base, attrs)
+        if not it.abstract:
+            it._add_related_collections()
+        return it
+
+
+class RelatedModel(with_metaclass(RelatedModelMetaclass, model.RedisModel)):
     """
     This subclass of RedisModel handles creation of related collections, and
     propagates to them the deletion of the instance. So it's needed for models
     with related fields to subclass this RelatedModel instead of RedisModel.
+    Related collections are created on first access (see
+    RelatedCollectionDescriptor), not when instances are created.
     """
 
     abstract = True
     collection_manager = ExtendedCollectionManager
 
-    def __init__(self, *args, **kwargs):
+    @classmethod
+    def _get_relations(cls):
         """
-        Create the instance then add all related collections (link between this
-        instance and related fields on other models)
+        Return the relations to the model, as tuples with the name of the
+        model and field on the other side, and the related name
         """
-        super(RelatedModel, self).__init__(*args, **kwargs)
+        return getattr(cls.database, '_relations', {}).get(cls._name.lower(), [])
 
-        # create the related collections
-        self.related_collections = []
-        relations = getattr(self.database, '_relations', {}).get(self._name.lower(), [])
-        for relation in relations:
-            # get the related field
-            model_name, field_name, _ = relation
-            related_model = self.database._models[model_name]
-            related_field = related_model.get_field(field_name)
+    @classmethod
+    def _get_related_field(cls, related_name):
+        """
+        Return the field, on the other side, of the relation with the given
+        related name, or None if there is no such relation
+        """
+        for model_name, field_name, relation_name in cls._get_relations():
+            if relation_name == related_name:
+                return cls.database._models[model_name].get_field(field_name)
+        return None
 
-            # add the collection
-            collection = related_field.related_collection_class(self, related_field)
-            setattr(self, related_field.related_name, collection)
-            self.related_collections.append(related_field.related_name)
+    @classmethod
+    def _add_related_collections(cls):
+        """
+        Add on the model a descriptor for each of its relations that doesn't
+        have one yet, to create the related collections on access
+        """
+        for _, _, related_name in cls._get_relations():
+            if not isinstance(cls.__dict__.get(related_name), RelatedCollectionDescriptor):
+                setattr(cls, related_name, RelatedCollectionDescriptor(related_name))
 
-    def delete(self):
+    @property
+    def related_collections(self):
         """
-        When the instance is deleted, we propagate the deletion to the related
-        collections, which will remove it from the related fields.
+        Return the names of the related collections of the instance
         """
-        for related_collection_name in self.related_collections:
-            related_collection = getattr(self, related_collection_name)
-            related_collection.remove_instance()
-        return super(RelatedModel, self).delete()
+        return [related_name for _, _, related_name in self._get_relations()]
+
+    @classmethod
+    def _delete_instances(cls, instances):
+        """
+        When instances are deleted (via ``delete`` or ``delete`` on a
+        collection), we propagate the deletion to the related collections,
+        which will remove them from the related fields.
+        """
+        for instance in instances:
+            for related_collection_name in instance.related_collections:
+                related_collection = getattr(instance, related_collection_name)
+                related_collection.remove_instance()
+        return super(RelatedModel, cls)._delete_instances(instances)
 
     @classmethod
     def use_database(cls, database):
@@ -179,6 +405,12 @@ class RelatedModel(model.RedisModel):
                 original_database._relations[related_model_name].remove(relation)
                 database._relations.setdefault(related_model_name, []).append(relation)
 
+        # add the related collections of the moved relations on the models of the new database
+        for related_model_name in database._relations:
+            related_model = database._models.get(related_model_name)
+            if isinstance(related_model, RelatedModelMetaclass):
+                related_model._add_related_collections()
+
         return impacted_models
 
 
@@ -215,16 +447,23 @@ class RelatedFieldMixin(with_metaclass(RelatedFieldMetaclass)):
       many values (without any other arguments) in
       "_commands_with_many_values_from_python" (see RelatedFieldMetaclass)
     - management of related parameters: "to" and "related_name"
+    - if "count_related" is True, counters of related instances maintained
+      with the index (see RelatedCountIndex)
     """
 
     _copy_conf = copy(fields.RedisField._copy_conf)
-    _copy_conf['kwargs'] += [('to', 'related_to'), 'related_name']
+    _copy_conf['kwargs'] += [('to', 'related_to'), 'related_name', 'count_related']
 
     _commands_with_single_value_from_python = []
     _commands_with_many_values_from_python = []
 
     related_collection_class = RelatedCollection
 
+    # related instance(s) fetched with the instance holding the field (see the
+    # `select_related` and `prefetch_related` arguments of
+    # `ExtendedCollectionManager.instances`)
+    _related_cache = None
+
     def __init__(self, to, *args, **kwargs):
         """
         Force the field to be indexable and save related arguments.
@@ -235,6 +474,14 @@ class RelatedFieldMixin(with_metaclass(RelatedFieldMetaclass)):
         self.related_to = to
         self.related_name = kwargs.pop('related_name', None)
 
+        self.count_related = kwargs.pop('count_related', False)
+        if self.count_related:
+            # the counting index replaces the default one, as both use the same sets
+            self.index_classes = [RelatedCountIndex] + [
+                index_class for index_class in self.index_classes
+                if index_class not in (EqualIndex, RelatedCountIndex)
+            ]
+
     def _attach_to_model(self, model):
         """
         When we have a model, save the relation in the database, to later create
@@ -264,6 +511,11 @@ class RelatedFieldMixin(with_metaclass(RelatedFieldMetaclass)):
         relation = (self._model._name, self.name, self.related_name)
         self.database._relations[self.related_to].append(relation)
 
+        # and add the related collection on the related model if it already exists
+        related_model = self.database._models.get(self.related_to)
+        if isinstance(related_model, RelatedModelMetaclass):
+            related_model._add_related_collections()
+
     def _assert_relation_does_not_exists(self):
         """
         Check if a relation with the current related_name doesn't already exists
@@ -308,6 +560,15 @@ class RelatedFieldMixin(with_metaclass(RelatedFieldMetaclass)):
 
         return model_name.lower()
 
+    def _call_command(self, name, *args, **kwargs):
+        """
+        Forget the related instance(s) fetched with the instance holding the
+        field if the value of the field is updated.
+        """
+        if name in self.available_modifiers:
+            self._related_cache = None
+        return super(RelatedFieldMixin, self)._call_command(name, *args, **kwargs)
+
     def _get_related_name(self):
         """
         Return the related name to use to access this related field.
@@ -416,10 +677,15 @@ class SimpleValueRelatedFieldMixin(RelatedFieldMixin):
         group.owner.instance()
 
     """
+
     def instance(self, lazy=False):
         """
         Returns the instance of the related object linked by the field.
+        If it was fetched with the instance holding the field, redis is not
+        called.
         """
+        if self._related_cache is not None:
+            return self._related_cache
         model = self.database._models[self.related_to]
         meth = model.lazy_connect if lazy else model
         return meth(self.proxy_get())
@@ -477,6 +743,18 @@ class MultiValuesRelatedFieldMixin(RelatedFieldMixin):
     # calling obj.field.collection() is the same as calling obj.field()
     collection = __call__
 
+    def instances(self, lazy=False):
+        """
+        Return the list of the related instances, in the order of the field,
+        without the ones that don't exist (if not lazy).
+        If they were fetched with the instance holding the field, redis is not
+        called.
+        """
+        if self._related_cache is not None:
+            return list(self._related_cache)
+        model = self.database._models[self.related_to]
+        return list(model.from_pks(self.proxy_get(), lazy=lazy))
+
 
 class M2MSetField(MultiValuesRelatedFieldMixin, fields.SetField):
     """ Related field based on a SetField, acting as a M2M """
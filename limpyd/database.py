@@ -3,10 +3,18 @@ from __future__ import unicode_literals
 from future.builtins import str
 from future.builtins import object
 
+from contextlib import contextmanager
+from functools import wraps
+from itertools import count
+import os
+import threading
+import time
+
 import redis
 
 from limpyd.exceptions import *
 from limpyd.indexes import EqualIndex
+from limpyd.utils import NotProvided
 
 from logging import getLogger
 log = getLogger(__name__)
@@ -18,6 +26,28 @@ DEFAULT_CONNECTION_SETTINGS = dict(
     db=0
 )
 
+# Names of the redis-py methods that only read data. They are always sent directly to redis, even
+# when writes are batched (see ``RedisDatabase.batch_writes``)
+READ_COMMANDS = frozenset({
+    # keys
+    'exists', 'type', 'ttl', 'pttl', 'keys', 'scan', 'scan_iter', 'randomkey', 'dbsize',
+    # strings
+    'get', 'mget', 'getbit', 'getrange', 'strlen', 'bitcount', 'bitpos',
+    # hashes
+    'hget', 'hmget', 'hgetall', 'hkeys', 'hvals', 'hlen', 'hexists', 'hstrlen', 'hscan',
+    'hscan_iter',
+    # sets
+    'smembers', 'sismember', 'scard', 'srandmember', 'sinter', 'sunion', 'sdiff', 'sscan',
+    'sscan_iter',
+    # lists
+    'lindex', 'llen', 'lrange',
+    # sorted sets
+    'zcard', 'zcount', 'zlexcount', 'zrange', 'zrangebyscore', 'zrangebylex', 'zrevrange',
+    'zrevrangebyscore', 'zrevrangebylex', 'zrank', 'zrevrank', 'zscore', 'zscan', 'zscan_iter',
+    # server
+    'info', 'ping', 'time',
+})
+
 
 class RedisDatabase(object):
     """
@@ -28,13 +58,39 @@ class RedisDatabase(object):
     Redis server+database)
     In a database, two models with the same namespace (empty by default) cannot
     have the same name (defined by the class name)
+    If `hash_tags` is True, all the keys of a model start with a hash tag (see
+    `RedisModel.get_key_prefix`), so they can be used together in multi-keys
+    commands and lua scripts on a redis cluster.
+    If `sharded` is True, the instances of the models are spread over many
+    redis servers, depending on their pk (see
+    `limpyd.contrib.database.ShardedRedisDatabase`).
+    `read_replicas` is a list of connection settings of replicas of the redis
+    server, to which the commands only reading data can be sent (see
+    `read_connection`), each one in turn if `read_strategy` is "round-robin"
+    (the default), or to the fastest to answer if "least-latency".
     """
-    _connections = {}  # class level cache
+    _connections = {}  # class level cache, by process id then by client class and settings
+    connection_class = redis.Redis  # class of the clients created by `connect`
 
     default_indexes = [EqualIndex]
+    hash_tags = False
+    sharded = False
 
-    def __init__(self, **connection_settings):
+    READ_STRATEGIES = ('round-robin', 'least-latency')
+    # number of seconds between two measures of the latency of the replicas
+    LATENCY_CHECK_INTERVAL = 10
+
+    def __init__(self, read_replicas=None, read_strategy='round-robin', **connection_settings):
+        if read_strategy not in self.READ_STRATEGIES:
+            raise ImplementationError('Invalid read_strategy %s, must be one of %s' % (
+                read_strategy, ', '.join(self.READ_STRATEGIES)))
         self._connection = None  # Instance level cache
+        self._connection_pid = None  # id of the process that created `_connection`
+        self._local = threading.local()  # to hold the current writes batch of each thread
+        self.read_replicas = [dict(settings) for settings in read_replicas or []]
+        self.read_strategy = read_strategy
+        self._replicas_counter = count()  # to use the replicas in turn
+        self._replicas_latencies = None  # latency of each replica, by process id
         self.reset(**(connection_settings or DEFAULT_CONNECTION_SETTINGS))
         # _models keep an entry for each defined model on this database
         self._models = dict()
@@ -58,17 +114,36 @@ class RedisDatabase(object):
     def connect(self, **settings):
         """
         Connect to redis and cache the new connection
+        The settings are the arguments of ``redis.Redis``, so they can also be
+        used to configure the pool of connections and the sockets, for example
+        with ``max_connections``, ``socket_timeout``, ``socket_connect_timeout``,
+        ``socket_keepalive``, ``socket_keepalive_options``,
+        ``health_check_interval``...
+        The cache is by process: in a forked process, connections created by
+        the parent process are never used, new ones are created.
+        The client is an instance of the ``connection_class`` attribute.
         """
         # compute a unique key for this settings, for caching. Work on the whole
         # dict without directly using known keys to allow the use of unix socket
         # connection or any other (future ?) way to connect to redis
         if not settings:
             settings = self.connection_settings
-        connection_key = ':'.join([str(settings[k]) for k in sorted(settings)])
-        if connection_key not in self._connections:
-            self._connections[connection_key] = redis.Redis(decode_responses=True, **settings)
+        connection_key = (
+            self.connection_class,
+            ':'.join([str(settings[k]) for k in sorted(settings)]),
+        )
+
+        pid = os.getpid()
+        if pid not in self._connections:
+            # first connection in this process: forget the ones of the parent process, if any
+            self._connections.clear()
+            self._connections[pid] = {}
+        connections = self._connections[pid]
+
+        if connection_key not in connections:
+            connections[connection_key] = self.connection_class(decode_responses=True, **settings)
             self.ensure_redis_versions()
-        return self._connections[connection_key]
+        return connections[connection_key]
 
     def reset(self, **connection_settings):
         """
@@ -99,6 +174,13 @@ class RedisDatabase(object):
             )
         return self._models[name]
 
+    def _check_model(self, model):
+        """
+        Called when a model, with its fields, is ready to be used on this
+        database. Raise an ``ImplementationError`` if this database cannot
+        handle it. Nothing is checked by default.
+        """
+
     def _use_for_model(self, model):
         """
         Update the given model to use the current database. Do it also for all
@@ -125,6 +207,7 @@ class RedisDatabase(object):
         models = get_models(model)
         for _model in models:
             if not _model.abstract:
+                self._check_model(_model)
                 self._add_model(_model)
                 del original_database._models[_model._name]
             _model.database = self
@@ -137,11 +220,253 @@ class RedisDatabase(object):
         """
         A simple property on the instance that return the connection stored on
         the class
+        If writes are currently batched in this thread (see ``batch_writes``),
+        the batch is returned instead, and if reads are automatically
+        pipelined (see ``auto_pipeline``), the auto pipeline is returned.
+        In a forked process, a new connection is created.
         """
-        if self._connection is None:
+        batch = getattr(self._local, 'writes_batch', None)
+        if batch is not None:
+            return batch
+        if self._connection is None or self._connection_pid != os.getpid():
             self._connection = self.connect()
+            self._connection_pid = os.getpid()
+        auto_pipeline = getattr(self._local, 'auto_pipeline', None)
+        if auto_pipeline is not None and not isinstance(self._connection, redis.client.Pipeline):
+            return auto_pipeline
         return self._connection
 
+    @contextmanager
+    def batch_writes(self, transaction=True):
+        """Send all the write commands of a block to redis in one pipeline.
+
+        Inside the block, for the current thread only, all commands that write data (including
+        lua scripts) are queued in a pipeline, executed when the block is exited. Commands that
+        only read data (see ``READ_COMMANDS``) are still sent directly to redis so, for example,
+        uniqueness checks of indexes still work.
+        If an exception is raised in the block, nothing is sent to redis.
+        If this method is called while a batch is already running in the thread, the same batch
+        is used and it will be executed by the outer block.
+
+        Collections must not be evaluated in such a block, as they need to read the temporary
+        keys they write.
+
+        Parameters
+        ----------
+        transaction: bool
+            Default to ``True``. If ``True``, the queued commands are wrapped in a MULTI/EXEC
+            block, so applied atomically.
+
+        Yields
+        ------
+        WritesBatch
+            The batch. Once the block exited, its ``results`` attribute holds the list of the
+            results of the queued commands.
+
+        Examples
+        --------
+
+        >>> with database.batch_writes():
+        ...     instance.field1.hset('foo')
+        ...     instance.field2.set('bar')
+
+        """
+        batch = getattr(self._local, 'writes_batch', None)
+        if batch is not None:
+            yield batch
+            return
+
+        batch = self._local.writes_batch = WritesBatch(self.connection, transaction=transaction)
+        try:
+            yield batch
+        except:
+            batch.writes_pipeline.reset()
+            raise
+        else:
+            batch.execute()
+        finally:
+            self._local.writes_batch = None
+
+    @property
+    def read_connection(self):
+        """
+        Return the connection to use for commands only reading data: one of
+        the read replicas if any (see ``read_strategy``), or the main
+        connection. The main connection is always used in a writes batch, in a
+        pipeline, in an auto pipeline, and in a ``read_your_writes`` block
+        (where reads are never queued by an auto pipeline).
+        """
+        connection = self.connection
+        primary_reads = getattr(self._local, 'primary_reads', 0)
+        if primary_reads and isinstance(connection, AutoPipeline):
+            connection.execute()
+            return connection.direct_connection
+        if not self.read_replicas or primary_reads \
+                or isinstance(connection, (WritesBatch, redis.client.Pipeline, AutoPipeline)):
+            return connection
+
+        if self.read_strategy == 'least-latency':
+            latencies = self._get_replicas_latencies()
+            index = latencies.index(min(latencies))
+        else:
+            index = next(self._replicas_counter) % len(self.read_replicas)
+        return self.connect(**self.read_replicas[index])
+
+    def _get_replicas_latencies(self):
+        """
+        Return the time taken by each read replica to answer a ``PING``,
+        measured again every ``LATENCY_CHECK_INTERVAL`` seconds. A replica not
+        answering is never used.
+        """
+        pid, now = os.getpid(), time.time()
+        if self._replicas_latencies is None or self._replicas_latencies[0] != pid \
+                or now - self._replicas_latencies[1] > self.LATENCY_CHECK_INTERVAL:
+            latencies = []
+            for settings in self.read_replicas:
+                start = time.time()
+                try:
+                    self.connect(**settings).ping()
+                except redis.RedisError:
+                    latencies.append(float('inf'))
+                else:
+                    latencies.append(time.time() - start)
+            self._replicas_latencies = (pid, now, latencies)
+        return self._replicas_latencies[2]
+
+    @contextmanager
+    def read_your_writes(self, wait=False, timeout=1000):
+        """Read data from the main redis server, not from replicas, in a block.
+
+        Commands reading data are sent to the read replicas, if any (see
+        ``read_connection``), so the data they return may not include the last
+        writes. This method is used in a ``with`` block, in which data written
+        before, and in the block, is always read.
+        Indexes are always maintained with the data read from the main server.
+        In the block, reads sent to the main server are not queued by an
+        ``auto_pipeline``: their values are returned directly.
+
+        Parameters
+        ----------
+        wait: bool
+            Default to ``False``, to send all the commands of the block to the main server. If
+            ``True``, a ``WAIT`` command is sent first, to wait for all the replicas to receive
+            the writes done before by this thread, and if they do, reads in the block are still
+            sent to the replicas. Writes done in the block may then not be read.
+        timeout: int
+            Default to 1000, the number of milliseconds to wait for the replicas when ``wait``
+            is ``True``. If not all replicas received the writes in time, reads are sent to the
+            main server.
+
+        Examples
+        --------
+
+        >>> instance.field.set('foo')
+        >>> with database.read_your_writes():
+        ...     instance.field.get()
+        'foo'
+
+        """
+        pinned = True
+        if wait and self.read_replicas:
+            connection = self.connection
+            if not isinstance(connection, (WritesBatch, redis.client.Pipeline)):
+                pinned = connection.wait(len(self.read_replicas), timeout) < len(self.read_replicas)
+
+        if pinned:
+            self._local.primary_reads = getattr(self._local, 'primary_reads', 0) + 1
+        try:
+            yield
+        finally:
+            if pinned:
+                self._local.primary_reads -= 1
+
+    @contextmanager
+    def auto_pipeline(self, max_commands=100, max_delay=None):
+        """Pipeline the reads of fields and instances, without changing the code using them.
+
+        Inside the block, for the current thread only, the commands of fields and instances that
+        only read data (``get``, ``hmget``, ``smembers``, ``scard``...) are queued in a pipeline
+        and return a ``LazyResult`` instead of waiting for the answer of redis: its value is in
+        its ``result`` attribute. All the queued commands are sent in one round trip when:
+
+        - the ``result`` of one of them is asked
+        - any other command is sent to redis (writes, collections, locks...), to keep the order
+        - ``max_commands`` commands are queued
+        - a command is queued while the first queued one is older than ``max_delay`` seconds
+        - the block is exited
+
+        So many independent reads done one after the other cost one round trip.
+
+        If this method is called while reads are already pipelined in the thread, the same auto
+        pipeline is used, with its own thresholds.
+
+        Parameters
+        ----------
+        max_commands: int
+            Default to 100. The number of queued commands from which they are sent.
+        max_delay: Optional[float]
+            Default to ``None``. If set, the maximum number of seconds a command can stay in the
+            pipeline, checked each time a command is queued.
+
+        Yields
+        ------
+        AutoPipeline
+            The stand-in for the redis connection. Its ``executions`` attribute holds the number
+            of round trips done to send queued commands.
+
+        Examples
+        --------
+
+        >>> with database.auto_pipeline():
+        ...     names = [boat.name.get() for boat in boats]  # nothing sent to redis yet
+        >>> print([name.result for name in names])  # all the ``GET`` commands were sent at once
+
+        """
+        auto_pipeline = getattr(self._local, 'auto_pipeline', None)
+        if auto_pipeline is not None:
+            yield auto_pipeline
+            return
+
+        connection = self.connection
+        if isinstance(connection, WritesBatch):
+            connection = connection.direct_connection
+        auto_pipeline = self._local.auto_pipeline = AutoPipeline(connection, max_commands, max_delay)
+        try:
+            yield auto_pipeline
+        finally:
+            self._local.auto_pipeline = None
+            auto_pipeline.execute()
+
+    @contextmanager
+    def using_shard_of(self, pk):
+        """Send the redis commands of the block to the shard of the given pk
+
+        There is only one redis server by default, so nothing is done. See
+        ``limpyd.contrib.database.ShardedRedisDatabase.using_shard_of``.
+
+        Parameters
+        ----------
+        pk: Any
+            The pk of the instance for which commands are sent. ``None`` to use
+            the shard holding the data not tied to an instance, as pk counters.
+
+        """
+        yield
+
+    def iter_shards(self):
+        """Yield each shard in turn, with the redis commands sent to it until the next one
+
+        There is only one redis server by default, so it's yielded once and nothing else is
+        done. See ``limpyd.contrib.database.ShardedRedisDatabase.iter_shards``.
+
+        Yields
+        ------
+        int
+            The position of the shard
+
+        """
+        yield 0
+
     @property
     def redis_version(self):
         """Return the redis version as a tuple"""
@@ -180,9 +505,13 @@ class RedisDatabase(object):
             args = []
         if 'script_object' not in script_dict:
             script_dict['script_object'] = self.connection.register_script(script_dict['lua'])
-        return script_dict['script_object'](keys=keys, args=args, client=self.connection)
+        connection = self.connection
+        if isinstance(connection, WritesBatch):
+            # use the real pipeline so redis-py can load the script before executing it
+            connection = connection.writes_pipeline
+        return script_dict['script_object'](keys=keys, args=args, client=connection)
 
-    def scan_keys(self, match=None, count=None):
+    def scan_keys(self, match=None, count=None, key_type=None):
         """Take a pattern expected by the redis `scan` command and iter on all matching keys
 
         Parameters
@@ -191,6 +520,10 @@ class RedisDatabase(object):
             The pattern of keys to look for
         count: int, default to None (redis uses 10)
             Hint for redis about the number of expected result
+        key_type: str, default to None
+            If set, only the keys holding this type of value (``set``, ``zset``...) are
+            returned. They are filtered by redis 6+, or else by a ``TYPE`` command for each
+            key, sent in one pipeline for all the keys of each scan call.
 
         Yields
         -------
@@ -199,13 +532,224 @@ class RedisDatabase(object):
             related to the way the SCAN command works in redis.
 
         """
+        scan_type = self._get_scan_type(key_type)
         cursor = 0
         while True:
-            cursor, keys = self.connection.scan(cursor, match=match, count=count)
+            cursor, keys = self.connection.scan(cursor, match=match, count=count, _type=scan_type)
+            if key_type and not scan_type:
+                keys = self._filter_keys_by_type(self.connection, keys, key_type)
             for key in keys:
                 yield key
             if not cursor:
                 break
 
+    def _get_scan_type(self, key_type):
+        """Return the type to pass to the SCAN command to filter keys by type, if redis
+        supports it (redis 6+), else ``None``"""
+        if key_type and self.redis_version >= (6, 0):
+            return key_type
+        return None
+
+    @staticmethod
+    def _filter_keys_by_type(connection, keys, key_type):
+        """Return the given keys holding a value of type `key_type`, checked in one pipeline"""
+        if not keys:
+            return []
+        with connection.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.type(key)
+            types = pipe.execute()
+        return [key for key, type_ in zip(keys, types) if type_ == key_type]
+
+
+def on_instance_shard(method):
+    """
+    Decorator for the methods of instances and of their fields, to send all
+    the redis commands they run to the shard of the instance, if the database
+    is sharded. The pk of the instance is created if needed.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        instance = getattr(self, '_instance', self)  # _instance if a field, self if an instance
+        # fields not tied to an instance, and deleted instances, have no `_pk`
+        if not self.database.sharded or not hasattr(instance, '_pk'):
+            return method(self, *args, **kwargs)
+        with self.database.using_shard_of(instance.pk.get()):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def on_instances_shards(method):
+    """
+    Decorator for the class methods of models working on a list of instances,
+    the first argument, to call them once for each shard, with the instances
+    stored in this shard, if the database is sharded. Nothing is returned in
+    this case.
+    """
+    @wraps(method)
+    def wrapper(cls, instances, *args, **kwargs):
+        if not cls.database.sharded:
+            return method(cls, instances, *args, **kwargs)
+        by_shard = {}
+        for instance in instances:
+            by_shard.setdefault(cls.database.get_shard_index(instance.pk.get()), []).append(instance)
+        for index, shard_instances in sorted(by_shard.items()):
+            with cls.database.using_shard(index):
+                method(cls, shard_instances, *args, **kwargs)
+    return wrapper
+
+
+class WritesBatch(object):
+    """
+    Stand-in for a redis connection, used by ``RedisDatabase.batch_writes``:
+    commands listed in ``READ_COMMANDS`` are sent directly to redis and all
+    the other ones are queued in a pipeline, to be executed in one round trip.
+    """
+
+    def __init__(self, connection, transaction=True):
+        self.direct_connection = connection
+        self.writes_pipeline = connection.pipeline(transaction=transaction)
+        self.results = None
+        # values of fields queued by limpyd but not yet written, by (key, field name), so that
+        # indexes using many fields read them instead of the ones still in redis
+        self.pending_values = {}
+
+    def __getattr__(self, name):
+        if name in READ_COMMANDS or name in ('register_script', 'pipeline'):
+            return getattr(self.direct_connection, name)
+        if name == 'sort':
+            return self._sort
+        return getattr(self.writes_pipeline, name)
+
+    def _sort(self, *args, **kwargs):
+        """SORT only writes data when the ``store`` argument is used"""
+        connection = self.writes_pipeline if kwargs.get('store') else self.direct_connection
+        return connection.sort(*args, **kwargs)
+
+    def execute(self):
+        """Send all the queued commands to redis and return (and save) their results"""
+        self.results = self.writes_pipeline.execute()
+        return self.results
+
+
+class AutoPipeline(object):
+    """
+    Stand-in for a redis connection, used by ``RedisDatabase.auto_pipeline``:
+    commands passed to ``defer`` are queued in a pipeline and a ``LazyResult``
+    is returned for each of them. Before any other command, sent directly to
+    redis, the queued ones are executed, so the order is kept.
+    """
+
+    def __init__(self, connection, max_commands=100, max_delay=None):
+        self.direct_connection = connection
+        self.max_commands = max_commands
+        self.max_delay = max_delay
+        self.reads_pipeline = connection.pipeline(transaction=False)
+        self.pending = []  # lazy results of the queued commands
+        self.first_queued_at = None
+        self.executions = 0
+
+    def __getattr__(self, name):
+        self.execute()
+        return getattr(self.direct_connection, name)
+
+    def defer(self, name, args=(), kwargs=None, callback=None):
+        """
+        Queue the command `name` and return a ``LazyResult`` for it. If given,
+        `callback` is called with the result to get the value of the lazy result.
+        """
+        if self.pending and self.max_delay is not None \
+                and time.time() - self.first_queued_at >= self.max_delay:
+            self.execute()
+
+        getattr(self.reads_pipeline, name)(*args, **(kwargs or {}))
+        result = LazyResult(self, callback)
+        self.pending.append(result)
+        if len(self.pending) == 1:
+            self.first_queued_at = time.time()
+
+        if len(self.pending) >= self.max_commands:
+            self.execute()
+        return result
+
+    def execute(self):
+        """
+        Send all the queued commands to redis, in one round trip, and set the
+        values of their lazy results
+        """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        self.executions += 1
+        try:
+            results = self.reads_pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            # the lazy results will raise the error too when their result is asked
+            for lazy_result in pending:
+                lazy_result._set_result(e)
+            raise
+        for lazy_result, result in zip(pending, results):
+            lazy_result._set_result(result)
+
+
+class LazyResult(object):
+    """
+    The result of a command queued by ``RedisDatabase.auto_pipeline``. Its
+    value is only available with the ``result`` attribute, that sends the
+    queued commands if needed: it is not a proxy for its value, so testing,
+    comparing, measuring or iterating it raises a ``TypeError``.
+    If the command failed, the error is raised when the result is asked.
+    """
+
+    def __init__(self, auto_pipeline, callback=None):
+        self._auto_pipeline = auto_pipeline
+        self._callback = callback
+        self._value = NotProvided
+
+    def _set_result(self, result):
+        if self._callback is not None and not isinstance(result, Exception):
+            try:
+                result = self._callback(result)
+            except Exception as e:
+                result = e
+        self._value = result
+
+    @property
+    def ready(self):
+        """Tell if the command was sent to redis (``result`` then doesn't send anything)"""
+        return self._value is not NotProvided
+
+    @property
+    def result(self):
+        """Return the result of the command, sending the queued commands if needed"""
+        if self._value is NotProvided:
+            self._auto_pipeline.execute()
+        if isinstance(self._value, Exception):
+            raise self._value
+        return self._value
+
+    def __repr__(self):
+        if self._value is NotProvided:
+            return '<LazyResult (pending)>'
+        return '<LazyResult %r>' % (self._value, )
+
+    def _refuse_value_use(self, *args):
+        raise TypeError('A LazyResult is not its value, use its `result` attribute to get it')
+
+    # using a lazy result as if it were its value would silently give wrong answers
+    __bool__ = __nonzero__ = __eq__ = __ne__ = __len__ = __iter__ = __contains__ = _refuse_value_use
+    __hash__ = object.__hash__
+
+
+def resolve_lazy_result(result):
+    """
+    Return the value of `result` if it is a ``LazyResult``, else `result`
+    itself. Used where limpyd needs the value of a command it ran, even in an
+    auto pipeline.
+    """
+    if isinstance(result, LazyResult):
+        return result.result
+    return result
+
 
 Lock = redis.client.Lock
@@ -11,7 +11,8 @@ from copy import copy
 
 from redis.exceptions import RedisError
 
-from limpyd.database import Lock
+from limpyd.database import (Lock, WritesBatch, AutoPipeline, READ_COMMANDS,
+                             on_instance_shard, resolve_lazy_result)
 from limpyd.utils import cached_property, make_key, normalize, NotProvided
 from limpyd.exceptions import *
 
@@ -120,8 +121,16 @@ class RedisProxyCommand(with_metaclass(MetaRedisProxy)):
         if not name in self.available_commands:
             raise AttributeError("%s is not an available command for %s" %
                                  (name, self.__class__.__name__))
-        attr = getattr(self.connection, "%s" % name)
+        # commands only reading data may be sent to a read replica, or queued in an auto pipeline
+        reading = name in READ_COMMANDS
+        connection = self.database.read_connection if reading else self.connection
         key = self.key
+        if reading and isinstance(connection, AutoPipeline) and not name.endswith('_iter'):
+            def post_command(result):
+                return self.post_command(sender=self, name=name, result=result, args=args, kwargs=kwargs)
+            log.debug(u"Queuing %s with key %s and args %s" % (name, key, args))
+            return connection.defer(name, (key, ) + tuple(args), kwargs, callback=post_command)
+        attr = getattr(connection, "%s" % name)
         log.debug(u"Requesting %s with key %s and args %s" % (name, key, args))
         result = attr(key, *args, **kwargs)
         result = self.post_command(
@@ -174,11 +183,12 @@ class RedisField(RedisProxyCommand):
     _copy_conf = {
         'args': [],
         'kwargs': ['lockable', 'default', 'indexable', 'unique', ('indexes', 'index_classes')],
-        'attrs': ['name', '_instance', '_model']
+        'attrs': ['name', '_instance', '_model', '_view_index_classes']
     }
     _unique_supported = True
     _field_parts = 1
     default_indexes = None
+    _view_index_classes = []  # indexes maintaining the materialized views using the field
 
     available_getters = {'expire', 'expireat', 'pexpire', 'pexpireat', 'ttl', 'pttl', 'persist'}
     available_modifiers = set()
@@ -228,9 +238,18 @@ class RedisField(RedisProxyCommand):
     def proxy_get(self):
         """
         A helper to easily call the proxy_getter of the field
-        """
+        The value is always returned directly, even in an auto pipeline (see
+        ``RedisDatabase.auto_pipeline``), as it is mostly used internally.
+        If writes are batched and a value of the field is waiting to be
+        written by limpyd (``save`` in buffered mode...), it is returned.
+        """
+        connection = self.connection
+        if isinstance(connection, WritesBatch) and connection.pending_values:
+            pending_key = (self.key, self.name)
+            if pending_key in connection.pending_values:
+                return connection.pending_values[pending_key]
         getter = getattr(self, self.proxy_getter)
-        return getter()
+        return resolve_lazy_result(getter())
 
     def proxy_set(self, value):
         """
@@ -245,6 +264,13 @@ class RedisField(RedisProxyCommand):
             result = setter(value)
         return result
 
+    def _pipeline_proxy_get(self, pipeline):
+        """
+        Queue in the given pipeline the command returning what ``proxy_get``
+        would return, to retrieve the values of many fields in one round trip.
+        """
+        return getattr(pipeline, self.proxy_getter)(self.key)
+
     @property
     def key(self):
         """
@@ -328,10 +354,12 @@ class RedisField(RedisProxyCommand):
 
     def make_key(self, *args):
         """
-        Simple shortcut to the make_key global function to create a redis key
-        based on all given arguments.
+        Simple shortcut to the make_key method of the model to create a redis
+        key based on all given arguments.
         """
-        return make_key(*args)
+        if not self._model:
+            return make_key(*args)
+        return self._model.make_key(*args)
 
     def delete(self):
         """
@@ -352,6 +380,7 @@ class RedisField(RedisProxyCommand):
                    kwargs=kwargs
                )
 
+    @on_instance_shard
     def exists(self):
         """
         Call the exists command to check if the redis key exists for the current
@@ -376,8 +405,8 @@ class RedisField(RedisProxyCommand):
         Returns
         -------
         list
-            An empty list if the field is not indexable, else a list of all indexes
-            tied to the field.
+            An empty list if the field is not indexable nor used by a materialized view,
+            else a list of all indexes tied to the field.
             If no indexes where passed when creating the field, the default indexes
             from the field/model/database will be used.
             If still no index classes, it will raise
@@ -392,13 +421,13 @@ class RedisField(RedisProxyCommand):
         if self.attached_to_instance:
             return self._model.get_field(self.name)._indexes
 
-        if not self.indexable:
+        if not self._indexed:
             return []
-        if not self.index_classes:
+        if self.indexable and not self.index_classes:
             raise ImplementationError('%s field is indexable but has no indexes attached' %
                                       self.__class__.__name__)
 
-        return [index_class(field=self) for index_class in self.index_classes]
+        return [index_class(field=self) for index_class in self.index_classes + self._view_index_classes]
 
     def get_index(self, index_class=NotProvided, key=NotProvided, prefix=NotProvided):
         """Get an index matching the given filters.
@@ -474,27 +503,47 @@ class RedisField(RedisProxyCommand):
         except AttributeError:
             return False
 
+    @on_instance_shard
     def _call_command(self, name, *args, **kwargs):
         """
         Add lock management and call parent.
         """
         meth = super(RedisField, self)._call_command
         if self.indexable and name in self.available_modifiers:
-            with FieldLock(self):
-                try:
-                    result = meth(name, *args, **kwargs)
-                except:
-                    if self._instance.connected:
-                        self._rollback_indexes()
-                    raise
-                else:
-                    return result
-                finally:
-                    if self._instance.connected:
-                        self._reset_indexes_rollback_caches(self._instance_pk)
+            # values to deindex must be read from the main server, not from a replica
+            with FieldLock(self), self.database.read_your_writes():
+                return self._call_modifier_with_rollback(meth, name, *args, **kwargs)
+        elif self._indexed and name in self.available_modifiers:
+            # fields only used by materialized views are not locked: their indexes save the
+            # new values in the views, whatever the previous ones
+            return self._call_modifier_with_rollback(meth, name, *args, **kwargs)
         else:
             return meth(name, *args, **kwargs)
 
+    def _call_modifier_with_rollback(self, meth, name, *args, **kwargs):
+        """
+        Call the modifier `name` with `meth`, and rollback the indexes if it fails.
+        """
+        try:
+            result = meth(name, *args, **kwargs)
+        except:
+            if self._instance.connected:
+                self._rollback_indexes()
+            raise
+        else:
+            return result
+        finally:
+            if self._instance.connected:
+                self._reset_indexes_rollback_caches(self._instance_pk)
+
+    @property
+    def _indexed(self):
+        """
+        Tell if the field has indexes to maintain: if it is indexable, or used
+        by a materialized view (see ``limpyd.views.View``).
+        """
+        return self.indexable or bool(self._view_index_classes)
+
     def _rollback_indexes(self):
         """
         Restore the index in its previous status, using deindexed/indexed values
@@ -518,11 +567,12 @@ class RedisField(RedisProxyCommand):
     def _prepare_index_data(self, pk, values=None):
         raise NotImplementedError
 
+    @on_instance_shard
     def _index(self, values, only_index=None):
         """
         Handle field index process.
         """
-        assert self.indexable, "Field not indexable"
+        assert self._indexed, "Field not indexable"
         if only_index:
             indexes = [self.get_index(
                 index_class=only_index.__class__, key=only_index.key, prefix=only_index.prefix
@@ -531,7 +581,8 @@ class RedisField(RedisProxyCommand):
             indexes = self._indexes
 
         pk = self._instance.pk.get()
-        values = self._prepare_index_data(pk, values)
+        with self.database.read_your_writes():
+            values = self._prepare_index_data(pk, values)
 
         for parts in values:
             value = parts[-1]
@@ -549,11 +600,12 @@ class RedisField(RedisProxyCommand):
                         # uniqueness check is done for this value
                         needs_to_check_uniqueness = False
 
+    @on_instance_shard
     def _deindex(self, values, only_index=None):
         """
         Run process of deindexing field value(s).
         """
-        assert self.indexable, "Field not indexable"
+        assert self._indexed, "Field not indexable"
         if only_index:
             indexes = [self.get_index(
                 index_class=only_index.__class__, key=only_index.key, prefix=only_index.prefix
@@ -562,7 +614,8 @@ class RedisField(RedisProxyCommand):
             indexes = self._indexes
 
         pk = self._instance.pk.get()
-        values = self._prepare_index_data(pk, values)
+        with self.database.read_your_writes():
+            values = self._prepare_index_data(pk, values)
 
         for parts in values:
             value = parts[-1]
@@ -597,7 +650,7 @@ class RedisField(RedisProxyCommand):
         >>> MyModel.get_field('myfield').clear_indexes()
 
         """
-        assert self.indexable, "Field not indexable"
+        assert self._indexed, "Field not indexable"
         assert self.attached_to_model, \
             '`rebuild_indexes` can only be called on a field attached to the model'
 
@@ -629,7 +682,7 @@ class RedisField(RedisProxyCommand):
 
 
         """
-        assert self.indexable, "Field not indexable"
+        assert self._indexed, "Field not indexable"
         assert self.attached_to_model, \
             '`rebuild_indexes` can only be called on a field attached to the model'
 
@@ -654,6 +707,7 @@ class RedisField(RedisProxyCommand):
         except (ImplementationError, DoesNotExist):
             return None
 
+    @on_instance_shard
     def check_uniqueness(self, value):
         if not self.unique:
             return
@@ -671,10 +725,10 @@ class RedisField(RedisProxyCommand):
         Shortcut for commands that reset values of the field.
         All will be deindexed and reindexed.
         """
-        if self.indexable:
+        if self._indexed:
             self.deindex()
         result = self._traverse_command(command, *args, **kwargs)
-        if self.indexable:
+        if self._indexed:
             self.index()
         return result
 
@@ -683,10 +737,10 @@ class RedisField(RedisProxyCommand):
         Same as _reset, but uses Redis return value to reindex, to
         save one query.
         """
-        if self.indexable:
+        if self._indexed:
             self.deindex()
         result = self._traverse_command(command, *args, **kwargs)
-        if self.indexable and result is not None:
+        if self._indexed and result is not None:
             self.index(result)
         return result
 
@@ -694,7 +748,7 @@ class RedisField(RedisProxyCommand):
         """
         Shortcut for commands that cannot be executed on indexable fields
         """
-        if self.indexable:
+        if self._indexed:
             raise ImplementationError('Indexable fields cannot be expired')
         return self._traverse_command(command, *args, **kwargs)
     _call_expire = _deny_if_indexable
@@ -707,7 +761,7 @@ class RedisField(RedisProxyCommand):
         Shortcut for commands that remove all values of the field.
         All will be deindexed.
         """
-        if self.indexable:
+        if self._indexed:
             self.deindex()
         return self._traverse_command(command, *args, **kwargs)
     _call_delete = _del
@@ -719,11 +773,37 @@ class SingleValueField(RedisField):
     types handling a single value.
     """
 
+    def _call_command(self, name, *args, **kwargs):
+        """
+        If the instance is in buffered mode, only keep the value passed to the
+        setter on the instance, to be written by ``save``. And return this
+        value when the getter is called.
+        Any other command on a field with a value not yet saved will save the
+        instance first.
+        If the value was prefetched (see ``_prefetched_values`` on the model),
+        it is returned by the getter, until the field is updated.
+        """
+        instance = getattr(self, '_instance', None)
+        prefetched_values = getattr(instance, '_prefetched_values', None)
+        if prefetched_values and self.name in prefetched_values:
+            if name == self.proxy_getter and not args and not kwargs:
+                return prefetched_values[self.name]
+            if name in self.available_modifiers:
+                del prefetched_values[self.name]
+        if instance is not None and instance.buffered and not isinstance(self, PKField):
+            if name == self.proxy_setter and len(args) == 1 and not kwargs:
+                return instance._buffer_value(self, args[0])
+            if self.name in instance._buffered_values:
+                if name == self.proxy_getter and not args and not kwargs:
+                    return instance._get_buffered_value(self)
+                instance.save()
+        return super(SingleValueField, self)._call_command(name, *args, **kwargs)
+
     def _call_set(self, command, value, *args, **kwargs):
         """
         Helper for commands that only set a value to the field.
         """
-        if self.indexable:
+        if self._indexed:
             current = self.proxy_get()
             if normalize(current) != normalize(value):
                 if current is not None:
@@ -773,14 +853,14 @@ class StringField(SingleValueField):
         Index only if value has been set.
         """
         result = self._traverse_command(command, value)
-        if self.indexable and value is not None and result:
+        if self._indexed and value is not None and result:
             self.index(value)
         return result
 
     def _call_set(self, command, value, ex=None, px=None, nx=False, xx=False):
         """Deny expiring args if indexable, and deny other flags"""
 
-        if self.indexable and (ex is not None or px is not None):
+        if self._indexed and (ex is not None or px is not None):
             raise ImplementationError('Indexable fields cannot be expired')
 
         if nx:
@@ -816,7 +896,7 @@ class MultiValuesField(RedisField):
         Shortcut for commands that only add values to the field.
         Added values will be indexed.
         """
-        if self.indexable:
+        if self._indexed:
             self.index(args)
         return self._traverse_command(command, *args, **kwargs)
 
@@ -825,7 +905,7 @@ class MultiValuesField(RedisField):
         Shortcut for commands that only remove values from the field.
         Removed values will be deindexed.
         """
-        if self.indexable:
+        if self._indexed:
             self.deindex(args)
         return self._traverse_command(command, *args, **kwargs)
 
@@ -836,7 +916,7 @@ class MultiValuesField(RedisField):
         The returned value will be deindexed
         """
         result = self._traverse_command(command, *args, **kwargs)
-        if self.indexable:
+        if self._indexed:
             self.deindex([result])
         return result
 
@@ -857,6 +937,7 @@ class MultiValuesField(RedisField):
         """
         self._deindex(values, only_index)
 
+    @on_instance_shard
     def check_uniqueness(self, values):
         if not self.unique:
             return
@@ -910,6 +991,9 @@ class SortedSetField(MultiValuesField):
         """
         return self.zrange(0, -1)
 
+    def _pipeline_proxy_get(self, pipeline):
+        return pipeline.zrange(self.key, 0, -1)
+
     def _call_zadd(self, command, *args, **kwargs):
         """
         Normal redis-py 3+ signature: mapping, nx=False, xx=False, ch=False, incr=False
@@ -922,7 +1006,7 @@ class SortedSetField(MultiValuesField):
         We actually don't support xx, nx and incr options.
         """
         args, kwargs = self.coerce_zadd_args(*args, **kwargs)
-        if self.indexable:
+        if self._indexed:
             mapping = args[0] if args else kwargs['mapping']
             self.index(mapping.keys())
         return self._traverse_command(command, *args, **kwargs)
@@ -932,7 +1016,7 @@ class SortedSetField(MultiValuesField):
         This command update a score of a given value. But it can be a new value
         of the sorted set, so we index it.
         """
-        if self.indexable:
+        if self._indexed:
             self.index([value])
         return self._traverse_command(command, amount, value)
 
@@ -1013,7 +1097,7 @@ class SetField(MultiValuesField):
         if count is not None and self.database.redis_version < (3, 2):
             raise ImplementationError("Count argument to SPOP is invalid for redis-server version < 3.2")
 
-        if count and self.indexable:
+        if count and self._indexed:
             # deindex all returned values (`_pop` assuming only one value)
             result = self._traverse_command(command, count=count)
             self.deindex(result)
@@ -1088,6 +1172,9 @@ class ListField(MultiValuesField):
         """
         return self.lrange(0, -1)
 
+    def _pipeline_proxy_get(self, pipeline):
+        return pipeline.lrange(self.key, 0, -1)
+
     def _call_lrank(self, command, value):
         """
         Addon to redis, to know if a value is in the list without having to retrieve all the list,
@@ -1130,7 +1217,7 @@ class ListField(MultiValuesField):
         existed when the command was called
         """
         result = self._traverse_command(command, *args, **kwargs)
-        if self.indexable and result:
+        if self._indexed and result:
             self.index(args)
         return result
     _call_lpushx = _pushx
@@ -1144,7 +1231,7 @@ class ListField(MultiValuesField):
         deindex/reindex. So do it carefuly.
         """
         if not count:
-            if self.indexable:
+            if self._indexed:
                 self.deindex([value])
             return self._traverse_command(command, count, value, *args, **kwargs)
         else:
@@ -1155,17 +1242,17 @@ class ListField(MultiValuesField):
         Before setting the new value, get the previous one to deindex it. Then
         call the command and index the new value, if exists
         """
-        if self.indexable:
-            old_value = self.lindex(index)
+        if self._indexed:
+            old_value = resolve_lazy_result(self.lindex(index))
             self.deindex([old_value])
         result = self._traverse_command(command, index, value, *args, **kwargs)
-        if self.indexable:
+        if self._indexed:
             self.index([value])
         return result
 
     def _call_linsert(self, command, where, refvalue, value):
         result = self._traverse_command(command, where, refvalue, value)
-        if self.indexable and result != -1:
+        if self._indexed and result != -1:
             self.index([value])
         return result
 
@@ -1192,16 +1279,16 @@ class HashField(MultiValuesField):
     _call_hscan_iter = MultiValuesField._scan
 
     def _call_hmset(self, command, *args, **kwargs):
-        if self.indexable:
+        if self._indexed:
             keys = list(kwargs.keys())
-            current = self.hmget(*keys)
+            current = resolve_lazy_result(self.hmget(*keys))
             self.deindex({key: value for key, value in zip(keys, current) if value is not None})
             self.index(kwargs)
         return self._traverse_command(command, kwargs)
 
     def _call_hset(self, command, key, value):
-        if self.indexable:
-            current = self.hget(key)
+        if self._indexed:
+            current = resolve_lazy_result(self.hget(key))
             if current != value:
                 if current is not None:
                     self.deindex({key: current})
@@ -1210,25 +1297,25 @@ class HashField(MultiValuesField):
         return self._traverse_command(command, key, value)
 
     def _call_hincrby(self, command, key, amount):
-        if self.indexable:
-            current = self.hget(key)
+        if self._indexed:
+            current = resolve_lazy_result(self.hget(key))
             if current is not None:
                 self.deindex({key: current})
         result = self._traverse_command(command, key, amount)
-        if self.indexable:
+        if self._indexed:
             self.index({key: result})
         return result
     _call_hincrbyfloat = _call_hincrby
 
     def _call_hdel(self, command, *args):
-        if self.indexable:
-            current = self.hmget(*args)
+        if self._indexed:
+            current = resolve_lazy_result(self.hmget(*args))
             self.deindex({key: value for key, value in zip(args, current) if value is not None})
         return self._traverse_command(command, *args)
 
     def _call_hsetnx(self, command, key, value):
         result = self._traverse_command(command, key, value)
-        if self.indexable and result:
+        if self._indexed and result:
             # hsetnx returns 1 if key has been set
             self.index({key: value})
         return result
@@ -1259,6 +1346,7 @@ class HashField(MultiValuesField):
         """
         self._deindex(values, only_index)
 
+    @on_instance_shard
     def hexists(self, key):
         """
         Call the hexists command to check if the redis hash key exists for the
@@ -1304,12 +1392,16 @@ class InstanceHashField(SingleValueField):
         args.insert(0, self.name)
         return super(InstanceHashField, self)._traverse_command(name, *args, **kwargs)
 
+    def _pipeline_proxy_get(self, pipeline):
+        return pipeline.hget(self.key, self.name)
+
     def delete(self):
         """
         Delete the field from redis, only the hash entry
         """
         return self._call_command('hdel')
 
+    @on_instance_shard
     def hexists(self):
         """
         Call the hexists command to check if the redis hash key exists for the
@@ -1385,7 +1477,7 @@ class PKField(SingleValueField):
         Property that return the name of the key in Redis where are stored
         all the exinsting pk for the model hosting this PKField
         """
-        return '%s:collection' % self._model._name
+        return self.make_key(self._model._name, 'collection')
 
     def exists(self, value=None):
         """
@@ -1402,12 +1494,16 @@ class PKField(SingleValueField):
             # field doesn't exist anymore) in this specific case
             return False
         else:
-            return self.connection.sismember(self.collection_key, value)
+            with self.database.using_shard_of(value):
+                return self.connection.sismember(self.collection_key, value)
 
     def collection(self):
         """
         Return all available primary keys for the given class
         """
+        if self.database.sharded:
+            return set().union(*self.database.map_shards(
+                lambda: self.connection.smembers(self.collection_key)))
         return self.connection.smembers(self.collection_key)
 
     def set(self, value):
@@ -1432,7 +1528,8 @@ class PKField(SingleValueField):
 
         # We have a new pk, so add it to the collection
         log.debug("Adding %s in %s collection" % (value, self._model.__name__))
-        self.connection.sadd(self.collection_key, value)
+        with self.database.using_shard_of(value):
+            self.connection.sadd(self.collection_key, value)
 
         # Finally return 1 as we did a real redis call to the set command
         return 1
@@ -1474,7 +1571,9 @@ class AutoPKField(PKField):
             raise ValueError('The pk for %s is "auto-increment", you must not fill it' %
                             self._model.__name__)
         key = self._instance.make_key(self._model._name, 'max_pk')
-        return self.normalize(self.connection.incr(key))
+        # on a sharded database, a single counter is used, so pks are unique in all shards
+        with self.database.using_shard_of(None):
+            return self.normalize(self.connection.incr(key))
 
 
 class FieldLock(Lock):
@@ -1496,9 +1595,13 @@ class FieldLock(Lock):
         """
         self.field = field
         self.sub_lock_mode = False
+        connection = field._model.get_connection()
+        if isinstance(connection, WritesBatch):
+            # a lock must never be queued in a batch of writes
+            connection = connection.direct_connection
         super(FieldLock, self).__init__(
-            redis=field._model.get_connection(),
-            name=make_key(field._model._name, 'lock-for-update', field.name),
+            redis=connection,
+            name=field.make_key(field._model._name, 'lock-for-update', field.name),
             timeout=timeout,
             sleep=sleep,
             blocking=blocking,
@@ -10,7 +10,7 @@ from logging import getLogger
 import threading
 
 from limpyd.exceptions import ImplementationError, LimpydException, UniquenessError
-from limpyd.utils import make_key, unique_key
+from limpyd.utils import unique_key
 
 logger = getLogger(__name__)
 
@@ -60,6 +60,9 @@ class BaseIndex(object):
         May include: 'set', 'zset' or 'list'
     filter_single_field : bool
         Tell if the index can be used to filter a field independently than others.
+    handle_bulk : bool
+        Tell if ``add_many`` and ``remove_many`` can store/unstore many pks in one redis
+        call instead of calling ``add``/``remove`` for each one.
 
     Parameters
     -----------
@@ -74,6 +77,7 @@ class BaseIndex(object):
     prefix = None
     transform = None
     filter_single_field = True
+    handle_bulk = False
 
     configurable_attrs = {
         'prefix', 'transform', 'handle_uniqueness', 'key', 'name'
@@ -485,6 +489,56 @@ class BaseIndex(object):
         """
         raise NotImplementedError
 
+    def add_many(self, pks, *args, **kwargs):
+        """Add many instances for the same given "value" (via `args`) to the index
+
+        By default, ``add`` is called for each pk.
+
+        Parameters
+        ----------
+        pks : Iterable
+            The primary keys of the instances we want to add to the index
+        args: tuple
+            All the values to take into account to define the index entry
+        kwargs: dict
+            check_uniqueness: Optional[bool]
+                When ``True`` (the default), if the index is unique, the uniqueness will
+                be checked before indexing
+                If passed, it MUST be passed as a named argument
+
+        Raises
+        ------
+        UniquenessError
+            If `check_uniqueness` is ``True``, the index unique, and the uniqueness not respected,
+            which is always the case if many pks are given.
+
+        """
+        pks = list(pks)
+        if len(set(pks)) > 1 and self.field.unique and kwargs.get('check_uniqueness', True):
+            raise UniquenessError(
+                'Value "%s" cannot be indexed for many instances for %s' % (
+                    list(args)[-1], self.unique_index_name
+                )
+            )
+        for pk in pks:
+            self.add(pk, *args, **kwargs)
+
+    def remove_many(self, pks, *args, **kwargs):
+        """Remove many instances for the same given "value" (via `args`) from the index
+
+        By default, ``remove`` is called for each pk.
+
+        Parameters
+        ----------
+        pks : Iterable
+            The primary keys of the instances we want to remove from the index
+        args: tuple
+            All the values to take into account to define the index entry
+
+        """
+        for pk in pks:
+            self.remove(pk, *args, **kwargs)
+
     def get_all_storage_keys(self):
         """Returns the keys to be removed by `clear` in aggressive mode
 
@@ -596,7 +650,7 @@ class BaseIndex(object):
             prefix_parts.append(prefix)
         return unique_key(
             self.connection,
-            prefix=make_key(*prefix_parts)
+            prefix=self.model.make_key(*prefix_parts)
         )
 
 
@@ -606,6 +660,7 @@ class EqualIndex(BaseIndex):
     handled_suffixes = {None, 'eq', 'in'}
     handle_uniqueness = True
     supported_key_types = {'set'}
+    handle_bulk = True
 
     def union_filtered_in_keys(self, dest_key, *source_keys):
         """Do a union of the given `source_keys` at the redis level, into `dest_key`
@@ -846,6 +901,42 @@ class EqualIndex(BaseIndex):
         if self.unstore(key, pk, **kwargs):
             self._get_rollback_cache(pk)['deindexed_values'].add(tuple(args))
 
+    def add_many(self, pks, *args, **kwargs):
+        """Add many instances for the same given "value" (via `args`) to the index
+
+        All the pks are added to the set of this value in one redis call.
+
+        For the parameters, see ``BaseIndex.add_many``
+
+        """
+        pks = list(pks)
+        if not self.handle_bulk or len(pks) < 2 or self.field.unique:
+            return super(EqualIndex, self).add_many(pks, *args, **kwargs)
+
+        key = self.get_storage_key(*args)
+        logger.debug("adding %s to index %s" % (pks, key))
+        self.connection.sadd(key, *pks)
+        for pk in pks:
+            self._get_rollback_cache(pk)['indexed_values'].add(tuple(args))
+
+    def remove_many(self, pks, *args, **kwargs):
+        """Remove many instances for the same given "value" (via `args`) from the index
+
+        All the pks are removed from the set of this value in one redis call.
+
+        For the parameters, see ``BaseIndex.remove_many``
+
+        """
+        pks = list(pks)
+        if not self.handle_bulk or len(pks) < 2:
+            return super(EqualIndex, self).remove_many(pks, *args, **kwargs)
+
+        key = self.get_storage_key(*args)
+        logger.debug("removing %s from index %s" % (pks, key))
+        self.connection.srem(key, *pks)
+        for pk in pks:
+            self._get_rollback_cache(pk)['deindexed_values'].add(tuple(args))
+
 
 class BaseRangeIndex(BaseIndex):
     """Base of indexes using sorted-set to do range filtering (lt, gte...)"""
@@ -853,6 +944,199 @@ class BaseRangeIndex(BaseIndex):
     handle_uniqueness = True
     lua_filter_script = NotImplemented
     supported_key_types = {'set', 'zset'}
+    walk_mode = NotImplemented
+
+    lua_walk_script = {
+        # we walk the sorted-set KEYS[1] by blocks of 100, from the position following the
+        # cursor (if any), or value by value in `lex` mode, and keep the pks that are in
+        # KEYS[2] (if given), until enough pks are found. For each one, we return the pk and
+        # the score (`score` mode) or the member (`lex` mode), used to make the cursor to
+        # pass to get the pks after it
+        'lua': """
+            local index_key, filter_key = KEYS[1], KEYS[2]
+            local mode, desc = ARGV[1], ARGV[2] == '1'
+            local cursor_value, cursor_pk = ARGV[3], ARGV[4]
+            local skip, num, separator = tonumber(ARGV[5]), tonumber(ARGV[6]), ARGV[7]
+            local block_size = 100
+
+            -- how to check if a pk is in the filter key, depending on its type
+            local is_member = function(pk) return true end
+            if filter_key then
+                local filter_type = redis.call('type', filter_key)['ok']
+                if filter_type == 'set' then
+                    is_member = function(pk) return redis.call('sismember', filter_key, pk) == 1 end
+                elseif filter_type == 'zset' then
+                    is_member = function(pk) return redis.call('zscore', filter_key, pk) ~= false end
+                elseif filter_type == 'list' then
+                    local lookup = {}
+                    for _, pk in ipairs(redis.call('lrange', filter_key, 0, -1)) do
+                        lookup[pk] = true
+                    end
+                    is_member = function(pk) return lookup[pk] == true end
+                else
+                    return {}
+                end
+            end
+
+            local result, found = {}, 0
+            if num == 0 then
+                return result
+            end
+            -- add the pk to the result if it's in the filter key, return true if we have enough
+            local add = function(pk, raw)
+                if is_member(pk) then
+                    if skip > 0 then
+                        skip = skip - 1
+                    else
+                        found = found + 1
+                        result[2*found-1], result[2*found] = pk, raw
+                        return found == num
+                    end
+                end
+                return false
+            end
+
+            if mode == 'lex' then
+                -- members are "value:SEPARATOR:pk", so in the sorted-set a value may come after
+                -- the values starting with it (like "a" after "a-b"), so we cannot simply walk the
+                -- sorted-set: values are walked one by one in the order of SORT ALPHA (a value
+                -- before the ones starting with it), each one found with a few ZRANGEBYLEX, and
+                -- the pks of each value are read in blocks, ordered by pk.
+                local max_char = '\\255'  -- not in utf-8 strings
+                local range = function(min, max, limit, rev)
+                    if rev then
+                        return redis.call('zrevrangebylex', index_key, max, min, 'limit', 0, limit)
+                    end
+                    return redis.call('zrangebylex', index_key, min, max, 'limit', 0, limit)
+                end
+                local split = function(member)
+                    -- split on the last separator to get the value and the pk
+                    local first_pos, last_pos = member:reverse():find(separator:reverse(), 1, true)
+                    return member:sub(1, member:len() - last_pos), member:sub(member:len() - first_pos + 2)
+                end
+                local has_value = function(value)
+                    return range('[' .. value .. separator, '[' .. value .. separator .. max_char, 1)[1] ~= nil
+                end
+                -- first (or last if rev) value in the range with more than `length` characters
+                local longer_value = function(min, max, length, rev)
+                    while true do
+                        local member = range(min, max, 1, rev)[1]
+                        if not member then return nil end
+                        local value = split(member)
+                        if value:len() > length then return value end
+                        -- members of a shorter value sharing the start of the range: skip them
+                        if rev then
+                            max = '(' .. value .. separator
+                        else
+                            min = '(' .. value .. separator .. max_char
+                        end
+                    end
+                end
+                -- first (or last if rev) value starting with the given prefix
+                local first_value = function(prefix, rev)
+                    while rev or not has_value(prefix) do
+                        local value = longer_value('[' .. prefix, '[' .. prefix .. max_char, prefix:len(), rev)
+                        if not value then
+                            return has_value(prefix) and prefix or nil
+                        end
+                        prefix = value:sub(1, prefix:len() + 1)
+                    end
+                    return prefix
+                end
+                -- value following (or preceding if rev) the given one
+                local next_value = function(value, rev)
+                    if not rev then
+                        -- values starting with this one come first
+                        local child = longer_value('[' .. value, '[' .. value .. max_char, value:len())
+                        if child then
+                            return first_value(child:sub(1, value:len() + 1))
+                        end
+                    end
+                    for i = value:len(), 1, -1 do
+                        local parent = value:sub(1, i - 1)
+                        local sibling
+                        if rev then
+                            sibling = longer_value('[' .. parent, '(' .. value:sub(1, i), i - 1, true)
+                        else
+                            sibling = longer_value('(' .. value:sub(1, i) .. max_char, '[' .. parent .. max_char, i - 1)
+                        end
+                        if sibling then
+                            return first_value(sibling:sub(1, i), rev)
+                        end
+                        if rev and has_value(parent) then
+                            return parent
+                        end
+                    end
+                    return nil
+                end
+
+                local value, bound
+                if cursor_value ~= '' then
+                    value, bound = split(cursor_value), '(' .. cursor_value
+                else
+                    value = first_value('', desc)
+                end
+                while value do
+                    local members
+                    if desc then
+                        members = range('[' .. value .. separator, bound or '[' .. value .. separator .. max_char, block_size, true)
+                    else
+                        members = range(bound or '[' .. value .. separator, '[' .. value .. separator .. max_char, block_size)
+                    end
+                    for _, member in ipairs(members) do
+                        local __, pk = split(member)
+                        if add(pk, member) then return result end
+                    end
+                    if #members < block_size then
+                        value, bound = next_value(value, desc), nil
+                    else
+                        bound = '(' .. members[#members]
+                    end
+                end
+                return result
+            end
+
+            -- position of the first entry after the cursor
+            local position = 0
+            if cursor_value ~= '' then
+                local score = redis.call('zscore', index_key, cursor_pk)
+                if score and tonumber(score) == tonumber(cursor_value) then
+                    if desc then
+                        position = redis.call('zrevrank', index_key, cursor_pk) + 1
+                    else
+                        position = redis.call('zrank', index_key, cursor_pk) + 1
+                    end
+                else
+                    -- the pk of the cursor moved: count entries before where it was
+                    local same_score = redis.call('zrangebyscore', index_key, cursor_value, cursor_value)
+                    if desc then
+                        position = redis.call('zcount', index_key, '(' .. cursor_value, '+inf')
+                        for _, pk in ipairs(same_score) do
+                            if pk >= cursor_pk then position = position + 1 end
+                        end
+                    else
+                        position = redis.call('zcount', index_key, '-inf', '(' .. cursor_value)
+                        for _, pk in ipairs(same_score) do
+                            if pk <= cursor_pk then position = position + 1 end
+                        end
+                    end
+                end
+            end
+
+            local command = desc and 'zrevrange' or 'zrange'
+            while true do
+                local members = redis.call(command, index_key, position, position + block_size - 1, 'withscores')
+                if members[1] == nil then -- nothing returned, we are done
+                    break
+                end
+                for i = 1, #members, 2 do
+                    if add(members[i], members[i+1]) then return result end
+                end
+                position = position + block_size
+            end
+            return result
+        """
+    }
 
     def get_storage_key(self, *args):
         """Return the redis key where to store the index for the given "value" (`args`)
@@ -1176,6 +1460,88 @@ class BaseRangeIndex(BaseIndex):
 
         raise NotImplementedError
 
+    def walk(self, filter_key=None, cursor=None, desc=False, start=0, num=-1):
+        """Return pks in the order of the index, only the ones in `filter_key` if given
+
+        The sorted-set of the index is walked by blocks in a lua script, from the position
+        following the given `cursor`, until enough pks are found, so the cost depends on the
+        position of the wanted pks in the index, not on the size of `filter_key`.
+
+        Parameters
+        ----------
+        filter_key: Optional[str]
+            If given, the key of a set, sorted-set or list, to only return pks it contains.
+        cursor: Optional[str]
+            A cursor returned by a previous call, to get the pks following it.
+        desc: bool
+            If ``True``, the index is walked from the highest values to the lowest ones.
+        start: int
+            The number of matching pks to skip.
+        num: int
+            The number of pks to return. ``-1`` (the default) to return all of them.
+
+        Returns
+        -------
+        list
+            A list of tuples with a pk and the opaque cursor to pass to get the pks after it.
+
+        """
+        keys = [self.get_storage_key(None)]
+        if filter_key:
+            keys.append(filter_key)
+
+        cursor_value, cursor_pk = self.parse_walk_cursor(cursor) if cursor else ('', '')
+
+        result = self.model.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=BaseRangeIndex.lua_walk_script,
+            keys=keys,
+            args=[
+                self.walk_mode, 1 if desc else 0, cursor_value, cursor_pk, start, num,
+                getattr(self, 'separator', ''),
+            ]
+        )
+
+        return [
+            (pk, self.make_walk_cursor(pk, raw))
+            for pk, raw in zip(result[::2], result[1::2])
+        ]
+
+    def make_walk_cursor(self, pk, raw):
+        """Return the cursor to use to walk the index after the given pk
+
+        Parameters
+        ----------
+        pk: str
+            The pk returned by the walk lua script
+        raw: str
+            The score or member of the sorted-set, returned by the walk lua script with the pk
+
+        Returns
+        -------
+        str
+            The opaque cursor
+
+        """
+        raise NotImplementedError
+
+    def parse_walk_cursor(self, cursor):
+        """Return the two parts to pass to the walk lua script from the given cursor
+
+        Parameters
+        ----------
+        cursor: str
+            A cursor returned by ``make_walk_cursor``
+
+        Returns
+        -------
+        tuple
+            The value (score or member) and the pk to start after.
+
+        """
+        raise NotImplementedError
+
 
 class TextRangeIndex(BaseRangeIndex):
     """Index allowing to filter on something greater/less than a value
@@ -1191,6 +1557,7 @@ class TextRangeIndex(BaseRangeIndex):
     handled_suffixes = {None, 'eq', 'gt', 'gte', 'lt', 'lte', 'startswith', 'in'}
     key = 'text-range'
     separator = u':%s-SEPARATOR:' % key.upper()
+    walk_mode = 'lex'
 
     lua_filter_script = {
         # we extract members of the sorted-set via zrangebylex
@@ -1370,12 +1737,31 @@ class TextRangeIndex(BaseRangeIndex):
             key, tmp_key, key_type, start, end, exclude, *args
         )
 
+    def make_walk_cursor(self, pk, raw):
+        """Return the cursor to use to walk the index after the given pk
+
+        The cursor is the member of the sorted-set, ie the value and the pk
+
+        For the parameters, see BaseRangeIndex.make_walk_cursor
+
+        """
+        return raw
+
+    def parse_walk_cursor(self, cursor):
+        """Return the two parts to pass to the walk lua script from the given cursor
+
+        For the parameters, see BaseRangeIndex.parse_walk_cursor
+
+        """
+        return cursor, ''
+
 
 class NumberRangeIndex(BaseRangeIndex):
 
     handled_suffixes = {None, 'eq', 'gt', 'gte', 'lt', 'lte', 'in'}
     key = 'number-range'
     raise_if_not_float = False
+    walk_mode = 'score'
 
     lua_filter_script = {
         # we extract members of the sorted-set via zrangebyscore
@@ -1499,6 +1885,25 @@ class NumberRangeIndex(BaseRangeIndex):
         start, end, __ = self.get_boundaries(filter_type, value)  # we have nothing to exclude
         return self.connection.zrangebyscore(key, start, end)
 
+    def make_walk_cursor(self, pk, raw):
+        """Return the cursor to use to walk the index after the given pk
+
+        The cursor is the score and the pk, joined by a ``:``
+
+        For the parameters, see BaseRangeIndex.make_walk_cursor
+
+        """
+        return '%s:%s' % (raw, pk)
+
+    def parse_walk_cursor(self, cursor):
+        """Return the two parts to pass to the walk lua script from the given cursor
+
+        For the parameters, see BaseRangeIndex.parse_walk_cursor
+
+        """
+        score, __, pk = cursor.partition(':')
+        return score, pk
+
 
 class _MultiFieldsIndexMixin(object):
     """Mixin for multi-fields indexing"""
@@ -1,6 +1,7 @@
 # -*- coding:utf-8 -*-
 from __future__ import unicode_literals
 
+from future.builtins import str
 from future.utils import iteritems, iterkeys
 from future.utils import with_metaclass
 
@@ -8,13 +9,16 @@ from collections import defaultdict
 from logging import getLogger
 from copy import copy
 import inspect
+import multiprocessing
 import threading
 
 from limpyd.fields import *
-from limpyd.utils import make_key
+from limpyd.fields import FieldLock, SingleValueField
+from limpyd.utils import make_key, normalize, NotProvided
 from limpyd.exceptions import *
-from limpyd.database import RedisDatabase
+from limpyd.database import RedisDatabase, on_instance_shard, on_instances_shards
 from limpyd.collection import CollectionManager
+from limpyd.views import View
 
 __all__ = ['RedisModel', ]
 
@@ -144,6 +148,23 @@ class MetaRedisModel(MetaRedisProxy):
         if pk_field.name != 'pk':
             it._redis_attr_pk = getattr(it, "_redis_attr_%s" % pk_field.name)
 
+        # Attach the views of the parents to the final model, and add the new ones, which adds
+        # the indexes maintaining them to their fields
+        _views = {}
+        for view in getattr(it, '_views', {}).values():
+            ownview = copy(view)
+            ownview._attach_to_model(it)
+            _views[view.name] = ownview
+        it._views = _views
+        for view in attrs.get('materialized_views') or []:
+            if view.name in _views:
+                raise ImplementationError(
+                    'The view %s is defined many times on %s' % (view.name, name))
+            view = copy(view)
+            view._attach_to_model(it)
+            _views[view.name] = view
+            view._add_indexes()
+
         # Tell index classes that fields are now ready
         for field in it.get_fields():
             if field is it._redis_attr_pk:
@@ -157,6 +178,9 @@ class MetaRedisModel(MetaRedisProxy):
             for index in field._indexes if not index.filter_single_field
         ]
 
+        if not it.abstract:
+            it.database._check_model(it)
+
         return it
 
 
@@ -167,10 +191,12 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
 
     namespace = None  # all models in an app may have the same namespace
     lockable = True
+    buffered = False  # if True, values of single value fields are only written on `save`
     abstract = True
     collection_manager = CollectionManager
     DoesNotExist = DoesNotExist
     default_indexes = None
+    hash_tag = None  # if set, used in the hash tag of the keys (see `make_key`)
 
     available_getters = {'hmget', 'hgetall', 'hkeys', 'hvals', 'hlen', }
     available_modifiers = {'hmset', 'hdel', }
@@ -187,6 +213,14 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         """
         self.lockable = self.__class__.lockable
 
+        # in buffered mode, values set to single value fields are kept here until `save` is called
+        self.buffered = self.__class__.buffered
+        self._buffered_values = {}
+
+        # values of single value fields read in advance (see ``select_related`` on extended
+        # collections), returned by their getter until the field is updated
+        self._prefetched_values = {}
+
         # set to True when the instance's PK will be tested for existence in redis
         self._connected = False
 
@@ -271,6 +305,9 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
                     if field.name not in kwargs or self._field_is_pk(field.name):
                         continue
                     field.proxy_set(kwargs[field.name])
+                if self.buffered:
+                    # write all the buffered values (including defaults) at once
+                    self.save()
             except UniquenessError:
                 # may be raised if things were added in the meantime. TODO: add lock at model level to avoid this ?
                 self.delete()
@@ -408,6 +445,17 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         collection = manager(cls)
         return collection(**filters)
 
+    @classmethod
+    def get_view(cls, name):
+        """
+        Return the materialized view (see ``limpyd.views.View``) with the given
+        name, declared in the ``materialized_views`` attribute of the model or its parents.
+        """
+        try:
+            return cls._views[name]
+        except KeyError:
+            raise ValueError("%s has no view named %s" % (cls.__name__, name))
+
     @classmethod
     def instances(cls, lazy=False, **filters):
         # FIXME Keep as shortcut or remove for clearer API?
@@ -513,8 +561,29 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
 
     @classmethod
     def make_key(cls, *args):
+        """
+        Create a redis key with all the given arguments. If the database uses
+        hash tags (see `RedisDatabase.hash_tags`), and the first argument is the
+        name of the model, it is replaced by the key prefix of the model (see
+        `get_key_prefix`)
+        """
+        if args and cls.database.hash_tags and args[0] == cls._name:
+            args = (cls.get_key_prefix(), ) + args[1:]
         return make_key(*args)
 
+    @classmethod
+    def get_key_prefix(cls):
+        """
+        Return the prefix of all the keys of the model when the database uses
+        hash tags: the name of the model as a hash tag, so all its keys are in
+        the same slot of a redis cluster, or, if the `hash_tag` attribute of the
+        model is set, this attribute as a hash tag followed by the name of the
+        model, so all the models with the same `hash_tag` share the same slot.
+        """
+        if cls.hash_tag:
+            return '{%s}%s' % (cls.hash_tag, cls._name)
+        return '{%s}' % cls._name
+
     # --- Hash management
     @property
     def key(self):
@@ -545,6 +614,7 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
 
         return self._call_command('hmget', args)
 
+    @on_instance_shard
     def hmset(self, **kwargs):
         """
         This command on the model allow setting many instancehash fields with only
@@ -554,6 +624,11 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         if kwargs and not any(kwarg in self._instancehash_fields for kwarg in iterkeys(kwargs)):
             raise ValueError("Only InstanceHashField can be used here.")
 
+        if self.buffered:
+            for field_name, value in iteritems(kwargs):
+                self._buffer_value(self.get_field(field_name), value)
+            return None
+
         indexed = []
 
         # main try block to revert indexes if something fail
@@ -562,7 +637,7 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
             # Set indexes for indexable fields.
             for field_name, value in iteritems(kwargs):
                 field = self.get_field(field_name)
-                if field.indexable:
+                if field._indexed:
                     indexed.append(field)
                     field.deindex()
                     field.index(value)
@@ -583,6 +658,7 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
             for field in indexed:
                 field._reset_indexes_rollback_caches(self.pk.get())
 
+    @on_instance_shard
     def hdel(self, *args):
         """
         This command on the model allow deleting many instancehash fields with
@@ -591,28 +667,302 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
         if args and not any(arg in self._instancehash_fields for arg in args):
             raise ValueError("Only InstanceHashField can be used here.")
 
+        if self._buffered_values:
+            self.save()
+
         # Set indexes for indexable fields.
         for field_name in args:
             field = self.get_field(field_name)
-            if field.indexable:
+            if field._indexed:
                 field.deindex()
 
         # Return the number of fields really deleted
         return self._call_command('hdel', *args)
 
+    @on_instance_shard
+    def _call_command(self, name, *args, **kwargs):
+        """
+        Save the values not yet written in buffered mode before running any
+        command at the model level, and forget the prefetched values if the
+        command updates fields.
+        """
+        if self._buffered_values:
+            self.save()
+        if name in self.available_modifiers:
+            self._prefetched_values = {}
+        return super(RedisModel, self)._call_command(name, *args, **kwargs)
+
+    def _buffer_value(self, field, value):
+        """
+        Keep the value to set to the given field until ``save`` is called.
+        The pk is created if needed (the default values will then be buffered
+        too), and the instance is connected.
+        """
+        if self._pk and not self.connected:
+            self.connect()
+        self._prefetched_values.pop(field.name, None)
+        self.pk.get()  # create the pk if needed
+        self._buffered_values[field.name] = value
+
+    def _get_buffered_value(self, field):
+        """
+        Return the value not yet saved for the given field, as redis would
+        return it once saved.
+        """
+        value = normalize(self._buffered_values[field.name])
+        if value is not None and not isinstance(value, str):
+            value = str(value)
+        return value
+
+    @property
+    def dirty_fields(self):
+        """
+        Return the names of the fields with a value not yet saved
+        """
+        return set(self._buffered_values)
+
+    @on_instance_shard
+    def save(self):
+        """
+        Write all the values that were set on single value fields in buffered
+        mode. It costs one round trip to redis if no field is indexed. For
+        indexed fields, each one is locked, the current values are retrieved
+        in one round trip, then all the index updates and values are written
+        in a single MULTI/EXEC.
+        Return ``False`` if there was nothing to save, else ``True``.
+        """
+        if not self._buffered_values:
+            return False
+
+        if self._pk and not self.connected:
+            self.connect()
+        pk = self.pk.get()
+
+        values = self._buffered_values
+        fields = [self.get_field(name) for name in self._fields if name in values]
+        indexed = [field for field in fields if field._indexed]
+
+        locks = []
+        try:
+            for field in indexed:
+                if not field.indexable:
+                    continue  # only used by views, see RedisField._call_command
+                lock = FieldLock(field)
+                lock.acquire()
+                locks.append(lock)
+
+            current_values = self._get_saved_values([self], [field.name for field in indexed])[0]
+
+            with self.database.batch_writes():
+                for field in indexed:
+                    current, value = current_values[field.name], values[field.name]
+                    if normalize(current) != normalize(value):
+                        if current is not None:
+                            field.deindex(current)
+                        # indexes using many fields must see the new value, not yet written
+                        # (the connection is the batch, of the shard of the instance if sharded)
+                        field.connection.pending_values[(field.key, field.name)] = value
+                        if value is not None:
+                            field.index(value)
+
+                hash_values = {
+                    field.name: values[field.name]
+                    for field in fields if isinstance(field, InstanceHashField)
+                }
+                if hash_values:
+                    self.connection.hmset(self.key, hash_values)
+                for field in fields:
+                    if not isinstance(field, InstanceHashField):
+                        self.connection.set(field.key, values[field.name])
+
+        finally:
+            for field in indexed:
+                field._reset_indexes_rollback_caches(pk)
+            for lock in reversed(locks):
+                lock.release()
+
+        self._buffered_values = {}
+        return True
+
+    @classmethod
+    def _get_saved_values(cls, instances, field_names):
+        """
+        Return, for each given instance, a dict with the values currently saved
+        in redis for the given fields, all retrieved in one round trip.
+        """
+        if not field_names:
+            return [{} for instance in instances]
+
+        with cls.database.connection.pipeline(transaction=False) as pipe:
+            for instance in instances:
+                for name in field_names:
+                    instance.get_field(name)._pipeline_proxy_get(pipe)
+            results = iter(pipe.execute())
+
+        return [
+            {name: next(results) for name in field_names}
+            for instance in instances
+        ]
+
     def delete(self):
         """
         Delete the instance from redis storage.
         """
-        # Delete each field
-        for field in self.fields:
-            if not isinstance(field, PKField):
-                # pk has no stored key
-                field.delete()
-        # Remove the pk from the model collection
-        self.connection.srem(self.get_field('pk').collection_key, self._pk)
-        # Deactivate the instance
-        delattr(self, "_pk")
+        if self._pk and not self.connected:
+            self.connect()
+        self.pk.get()
+        self._delete_instances([self])
+
+    @classmethod
+    @on_instances_shards
+    def _delete_instances(cls, instances):
+        """
+        Delete the given instances from redis storage. The indexed fields are
+        locked, the values to deindex are retrieved in one round trip, then the
+        indexes are updated and all the keys deleted in a single MULTI/EXEC.
+        """
+        if not instances:
+            return
+
+        for instance in instances:
+            # Values not yet saved are lost
+            instance._buffered_values = {}
+
+        indexed = [
+            field for field in instances[0].fields
+            if field._indexed and not isinstance(field, PKField)
+        ]
+        pks = [instance.pk.get() for instance in instances]
+
+        locks = []
+        try:
+            for field in indexed:
+                if not field.indexable:
+                    continue  # only used by views, see RedisField._call_command
+                lock = FieldLock(field)
+                lock.acquire()
+                locks.append(lock)
+
+            saved_values = cls._get_saved_values(instances, [field.name for field in indexed])
+
+            with cls.database.batch_writes():
+                keys = []
+                for instance, values in zip(instances, saved_values):
+                    for field in instance.fields:
+                        if isinstance(field, PKField):
+                            # pk has no stored key
+                            continue
+                        if field._indexed:
+                            value = values[field.name]
+                            if value is not None:
+                                field.deindex(value)
+                        keys.append(field.key)
+                if keys:
+                    cls.get_connection().delete(*set(keys))
+                # Remove the pks from the model collection
+                cls.get_connection().srem(cls.get_field('pk').collection_key, *pks)
+
+        finally:
+            for instance, pk in zip(instances, pks):
+                for field in indexed:
+                    instance.get_field(field.name)._reset_indexes_rollback_caches(pk)
+            for lock in reversed(locks):
+                lock.release()
+
+        # Deactivate the instances
+        for instance in instances:
+            delattr(instance, "_pk")
+
+    @classmethod
+    @on_instances_shards
+    def _update_instances(cls, instances, values):
+        """
+        Set the given values (a dict with names of single value fields as keys)
+        on all the given instances. The indexed fields are locked, their current
+        values retrieved in one round trip, then the updates of the indexes,
+        done for all the instances sharing the same old value at once (see
+        ``BaseIndex.add_many``), and the writes of the values, are done in a
+        single MULTI/EXEC.
+        """
+        for field_name in values:
+            field = cls.get_field(field_name)
+            if not isinstance(field, SingleValueField) or isinstance(field, PKField):
+                raise ValueError("Only StringField and InstanceHashField can be updated.")
+
+        if not instances or not values:
+            return
+
+        fields = [instances[0].get_field(name) for name in cls._fields if name in values]
+        indexed = [field for field in fields if field._indexed]
+        pks = [instance.pk.get() for instance in instances]
+
+        locks = []
+        try:
+            for field in indexed:
+                if not field.indexable:
+                    continue  # only used by views, see RedisField._call_command
+                lock = FieldLock(field)
+                lock.acquire()
+                locks.append(lock)
+
+            saved_values = cls._get_saved_values(instances, [field.name for field in indexed])
+
+            with cls.database.batch_writes():
+                for field in indexed:
+                    value = values[field.name]
+
+                    # group the pks to move by their current value
+                    moved_pks = defaultdict(list)
+                    moved_instances = []
+                    for instance, pk, saved in zip(instances, pks, saved_values):
+                        if normalize(saved[field.name]) != normalize(value):
+                            moved_pks[saved[field.name]].append(pk)
+                            moved_instances.append(instance)
+                    if not moved_pks:
+                        continue
+
+                    for index in field._indexes:
+                        for current, current_pks in iteritems(moved_pks):
+                            if current is not None:
+                                index.remove_many(current_pks, current)
+
+                    # indexes using many fields must see the new value, not yet written
+                    # (the connection is the batch, of the shard of the instances if sharded)
+                    for instance in moved_instances:
+                        instance_field = instance.get_field(field.name)
+                        instance_field.connection.pending_values[(instance_field.key, field.name)] = value
+
+                    if value is not None:
+                        changed_pks = [pk for current_pks in moved_pks.values() for pk in current_pks]
+                        needs_to_check_uniqueness = bool(field.unique)
+                        for index in field._indexes:
+                            index.add_many(
+                                changed_pks,
+                                value,
+                                check_uniqueness=needs_to_check_uniqueness and index.handle_uniqueness
+                            )
+                            if needs_to_check_uniqueness and index.handle_uniqueness:
+                                # uniqueness check is done for this value
+                                needs_to_check_uniqueness = False
+
+                hash_values = {
+                    field.name: values[field.name]
+                    for field in fields if isinstance(field, InstanceHashField)
+                }
+                connection = cls.get_connection()
+                for instance in instances:
+                    if hash_values:
+                        connection.hmset(instance.key, hash_values)
+                    for field in fields:
+                        if not isinstance(field, InstanceHashField):
+                            connection.set(instance.get_field(field.name).key, values[field.name])
+
+        finally:
+            for instance, pk in zip(instances, pks):
+                for field in indexed:
+                    instance.get_field(field.name)._reset_indexes_rollback_caches(pk)
+            for lock in reversed(locks):
+                lock.release()
 
     @classmethod
     def _thread_lock_storage(cls):
@@ -689,6 +1039,91 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
 
         return cls.database.scan_keys(pattern, count)
 
+    @classmethod
+    def _iter_partitions(cls, chunk_size):
+        """Yield the partitions of the primary keys of the model to pass to ``map_reduce`` workers
+
+        For a model with an ``AutoPKField``, partitions are ranges of ``chunk_size`` primary keys,
+        up to the last one created, without reading the collection: each worker will check which
+        ones exist. For other models, or if the database is sharded, the collection is read with
+        ``SSCAN`` (on each shard) and partitions are lists of ``chunk_size`` existing primary keys.
+
+        """
+        if cls.get_field('pk')._auto_increment and not cls.database.sharded:
+            max_pk = int(cls.get_connection().get(cls.make_key(cls._name, 'max_pk')) or 0)
+            for start in range(1, max_pk + 1, chunk_size):
+                yield 'range', (start, min(start + chunk_size, max_pk + 1))
+            return
+
+        for __ in cls.database.iter_shards():
+            pks = []
+            for pk in cls.get_connection().sscan_iter(cls.get_field('pk').collection_key, count=chunk_size):
+                pks.append(pk)
+                if len(pks) >= chunk_size:
+                    yield 'pks', pks
+                    pks = []
+            if pks:
+                yield 'pks', pks
+
+    @classmethod
+    def map_reduce(cls, mapper, reducer=None, initial=NotProvided, processes=None, chunk_size=1000):
+        """Call ``mapper`` on all the primary keys of the model, by chunks, in a pool of processes
+
+        Parameters
+        ----------
+        mapper: callable
+            Called in a worker process with a list of at most ``chunk_size`` primary keys of
+            existing instances (never empty). Must be picklable, ie defined at the module level.
+            Each worker process has its own connections to redis (see ``RedisDatabase.connect``).
+        reducer: Optional[callable]
+            If set, called in the current process with the accumulated result and the result of
+            a call to ``mapper``, to return the new accumulated result, like ``functools.reduce``.
+            Results are passed in the order the workers finished their job.
+        initial: Any
+            The initial accumulated result passed to ``reducer``. If not set, the first result
+            of ``mapper`` is used. If there is no instance, ``None`` is returned.
+        processes: Optional[int]
+            The number of worker processes. Default to the number of CPUs.
+        chunk_size: int
+            Default to 1000, the number of primary keys in each partition.
+
+        Returns
+        -------
+        Any
+            The result of the last call to ``reducer``, or, without ``reducer``, a list with the
+            results of all the calls to ``mapper``.
+
+        Examples
+        --------
+
+        >>> def count_long_names(pks):
+        ...     return sum(len(person.name.get()) > 20 for person in Person.from_pks(pks))
+        >>> Person.map_reduce(count_long_names, operator.add)
+        12
+
+        """
+        results = []
+        accumulated = initial
+        pool = multiprocessing.Pool(processes)
+        try:
+            tasks = ((cls, mapper, kind, partition) for kind, partition in cls._iter_partitions(chunk_size))
+            for has_result, result in pool.imap_unordered(_map_partition, tasks):
+                if not has_result:
+                    continue
+                if reducer is None:
+                    results.append(result)
+                elif accumulated is NotProvided:
+                    accumulated = result
+                else:
+                    accumulated = reducer(accumulated, result)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if reducer is None:
+            return results
+        return None if accumulated is NotProvided else accumulated
+
     def __hash_key(self):
         """Elements used in __hash__ and __eq__ of an instance"""
         return self.__class__, self.pk.get()
@@ -704,3 +1139,24 @@ class RedisModel(with_metaclass(MetaRedisModel, RedisProxyCommand)):
 
     def __repr__(self):
         return u'%s (pk=%s)>' % (super(RedisModel, self).__repr__()[:-2], self.pk.get())
+
+
+def _map_partition(task):
+    """
+    Run in a worker process of ``RedisModel.map_reduce``: get the existing
+    primary keys of the partition, and call the mapper with them.
+    Return a tuple with a flag telling if the mapper was called, and its result.
+    """
+    model, mapper, kind, partition = task
+    if kind == 'range':
+        candidates = [str(pk) for pk in range(*partition)]
+        with model.get_connection().pipeline(transaction=False) as pipe:
+            for pk in candidates:
+                pipe.sismember(model.get_field('pk').collection_key, pk)
+            pks = [pk for pk, exists in zip(candidates, pipe.execute()) if exists]
+    else:
+        pks = partition
+
+    if not pks:
+        return False, None
+    return True, mapper(pks)
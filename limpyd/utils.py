@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 from future.builtins import str, bytes, object
 
+import heapq
 import uuid
 
 from logging import getLogger
@@ -61,6 +62,77 @@ def normalize(value):
     return value
 
 
+def to_number(value):
+    """
+    Convert a number got as a string from redis (or a lua script) to an int
+    if possible, else to a float
+    """
+    value = normalize(value)
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+class _MergeKey(object):
+    """
+    Wrap a key used by ``merge_sorted`` to compare entries, in reverse order
+    if asked
+    """
+    __slots__ = ('value', 'reverse')
+
+    def __init__(self, value, reverse):
+        self.value = value
+        self.reverse = reverse
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        if self.reverse:
+            return other.value < self.value
+        return self.value < other.value
+
+
+def merge_sorted(iterables, key, reverse=False):
+    """Merge many sorted iterables in a single sorted list (a k-way merge).
+
+    Parameters
+    ----------
+    iterables : List[Iterable]
+        The iterables to merge, each one already sorted with the given `key` and `reverse`
+    key : Callable
+        The function returning, for an entry, the value to compare it with the other ones
+    reverse : bool
+        Default to ``False``. If ``True``, the iterables are sorted in descending order
+
+    Returns
+    -------
+    list
+        All the entries of the iterables, sorted. Entries comparing equal are in the order of
+        the iterables.
+
+    """
+    iterators = [iter(iterable) for iterable in iterables]
+    heap = []
+    for position, iterator in enumerate(iterators):
+        for entry in iterator:
+            heap.append((_MergeKey(key(entry), reverse), position, entry))
+            break
+    heapq.heapify(heap)
+
+    result = []
+    while heap:
+        position, entry = heap[0][1:]
+        result.append(entry)
+        for entry in iterators[position]:
+            heapq.heapreplace(heap, (_MergeKey(key(entry), reverse), position, entry))
+            break
+        else:
+            heapq.heappop(heap)
+    return result
+
+
 class cached_property(object):
     """
     Decorator that converts a method with a single self argument into a
@@ -0,0 +1,338 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+from future.builtins import str, object
+
+from limpyd.exceptions import ImplementationError
+from limpyd.fields import SingleValueField
+from limpyd.indexes import BaseIndex
+
+__all__ = ['View', ]
+
+
+class ViewIndex(BaseIndex):
+    """Index keeping up to date the sorted set of a materialized ``View``
+
+    One such index is added to each field used by a view. It cannot be used to filter
+    collections: when a value is added/removed, it will save it in the hash of the view for this
+    field, then add or remove the instance from the sorted set of the view, depending on the
+    values saved for all the fields of the view.
+
+    As values are saved in the view itself, the update does not depend on the order in which the
+    values of the different fields are written.
+
+    Configurable attributes
+    -----------------------
+    These are class attributes that can be changed via ``configure``:
+
+    view_name : str
+        The name of the view on the model
+
+    """
+
+    key = 'view'
+    view_name = None
+    configurable_attrs = BaseIndex.configurable_attrs | {'view_name'}
+
+    lua_update_script = {
+        # we save (or remove if ARGV[3] is not '1') the value ARGV[4] of the pk ARGV[1] in the
+        # hash of the field at position ARGV[2], then, if all the hashes of the filters (the
+        # first ones) hold the expected values (ARGV[6] and next), we add the pk to the view
+        # KEYS[1] with, as score, the value in the hash of the sort field (position ARGV[5]),
+        # or 0 if there is no sort field. Else we remove the pk from the view.
+        'lua': """
+            local view_key, pk = KEYS[1], ARGV[1]
+            local changed, is_set, value = tonumber(ARGV[2]), ARGV[3] == '1', ARGV[4]
+            local sort_position = tonumber(ARGV[5])
+
+            if is_set then
+                redis.call('hset', KEYS[changed + 1], pk, value)
+            else
+                redis.call('hdel', KEYS[changed + 1], pk)
+            end
+
+            for i = 6, #ARGV do
+                if redis.call('hget', KEYS[i - 4], pk) ~= ARGV[i] then
+                    redis.call('zrem', view_key, pk)
+                    return 0
+                end
+            end
+
+            local score = 0
+            if sort_position > 0 then
+                score = tonumber(redis.call('hget', KEYS[sort_position + 1], pk))
+                if not score then
+                    redis.call('zrem', view_key, pk)
+                    return 0
+                end
+            end
+
+            redis.call('zadd', view_key, score, pk)
+            return 1
+        """
+    }
+
+    @classmethod
+    def handle_configurable_attrs(cls, view_name, **kwargs):
+        """Handle attributes that can be passed to ``configure``.
+
+        This method handle the ``view_name`` attribute added in this index class.
+
+        Parameters
+        ----------
+        view_name : str
+            The name of the view on the model
+
+        For the other parameters, see ``BaseIndex.handle_configurable_attrs``.
+
+        """
+        name, attrs, kwargs = super(ViewIndex, cls).handle_configurable_attrs(**kwargs)
+        attrs['view_name'] = view_name
+        return name, attrs, kwargs
+
+    @property
+    def view(self):
+        """Get the view of the model tied to the field tied to this index
+
+        Returns
+        -------
+        View
+            The view, attached to the model (it may be a subclass of the one that declared it)
+
+        """
+        return self.model.get_view(self.view_name)
+
+    def update_view(self, pk, value):
+        """Save the value for the given pk and add/remove the pk from the view
+
+        Parameters
+        ----------
+        pk : Any
+            The primary key of the instance to update in the view
+        value : Any
+            The new value of the field for this instance. ``None`` if the value is removed.
+
+        """
+        view = self.view
+        position = view.fields.index(self.field.name) + 1
+
+        self.model.database.call_script(
+            # be sure to use the script dict at the class level
+            # to avoid registering it many times
+            script_dict=ViewIndex.lua_update_script,
+            keys=view.get_storage_keys(),
+            args=[
+                pk,
+                position,
+                0 if value is None else 1,
+                '' if value is None else self.normalize_value(value),
+                view.fields.index(view.sort_field) + 1 if view.sort_field else 0,
+            ] + view.get_filters_values(),
+        )
+
+    def add(self, pk, *args, **kwargs):
+        """Save the value in the view and update the presence of the instance in it
+
+        For the parameters, see ``BaseIndex.add``
+
+        """
+        self.update_view(pk, args[-1])
+        self._get_rollback_cache(pk)['indexed_values'].add(tuple(args))
+
+    def remove(self, pk, *args, **kwargs):
+        """Remove the value from the view and remove the instance from it
+
+        For the parameters, see ``BaseIndex.remove``
+
+        """
+        self.update_view(pk, None)
+        self._get_rollback_cache(pk)['deindexed_values'].add(tuple(args))
+
+    def get_all_storage_keys(self):
+        """Returns the keys to be removed by `clear` in aggressive mode
+
+        For the parameters, see BaseIndex.get_all_storage_keys
+
+        Notes
+        -----
+        The whole view is cleared, not only the part tied to the field of this index
+
+        """
+        return set(self.view.get_storage_keys())
+
+
+class View(object):
+    """A materialized view of a model: the pks of the instances matching some filters, sorted
+
+    The view is stored in a sorted set, maintained when the values of its fields are updated, so
+    reading it is a single ``ZRANGE``, without any filtering or sorting at query time.
+
+    Parameters
+    ----------
+    name : str
+        The name of the view, unique in the model
+    filters : Optional[dict]
+        The name of the fields as keys, and the value they must hold as values, for an instance
+        to be part of the view. Only equality is supported.
+    sort : Optional[str]
+        The name of the field, holding numbers, to use to sort the instances. Instances without
+        a number in this field are not part of the view. Prefix the name with ``-`` to read the
+        view in descending order. If not set, instances are sorted by pk (lexicographically).
+
+    Examples
+    --------
+
+    >>> class Article(RedisModel):
+    ...     database = main_database
+    ...     status = InstanceHashField()
+    ...     date = InstanceHashField()  # a timestamp
+    ...     materialized_views = [View('active_by_date', filters={'status': 'active'}, sort='-date')]
+    >>> Article.get_view('active_by_date').pks(num=10)
+
+    """
+
+    def __init__(self, name, filters=None, sort=None):
+        self.name = name
+        self.filters = dict(filters or {})
+        self.desc = bool(sort) and sort.startswith('-')
+        self.sort_field = sort[1:] if self.desc else sort
+        self._model = None
+
+    def __repr__(self):
+        return '<%s %s (filters=%s, sort=%s%s)>' % (
+            self.__class__.__name__,
+            self.name,
+            self.filters,
+            '-' if self.desc else '',
+            self.sort_field,
+        )
+
+    @property
+    def fields(self):
+        """Return the name of the fields of the view: the filters ones, then the sort one"""
+        fields = sorted(self.filters)
+        if self.sort_field and self.sort_field not in self.filters:
+            fields.append(self.sort_field)
+        return fields
+
+    def _attach_to_model(self, model):
+        """Attach the view to a model, to compute its keys"""
+        self._model = model
+
+    def _add_indexes(self):
+        """Add the index maintaining the view to all its fields"""
+        if not self.fields:
+            raise ImplementationError("The view %s on %s must have filters or a sort field" % (
+                self.name,
+                self._model.__name__,
+            ))
+        for field_name in self.fields:
+            if not self._model.has_field(field_name):
+                raise ImplementationError("%s is not an existing field for the view %s on %s" % (
+                    field_name,
+                    self.name,
+                    self._model.__name__,
+                ))
+            field = self._model.get_field(field_name)
+            if self._model._field_is_pk(field_name) or not isinstance(field, SingleValueField):
+                raise ImplementationError("The view %s on %s cannot use the field %s, a %s" % (
+                    self.name,
+                    self._model.__name__,
+                    field_name,
+                    field.__class__.__name__,
+                ))
+            # kept apart from the indexes of the field, that is not made ``indexable``: the
+            # view cannot be used to filter collections. Do not update the list in place, as it
+            # may be shared with a parent model
+            field._view_index_classes = field._view_index_classes + [
+                ViewIndex.configure(view_name=self.name)]
+
+    def _get_index(self, field):
+        """Return the index of the given field that maintains this view"""
+        for index in field._indexes:
+            if isinstance(index, ViewIndex) and index.view_name == self.name:
+                return index
+
+    @property
+    def key(self):
+        """The key of the sorted set holding the pks of the view"""
+        return self._model.make_key(self._model._name, '__view__', self.name)
+
+    def get_storage_keys(self):
+        """Return the key of the view, then the key of the hash of each of its fields"""
+        return [self.key] + [self._model.make_key(self.key, field_name) for field_name in self.fields]
+
+    def get_filters_values(self):
+        """Return the values of the filters, normalized as saved in the hashes of the view"""
+        return [
+            str(self._model.get_field(field_name).from_python(self.filters[field_name]))
+            for field_name in sorted(self.filters)
+        ]
+
+    def count(self):
+        """Return the number of instances in the view"""
+        return self._model.get_connection().zcard(self.key)
+
+    def pks(self, start=0, num=None):
+        """Return the pks of the view, in its order, with a single ``ZRANGE``
+
+        Parameters
+        ----------
+        start : int
+            The position of the first pk to return
+        num : Optional[int]
+            The number of pks to return. All the ones after ``start`` if not set
+
+        Returns
+        -------
+        list
+            The pks of the view
+
+        """
+        if num is not None and num <= 0:
+            return []
+        stop = -1 if num is None else start + num - 1
+        command = 'zrevrange' if self.desc else 'zrange'
+        return getattr(self._model.get_connection(), command)(self.key, start, stop)
+
+    def instances(self, start=0, num=None, lazy=False):
+        """Return the instances of the view, in its order. See ``pks`` for the parameters.
+
+        If ``lazy`` is ``True``, instances are created with ``lazy_connect``
+        """
+        return list(self._model.from_pks(self.pks(start, num), lazy=lazy))
+
+    def rebuild(self, chunk_size=1000):
+        """Rebuild the view from the values of all the existing instances
+
+        Parameters
+        ----------
+        chunk_size: int
+            Default to 1000, it's the number of instances to load at once.
+
+        """
+        connection = self._model.get_connection()
+        connection.delete(*self.get_storage_keys())
+
+        fields = [self._model.get_field(field_name) for field_name in self.fields]
+        indexes = [self._get_index(field) for field in fields]
+
+        def update_views(pks):
+            instances = list(self._model.from_pks(pks, lazy=True))
+            saved_values = self._model._get_saved_values(instances, self.fields)
+            for pk, values in zip(pks, saved_values):
+                for field, index in zip(fields, indexes):
+                    if values[field.name] is not None:
+                        index.update_view(pk, values[field.name])
+
+        # read the pks with ``SSCAN``, that works for any kind of pks and doesn't sort
+        # the whole collection for each chunk. A pk may be returned twice but updating
+        # a view is idempotent.
+        pks = []
+        pk_collection_key = self._model.get_field('pk').collection_key
+        for pk in connection.sscan_iter(pk_collection_key, count=chunk_size):
+            pks.append(pk)
+            if len(pks) >= chunk_size:
+                update_views(pks)
+                pks = []
+        if pks:
+            update_views(pks)
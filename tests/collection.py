@@ -10,6 +10,7 @@ from redis.exceptions import ResponseError
 from limpyd import fields
 from limpyd.collection import CollectionManager, CollectionResults
 from limpyd.exceptions import *
+from limpyd.indexes import NumberRangeIndex, TextRangeIndex
 
 from .base import LimpydBaseTest, TEST_CONNECTION_SETTINGS
 from .model import Boat, Bike, Email, TestRedisModel
@@ -441,6 +442,104 @@ class SortTest(CollectionBaseTest):
         self.assertListEqual(sorted_pks, ['87', '7402', '8123', '8674'])
 
 
+class MultiSortTest(CollectionBaseTest):
+    """
+    Test the sort() method with many fields.
+    """
+
+    def test_sort_by_many_fields(self):
+        self.assertEqual(
+            list(Boat.collection().sort(by=['power', '-length'], alpha=['power'])),
+            ['4', '3', '1', '2']
+        )
+        self.assertEqual(
+            list(Boat.collection().sort(by=['-power', 'length'], alpha=['power'])),
+            ['2', '1', '3', '4']
+        )
+        self.assertEqual(
+            list(Boat.collection(power='sail').sort(by=['-launched', 'length'])),
+            ['3', '2', '1']
+        )
+
+    def test_sort_by_one_field_in_a_list_should_use_normal_sort(self):
+        collection = Boat.collection().sort(by=['-length'])
+        self.assertEqual(collection._sort, {'by': Boat.get_field('length').sort_wildcard, 'desc': True})
+        self.assertEqual(list(collection), ['4', '3', '1', '2'])
+
+    def test_alpha_should_apply_to_all_fields_if_true(self):
+        Boat(name="Pen Duick IV", length=8, launched=1968)
+        self.assertEqual(
+            list(Boat.collection(power='sail').sort(by=['power', 'length'], alpha=True)),
+            ['2', '1', '3', '5']
+        )
+        self.assertEqual(
+            list(Boat.collection(power='sail').sort(by=['power', 'length'], alpha=['power'])),
+            ['5', '2', '1', '3']
+        )
+
+    def test_sort_by_many_fields_should_use_pk_for_ties(self):
+        Boat(name="Pen Duick V", length=10.6, launched=1968)
+        Boat(name="Pen Duick VI", length=22.25, launched=1968)
+        self.assertEqual(
+            list(Boat.collection().sort(by=['-launched', 'power'], alpha=True)),
+            ['5', '6', '3', '2', '4', '1']
+        )
+        self.assertEqual(
+            list(Boat.collection().sort(by=['-launched', '-pk'], alpha=['launched'])),
+            ['6', '5', '3', '2', '4', '1']
+        )
+        self.assertEqual(
+            list(Boat.collection().sort(by=['launched', 'power'], alpha=True, desc=True)),
+            ['6', '5', '3', '2', '4', '1']
+        )
+
+    def test_missing_values_should_come_first(self):
+        Boat(name="Pen Duick VI", launched=1973)
+        self.assertEqual(
+            list(Boat.collection().sort(by=['length', 'name'], alpha=['name'])),
+            ['5', '2', '1', '3', '4']
+        )
+        self.assertEqual(
+            list(Boat.collection().sort(by=['name', 'length'], alpha=True)),
+            ['1', '2', '3', '5', '4']
+        )
+
+    def test_sort_by_many_fields_should_fail_for_non_numeric_values(self):
+        with self.assertRaises(ResponseError):
+            list(Boat.collection().sort(by=['power', 'length']))
+
+    def test_sort_by_many_fields_should_be_sliceable(self):
+        for x in range(5):
+            Boat(name='boat%s' % x, length=x % 2, power='engine' if x % 3 else 'sail')
+
+        collection = Boat.collection().sort(by=['power', '-length'], alpha=['power'])
+        test_list = ['4', '6', '7', '9', '3', '1', '2', '8', '5']
+        self.assertEqual(list(collection), test_list)
+
+        limit = 5
+        for start in list(range(-limit, limit+1)) + [None]:
+            for stop in list(range(-limit, limit+1)) + [None]:
+                for step in range(-limit, limit+1):
+                    if not step:
+                        continue
+                    with self.subTest(Start=start, Stop=stop, step=step):
+                        self.assertEqual(list(collection[start:stop:step]), test_list[start:stop:step])
+
+    def test_sort_by_many_fields_should_work_with_a_single_pk_filter(self):
+        self.assertEqual(list(Boat.collection(pk=2).sort(by=['power', 'length'], alpha=['power'])), ['2'])
+        self.assertEqual(list(Boat.collection(pk=2, power='engine').sort(by=['power', 'length'])), [])
+
+    def test_sort_by_many_fields_should_return_instances(self):
+        boats = Boat.collection().sort(by=['power', '-length'], alpha=['power']).instances()[1:3]
+        self.assertEqual([boat.name.get() for boat in boats], ['Pen Duick III', 'Pen Duick I'])
+
+    def test_temporary_key_is_deleted(self):
+        keys_before = self.connection.info()['db%s' % TEST_CONNECTION_SETTINGS['db']]['keys']
+        list(Boat.collection(power='sail').sort(by=['power', 'length'], alpha=['power']))
+        keys_after = self.connection.info()['db%s' % TEST_CONNECTION_SETTINGS['db']]['keys']
+        self.assertEqual(keys_after, keys_before)
+
+
 class InstancesTest(CollectionBaseTest):
     """
     Test the instances() method.
@@ -643,5 +742,258 @@ class LenTest(CollectionBaseTest):
             self.assertEqual(len(list(collection)), 3)
 
 
+class DeleteTest(CollectionBaseTest):
+    """
+    Test the delete() method.
+    """
+
+    def test_delete_should_delete_all_instances_of_the_collection(self):
+        self.assertEqual(Boat.collection(power="sail").delete(), 3)
+        self.assertEqual(set(Boat.collection()), {self.boat4._pk})
+        self.assertEqual(set(Boat.collection(power="sail")), set())
+        self.assertEqual(set(Boat.collection(launched=1898)), set())
+        self.assertFalse(Boat.exists(name="Pen Duick I"))
+        self.assertTrue(Boat.exists(name="Rainbow Warrior I"))
+        with self.assertRaises(DoesNotExist):
+            Boat.get(self.boat1._pk)
+
+    def test_delete_should_work_by_chunks(self):
+        self.assertEqual(Boat.collection().delete(chunk_size=3), 4)
+        self.assertEqual(len(Boat.collection()), 0)
+        # only the max pk key remains
+        self.assertEqual(self.count_keys(), 1)
+
+    def test_delete_on_empty_collection_should_do_nothing(self):
+        self.assertEqual(Boat.collection(power="nothing").delete(), 0)
+        self.assertEqual(len(Boat.collection()), 4)
+
+
+class UpdateTest(CollectionBaseTest):
+    """
+    Test the update() method.
+    """
+
+    def test_update_should_set_values_and_update_indexes(self):
+        self.assertEqual(Boat.collection(power="sail").update(power="engine", length=10), 3)
+        self.assertEqual(set(Boat.collection(power="sail")), set())
+        self.assertEqual(len(Boat.collection(power="engine")), 4)
+        self.assertEqual(self.boat1.power.hget(), "engine")
+        self.assertEqual(self.boat2.length.get(), "10")
+        self.assertEqual(self.boat4.length.get(), "40")
+
+    def test_update_should_move_pks_with_different_old_values(self):
+        Boat.collection(power="sail").update(launched=2000)
+        self.assertEqual(
+            set(Boat.collection(launched=2000)),
+            {self.boat1._pk, self.boat2._pk, self.boat3._pk}
+        )
+        for launched in (1898, 1964, 1966):
+            self.assertEqual(set(Boat.collection(launched=launched)), set())
+        self.assertEqual(set(Boat.collection(launched=1955)), {self.boat4._pk})
+
+    def test_update_should_move_pks_at_once(self):
+        Boat.collection(pk=self.boat1._pk).update(launched=1964)
+        with self.assertNumCommands(16):
+            # 1 SMEMBERS to get the pks, 1 lock, 3 GET in a pipeline, then in
+            # a MULTI/EXEC: one SREM for "1964" (boats 1 and 2 at once), one
+            # for "1966", one SADD for "2000", and 3 SET, then 1 unlock (a lua
+            # script doing a GET and a DEL)
+            Boat.collection(power="sail").update(launched=2000)
+
+    def test_update_should_work_by_chunks(self):
+        self.assertEqual(Boat.collection().update(chunk_size=3, power="oars"), 4)
+        self.assertEqual(len(Boat.collection(power="oars")), 4)
+
+    def test_update_should_refuse_unique_fields_for_many_instances(self):
+        with self.assertRaises(UniquenessError):
+            Boat.collection(power="sail").update(name="Pen Duick")
+        self.assertEqual(self.boat1.name.get(), "Pen Duick I")
+
+        # but it works for only one instance, if the value is really unique
+        Boat.collection(pk=self.boat1._pk).update(name="Pen Duick")
+        self.assertEqual(self.boat1.name.get(), "Pen Duick")
+        with self.assertRaises(UniquenessError):
+            Boat.collection(pk=self.boat1._pk).update(name="Pen Duick II", length=1)
+        self.assertEqual(self.boat1.name.get(), "Pen Duick")
+        self.assertEqual(self.boat1.length.get(), "15.1")
+        self.assertTrue(Boat.exists(name="Pen Duick"))
+
+    def test_update_should_refuse_multi_values_fields(self):
+        class Sailor(TestRedisModel):
+            name = fields.StringField()
+            boats = fields.SetField()
+
+        Sailor(name="Eric")
+        with self.assertRaises(ValueError):
+            Sailor.collection().update(boats="Pen Duick")
+        with self.assertRaises(ValueError):
+            Sailor.collection().update(pk=2)
+
+
+class Player(TestRedisModel):
+    namespace = 'collection-cursor'
+    name = fields.InstanceHashField(indexable=True, indexes=[TextRangeIndex])
+    team = fields.InstanceHashField(indexable=True)
+    score = fields.InstanceHashField(indexable=True, indexes=[NumberRangeIndex])
+
+
+class CursorTest(LimpydBaseTest):
+    """
+    Test the after() method.
+    """
+
+    def setUp(self):
+        super(CursorTest, self).setUp()
+        # scores: 0, 1, 2, 3, 4, 0, 1... (pks 1 to 20), teams: a, b, a, b...
+        for i in range(20):
+            Player(name='player%02d' % i, team='ab'[i % 2], score=i % 5)
+
+    def get_pages(self, collection, size):
+        pages, cursor = [], None
+        while True:
+            page = collection.after(cursor)
+            results = page[:size]
+            if not results:
+                return pages
+            pages.append(list(results))
+            cursor = page.next_cursor
+
+    def test_pages_should_follow_the_sort(self):
+        collection = Player.collection().sort(by='score')
+        pages = self.get_pages(collection, 3)
+        self.assertEqual(len(pages), 7)
+        pks = [pk for page in pages for pk in page]
+        self.assertEqual(len(set(pks)), 20)
+        scores = [Player(pk).score.hget() for pk in pks]
+        self.assertEqual(scores, sorted(scores))
+
+    def test_pages_should_follow_the_desc_sort(self):
+        pages = self.get_pages(Player.collection().sort(by='-score'), 6)
+        scores = [Player(pk).score.hget() for page in pages for pk in page]
+        self.assertEqual(len(scores), 20)
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_pages_should_follow_alpha_sort(self):
+        pages = self.get_pages(Player.collection().sort(by='-name', alpha=True), 8)
+        names = [Player(pk).name.hget() for page in pages for pk in page]
+        self.assertEqual(names, ['player%02d' % i for i in range(19, -1, -1)])
+
+    def test_pages_should_follow_alpha_sort_of_values_starting_with_other_ones(self):
+        for name in ('player', 'player-1', 'player:1', 'player!', 'play', 'player'):
+            Player(name=name, team='c', score=0)
+        for sort in ('name', '-name'):
+            with self.subTest(sort=sort):
+                collection = Player.collection(team='c').sort(by=sort, alpha=True)
+                names = [Player(pk).name.hget() for page in self.get_pages(collection, 2) for pk in page]
+                self.assertEqual(names, [Player(pk).name.hget() for pk in collection])
+                self.assertEqual(names, sorted(names, reverse=sort.startswith('-')))
+
+    def test_pages_with_same_values_should_be_ordered_by_pk(self):
+        for name in ('foo', 'bar', 'foo', 'bar'):
+            Player(name=name, team='c', score=0)
+        pages = self.get_pages(Player.collection(team='c').sort(by='name', alpha=True), 3)
+        self.assertEqual(pages, [['22', '24', '21'], ['23']])
+        pages = self.get_pages(Player.collection(team='c').sort(by='-name', alpha=True), 3)
+        self.assertEqual(pages, [['23', '21', '24'], ['22']])
+
+    def test_pages_should_be_filtered(self):
+        pages = self.get_pages(Player.collection(team='a').sort(by='score'), 4)
+        self.assertEqual([len(page) for page in pages], [4, 4, 2])
+        pks = {pk for page in pages for pk in page}
+        self.assertEqual(pks, set(Player.collection(team='a')))
+
+    def test_slice_after_cursor(self):
+        collection = Player.collection().sort(by='score')
+        all_pks = list(collection)
+        first = collection.after()
+        self.assertEqual(list(first[:2]), all_pks[:2])
+        after = collection.after(first.next_cursor)
+        self.assertEqual(list(after[3:5]), all_pks[5:7])
+        self.assertEqual(after[0], all_pks[2])
+        self.assertEqual(len(after), 18)
+        self.assertEqual(list(after), all_pks[2:])
+
+    def test_cursor_should_resist_to_updates(self):
+        collection = Player.collection().sort(by='score')
+        all_pks = list(collection)
+        page = collection.after()
+        page[:4]
+        # the pk of the cursor changes its score, the next page is still the same
+        Player(all_pks[3]).score.hset(10)
+        self.assertEqual(list(collection.after(page.next_cursor)[:2]), all_pks[4:6])
+
+    def test_next_cursor_should_not_change_if_no_results(self):
+        collection = Player.collection().sort(by='score')
+        page = collection.after()
+        page[:20]
+        cursor = page.next_cursor
+        page = collection.after(cursor)
+        self.assertEqual(list(page[:5]), [])
+        self.assertEqual(page.next_cursor, cursor)
+
+    def test_values_after_cursor(self):
+        page = Player.collection(team='b').sort(by='-score').instances().after()
+        self.assertEqual([player.score.hget() for player in page[:3]], ['4', '4', '3'])
+
+    def test_cursor_needs_a_sort_by_a_field_with_range_index(self):
+        with self.assertRaises(ValueError):
+            Player.collection().after()[:5]
+        with self.assertRaises(ValueError):
+            Player.collection().sort(by='team', alpha=True).after()[:5]
+        with self.assertRaises(ValueError):
+            Player.collection().sort(by='score', alpha=True).after()[:5]
+
+    def test_cursor_only_allows_positive_slicing(self):
+        collection = Player.collection().sort(by='score').after()
+        with self.assertRaises(ValueError):
+            collection[-5:]
+        with self.assertRaises(ValueError):
+            collection[-1]
+
+
+class TopFromIndexTest(LimpydBaseTest):
+    """
+    Test that the first results of a collection sorted by a field with a range
+    index are read from the index.
+    """
+
+    def setUp(self):
+        super(TopFromIndexTest, self).setUp()
+        # scores: 0, 1, 2, 3, 4, 0, 1... (pks 1 to 20), teams: a, b, a, b...
+        for i in range(20):
+            Player(name='player%02d' % i, team='ab'[i % 2], score=i % 5)
+
+    def test_top_should_be_read_from_index(self):
+        # change a value without updating the index: SORT would see it
+        self.connection.hset(Player(1).key, 'score', 100)
+        # ties are ordered by pk, as with SORT
+        self.assertEqual(Player.collection().sort(by='-score')[:3], ['5', '20', '15'])
+        self.assertEqual(Player.collection().sort(by='-score')[:5][-1], '9')
+        self.assertEqual(Player.collection().sort(by='-score')[-1], '1')
+        # but not if all the collection is wanted
+        self.assertEqual(list(Player.collection().sort(by='-score'))[0], '1')
+
+    def test_top_should_be_the_same_as_with_sort(self):
+        for collection in (Player.collection().sort(by='-score'),
+                           Player.collection(team='b').sort(by='score'),
+                           Player.collection(team='a').sort(by='-score')):
+            with self.subTest(collection=collection):
+                expected = list(collection)
+                for start, stop in ((0, 3), (2, 6), (0, 20), (5, 30), (-3, None), (-5, -2)):
+                    self.assertEqual(list(collection[start:stop]), expected[start:stop])
+                self.assertEqual(collection[1], expected[1])
+
+    def test_top_values_should_be_returned(self):
+        collection = Player.collection(team='a').sort(by='-score').instances()
+        self.assertEqual([player.name.hget() for player in collection[:3]],
+                         ['player04', 'player14', 'player08'])
+
+    def test_sort_should_be_used_if_some_pks_are_not_indexed(self):
+        Player(name='player20', team='a')
+        # a missing value is sorted as 0 by SORT
+        collection = Player.collection(team='a').sort(by='score')
+        self.assertEqual(collection[:3], ['1', '11', '21'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,7 +7,7 @@ import unittest
 from redis import ResponseError
 
 from limpyd import fields
-from limpyd.contrib.collection import ExtendedCollectionManager, SORTED_SCORE, DEFAULT_STORE_TTL
+from limpyd.contrib.collection import ExtendedCollectionManager, SORTED_SCORE, DEFAULT_STORE_TTL, numpy, pandas
 from limpyd.utils import unique_key
 from limpyd.exceptions import *
 from tests.indexes import RangeIndexTestModel
@@ -183,6 +183,13 @@ class FieldOrModelAsValueForSortAndFilterTest(BaseTest):
                                         .values_list('name', flat=True))
         self.assertEqual(groups, ['bar', 'baz', 'foo', 'qux'])
 
+    def test_sort_by_many_fields_should_accept_fields_or_fieldnames(self):
+        collection = Group.collection().sort(by=[self.groups[0].active, '-name'], alpha=['name'])
+        self.assertEqual(list(collection.values_list('name', flat=True)), ['qux', 'baz', 'foo', 'bar'])
+        self.assertEqual(list(collection.values('pk', 'public')[1:3]),
+                         [{'pk': '3', 'public': '1'}, {'pk': '1', 'public': '1'}])
+        self.assertEqual(list(collection.store()), ['4', '3', '1', '2'])
+
     def test_filter_should_accept_field_from_same_model(self):
         # test using field from same model, without updating its value
         group = Group(name='foo')
@@ -684,6 +691,39 @@ class SortByScoreTest(BaseTest):
                                                         by_score=self.container.groups_sortedset)
         self.assertListEqual(list(collection), [{'name': 'foo', SORTED_SCORE: '1000.0'}])
 
+    def test_sort_by_sortedset_should_keep_pks_without_score(self):
+        self.container.groups_sortedset.zrem(2, 3)
+        collection = Group.collection().sort(by_score=self.container.groups_sortedset)
+        # pks without score come first, ordered by pk
+        self.assertEqual(list(collection), ['2', '3', '4', '1'])
+        # their score is -inf, as when sorting by score without lua
+        self.assertEqual(list(collection.values_list('name', SORTED_SCORE))[1:3],
+                         [('baz', '-inf'), ('qux', '40.0')])
+        self.assertEqual(list(collection.values('name', SORTED_SCORE)[:1]),
+                         [{'name': 'bar', SORTED_SCORE: '-inf'}])
+        self.assertEqual(collection[:2], ['2', '3'])
+
+    def test_sort_by_sortedset_should_work_on_stored_collection(self):
+        stored = Group.collection(active=1).sort(by='name', alpha=True).store()
+        self.assertEqual(list(stored), ['2', '1'])
+        collection = stored.sort(by_score=self.container.groups_sortedset, desc=True)
+        self.assertEqual(list(collection), ['1', '2'])
+        self.assertEqual(collection.values_list('name', flat=True)[1:], ['bar'])
+
+    def test_sort_by_sortedset_could_be_stored(self):
+        collection = Group.collection().sort(by_score=self.container.groups_sortedset)
+        stored = collection.store()
+        self.assertEqual(list(stored), self.sorted_pks)
+        stored = collection.sort(by_score=self.container.groups_sortedset, desc=True).store()
+        self.assertEqual(list(stored), self.reversed_sorted_pks)
+
+    def test_sort_by_sortedset_should_not_create_keys(self):
+        collection = Group.collection(active=1).sort(by_score=self.container.groups_sortedset)
+        keys = set(test_database.connection.keys())
+        self.assertEqual(list(collection.values('name', SORTED_SCORE)[1:]),
+                         [{'name': 'foo', SORTED_SCORE: '1000.0'}])
+        self.assertEqual(set(test_database.connection.keys()), keys)
+
 
 class StoreTest(BaseTest):
 
@@ -812,6 +852,90 @@ class StoreTest(BaseTest):
         )
 
 
+class StoreAsZsetTest(BaseTest):
+
+    def test_stored_collection_should_be_a_sorted_set(self):
+        collection = Group.collection().sort(by='-name', alpha=True)
+        stored_collection = collection.store(as_zset=True)
+        self.assertEqual(self.connection.type(stored_collection.stored_key), 'zset')
+        self.assertEqual(self.connection.zrange(stored_collection.stored_key, 0, -1, withscores=True),
+                         [('4', 1.0), ('1', 2.0), ('3', 3.0), ('2', 4.0)])
+        self.assertEqual(list(stored_collection), ['4', '1', '3', '2'])
+        self.assertEqual(len(stored_collection), 4)
+        self.assertEqual(stored_collection[1:3], ['1', '3'])
+        self.assertEqual(list(stored_collection.values_list('name', flat=True)), ['qux', 'foo', 'baz', 'bar'])
+
+    def test_stored_sorted_set_could_be_used_by_from_stored(self):
+        stored_key = Group.collection().sort(by='-name', alpha=True).store(as_zset=True).stored_key
+        stored_collection = Group.collection().from_stored(stored_key)
+        self.assertEqual(list(stored_collection), ['4', '1', '3', '2'])
+
+    def test_stored_sorted_set_should_keep_order_when_filtered(self):
+        stored_collection = Group.collection().sort(by='-name', alpha=True).store(as_zset=True)
+        collection = stored_collection.filter(public=1)
+        self.assertEqual(list(collection), ['1', '3'])
+        self.assertEqual(len(collection), 2)
+        collection = stored_collection.intersect(['1', '2', '4'])
+        self.assertEqual(list(collection), ['4', '1', '2'])
+        self.assertEqual(list(collection.sort(by='name', alpha=True)), ['2', '1', '4'])
+
+    def test_refresh_should_update_the_stored_collection(self):
+        stored_collection = Group.collection(active=1).sort(by='name', alpha=True).store(as_zset=True)
+        self.assertEqual(list(stored_collection), ['2', '1'])
+
+        self.groups[1].active.hset(0)
+        self.groups[2].active.hset(1)
+        new_group = Group(name='aaa')
+        self.assertEqual(list(stored_collection), ['2', '1'])  # cached
+
+        self.assertEqual(stored_collection.refresh(), (1, 2))
+        # new pks are inserted at their sorted position
+        self.assertEqual(list(stored_collection), [new_group.pk.get(), '3', '1'])
+        self.assertEqual(len(stored_collection), 3)
+        self.assertEqual(stored_collection.refresh(), (0, 0))
+
+    def test_refresh_should_insert_new_pks_at_their_position(self):
+        for group, position in zip(self.groups, [10, 20, 30, 40]):
+            group.name.hset(position)
+        stored_collection = Group.collection(active=1).sort(by='-name').store(as_zset=True)
+        self.assertEqual(list(stored_collection), ['2', '1'])
+
+        new_groups = [Group(name=position) for position in [5, 15, 16, 25]]
+        self.groups[2].active.hset(1)  # name=30
+        self.assertEqual(stored_collection.refresh(), (0, 5))
+        self.assertEqual(list(stored_collection), ['3', new_groups[3].pk.get(), '2', new_groups[2].pk.get(),
+                                                   new_groups[1].pk.get(), '1', new_groups[0].pk.get()])
+
+        # sorted by pk
+        stored_collection = Group.collection(active=1).sort().store(as_zset=True)
+        self.groups[3].active.hset(1)
+        self.assertEqual(stored_collection.refresh(), (0, 1))
+        self.assertEqual(list(stored_collection), ['1', '2', '3', '4'] + [group.pk.get() for group in new_groups])
+
+    def test_refresh_should_not_work_with_collections_sorted_by_many_fields_or_by_score(self):
+        stored_collection = Group.collection().sort(by=['name', 'id'], alpha=['name']).store(as_zset=True)
+        with self.assertRaises(ValueError):
+            stored_collection.refresh()
+
+    def test_refresh_should_work_with_empty_collection(self):
+        stored_collection = Group.collection(name='new').store(as_zset=True)
+        self.assertEqual(list(stored_collection), [])
+        new_group = Group(name='new')
+        self.assertEqual(stored_collection.refresh(), (0, 1))
+        self.assertEqual(list(stored_collection), [new_group.pk.get()])
+        new_group.name.hset('old')
+        self.assertEqual(stored_collection.refresh(), (1, 0))
+        self.assertEqual(list(stored_collection), [])
+
+    def test_refresh_should_only_work_with_sorted_sets_from_store(self):
+        stored_collection = Group.collection().store()
+        with self.assertRaises(ValueError):
+            stored_collection.refresh()
+        stored_key = Group.collection().store(as_zset=True).stored_key
+        with self.assertRaises(ValueError):
+            Group.collection().from_stored(stored_key).refresh()
+
+
 class LenTest(BaseTest):
     def test_len_should_work_with_sortedsets(self):
         container = GroupsContainer()
@@ -985,3 +1109,240 @@ class ValuesListTest(BaseValuesTest):
         self.assertEqual(boats, {'1', '2', '3', '4'})
         boats = set(Boat.collection().values_list('name', flat=True).primary_keys())
         self.assertEqual(boats, {'1', '2', '3', '4'})
+
+
+class CountByTest(BaseValuesTest):
+    def test_count_by_should_return_counts_by_value(self):
+        self.assertEqual(Boat.collection().count_by('power'), {'sail': 3, 'engine': 1})
+        self.assertEqual(Boat.collection(power='sail').count_by('launched'),
+                         {'1898': 1, '1964': 1, '1966': 1})
+
+    def test_count_by_should_use_index_keys_if_not_filtered(self):
+        # add a fake pk in an index key to see where counts come from
+        index_key = Boat.get_field('launched').get_index().get_storage_key(1898)
+        self.connection.sadd(index_key, 9999)
+        self.assertEqual(Boat.collection().count_by('launched'),
+                         {'1898': 2, '1964': 1, '1966': 1, '1955': 1})
+        self.assertEqual(Boat.collection(power='sail').count_by('launched'),
+                         {'1898': 1, '1964': 1, '1966': 1})
+
+    def test_count_by_should_ignore_other_keys_sharing_the_index_prefix(self):
+        index_key = Boat.get_field('launched').get_index().get_storage_key('foo')
+        self.connection.hset(index_key, 'bar', 1)
+        self.assertEqual(Boat.collection().count_by('launched'),
+                         {'1898': 1, '1964': 1, '1966': 1, '1955': 1})
+
+    def test_count_by_should_count_missing_values_with_none(self):
+        self.boat1.length.delete()
+        self.assertEqual(Boat.collection(power='sail').count_by('length'),
+                         {'13.6': 1, '17.45': 1, None: 1})
+
+    def test_count_by_on_indexed_field_should_count_missing_values_with_none(self):
+        self.boat1.launched.delete()
+        self.assertEqual(Boat.collection().count_by('launched'),
+                         {'1964': 1, '1966': 1, '1955': 1, None: 1})
+        self.assertEqual(Boat.collection(power='sail').count_by('launched'),
+                         {'1964': 1, '1966': 1, None: 1})
+
+    def test_count_by_should_work_with_pk(self):
+        self.assertEqual(Boat.collection(pk=self.boat1._pk).count_by('power'), {'sail': 1})
+        self.assertEqual(Boat.collection(pk=10).count_by('power'), {})
+
+    def test_count_by_should_only_accept_simple_fields(self):
+        class BoatWithPassengers(Boat):
+            passengers = fields.SetField()
+
+        with self.assertRaises(ValueError):
+            BoatWithPassengers.collection().count_by('passengers')
+        with self.assertRaises(ValueError):
+            BoatWithPassengers.collection().count_by('foo')
+        with self.assertRaises(ValueError):
+            BoatWithPassengers.collection().count_by('pk')
+
+
+class AggregateTest(BaseValuesTest):
+    def test_aggregate_should_compute_all_aggregates(self):
+        self.assertEqual(Boat.collection().aggregate(
+            count='length', sum='length', min='length', max=['length', 'launched'], avg='launched',
+        ), {
+            'length__count': 4,
+            'length__sum': 86.15,
+            'length__min': 13.6,
+            'length__max': 40,
+            'launched__max': 1966,
+            'launched__avg': 1945.75,
+        })
+
+    def test_aggregate_should_work_on_filtered_collection(self):
+        self.assertEqual(Boat.collection(power='sail').aggregate(sum='launched', max='length'), {
+            'launched__sum': 5828,
+            'length__max': 17.45,
+        })
+        self.assertEqual(Boat.collection(pk=self.boat4._pk).aggregate(sum='length'), {
+            'length__sum': 40,
+        })
+
+    def test_aggregate_should_ignore_non_numeric_values(self):
+        self.boat1.length.set('unknown')
+        self.boat2.length.delete()
+        self.assertEqual(Boat.collection().aggregate(count='length', min='length', avg='name'), {
+            'length__count': 2,
+            'length__min': 17.45,
+            'name__avg': None,
+        })
+
+    def test_aggregate_should_not_lose_precision(self):
+        self.boat1.length.set(100000000000001)
+        self.boat2.length.set(0.1)
+        self.boat3.length.set(7)
+        self.boat4.length.delete()
+        self.assertEqual(Boat.collection().aggregate(sum='length', min='length', max='length'), {
+            'length__sum': 100000000000008.1,
+            'length__min': 0.1,
+            'length__max': 100000000000001,
+        })
+        self.assertIsInstance(Boat.collection().aggregate(max='length')['length__max'], int)
+
+    def test_aggregate_on_empty_collection(self):
+        self.assertEqual(Boat.collection(power='oars').aggregate(count='length', sum='length', max='length'), {
+            'length__count': 0,
+            'length__sum': 0,
+            'length__max': None,
+        })
+
+    def test_aggregate_should_refuse_invalid_aggregates_or_fields(self):
+        with self.assertRaises(ValueError):
+            Boat.collection().aggregate(median='length')
+        with self.assertRaises(ValueError):
+            Boat.collection().aggregate(sum='foo')
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class ToArraysTest(BaseValuesTest):
+    def test_to_arrays_should_return_a_column_by_field(self):
+        arrays = Boat.collection().sort(by='launched').to_arrays(['pk', 'name', 'launched'])
+        self.assertEqual(list(arrays), ['pk', 'name', 'launched'])
+        self.assertEqual(list(arrays['pk']), ['1', '4', '2', '3'])
+        self.assertEqual(list(arrays['launched']), ['1898', '1955', '1964', '1966'])
+        self.assertEqual(arrays['name'].dtype, object)
+
+    def test_to_arrays_without_fields_returns_all_fields(self):
+        arrays = Boat.collection().to_arrays()
+        self.assertEqual(set(arrays), {'pk', 'name', 'power', 'launched', 'length'})
+
+    def test_to_arrays_should_convert_columns_to_dtypes(self):
+        self.boat2.length.delete()
+        arrays = Boat.collection(power='sail').sort(by='-launched').to_arrays(
+            ['launched', 'length', 'name'], dtypes={'launched': 'int32', 'length': float, 'name': 'U20'}
+        )
+        self.assertEqual(arrays['launched'].dtype, numpy.int32)
+        self.assertEqual(arrays['launched'].tolist(), [1966, 1964, 1898])
+        self.assertEqual(arrays['length'][0], 17.45)
+        self.assertTrue(numpy.isnan(arrays['length'][1]))
+        self.assertEqual(arrays['name'].tolist(), ['Pen Duick III', 'Pen Duick II', 'Pen Duick I'])
+
+        with self.assertRaises(ValueError):
+            Boat.collection().to_arrays(['length'], dtypes={'length': int})
+
+    def test_to_arrays_should_read_by_chunks(self):
+        for index in range(10):
+            Boat(name='boat %s' % index, launched=2000 + index)
+        arrays = Boat.collection().sort(by='launched').to_arrays(
+            ['launched'], dtypes={'launched': int}, chunk_size=3
+        )
+        self.assertEqual(arrays['launched'].tolist(), [1898, 1955, 1964, 1966] + list(range(2000, 2010)))
+
+    def test_to_arrays_on_empty_collection(self):
+        arrays = Boat.collection(power='oars').to_arrays(['pk', 'length'], dtypes={'length': float})
+        self.assertEqual(len(arrays['pk']), 0)
+        self.assertEqual(arrays['length'].dtype, float)
+
+    def test_to_arrays_should_not_leave_keys(self):
+        keys = set(self.connection.keys())
+        Boat.collection(power='sail').to_arrays(['name'])
+        self.assertEqual(set(self.connection.keys()), keys)
+
+    def test_to_arrays_stored_key_should_not_expire_during_the_export(self):
+        keys = set(self.connection.keys())
+        ttls = []
+        collection = Boat.collection(power='sail')
+        resolve_related_values = collection._resolve_related_values
+
+        def resolve_and_get_ttls(results, fields_parameters):
+            ttls.extend(self.connection.ttl(key) for key in set(self.connection.keys()) - keys)
+            return resolve_related_values(results, fields_parameters)
+        collection._resolve_related_values = resolve_and_get_ttls
+
+        collection.to_arrays(['name'], chunk_size=1)
+        self.assertEqual(ttls, [-1, -1, -1])
+
+    @unittest.skipIf(pandas is None, 'pandas is not installed')
+    def test_to_dataframe_should_return_a_dataframe(self):
+        dataframe = Boat.collection().sort(by='launched').to_dataframe(
+            ['name', 'length'], dtypes={'length': float}
+        )
+        self.assertEqual(list(dataframe.columns), ['name', 'length'])
+        self.assertEqual(list(dataframe['name']), ['Pen Duick I', 'Rainbow Warrior I', 'Pen Duick II', 'Pen Duick III'])
+        self.assertEqual(dataframe['length'].sum(), 86.15)
+
+
+class FacetsTest(BaseTest):
+    def test_facets_should_count_values_of_many_fields(self):
+        self.assertEqual(Group.collection().facets('active', 'public'), {
+            'active': {'1': 2, '0': 2},
+            'public': {'1': 2, '0': 2},
+        })
+        self.assertEqual(Group.collection(active=1).facets('name', 'public'), {
+            'name': {'foo': 1, 'bar': 1},
+            'public': {'1': 1, '0': 1},
+        })
+
+    def test_facets_should_not_retrieve_pks(self):
+        collection = Group.collection(active=1)
+        self.assertEqual(collection._collection_cache, None)
+        collection.facets('public')
+        self.assertEqual(collection._collection_cache, None)
+
+    def test_facets_should_work_with_pk(self):
+        self.assertEqual(Group.collection(pk=2).facets('name', 'public'), {
+            'name': {'bar': 1},
+            'public': {'0': 1},
+        })
+        self.assertEqual(Group.collection(pk=10).facets('name'), {'name': {}})
+
+    def test_facets_should_work_with_intersect(self):
+        collection = Group.collection(active=1).intersect(['1', '3'])
+        self.assertEqual(collection.facets('public'), {'public': {'1': 1}})
+        container = GroupsContainer()
+        container.groups_list.rpush('1', '2', '4')
+        collection = Group.collection(public=0).intersect(container.groups_list)
+        self.assertEqual(collection.facets('active'), {'active': {'1': 1, '0': 1}})
+        container.groups_sortedset.zadd({'1': 1, '2': 2})
+        collection = Group.collection().intersect(container.groups_sortedset)
+        self.assertEqual(collection.facets('public'), {'public': {'1': 1, '0': 1}})
+
+    def test_facets_should_work_on_stored_collection(self):
+        stored = Group.collection(public=1).store()
+        self.assertEqual(stored.facets('active'), {'active': {'1': 1, '0': 1}})
+
+    def test_facets_should_only_accept_fields_with_simple_equal_index(self):
+        with self.assertRaises(ValueError):
+            Boat.collection().facets('length')
+        with self.assertRaises(ValueError):
+            Group.collection().facets('foo')
+
+
+class CursorTest(BaseTest):
+    def test_after_should_work_with_values_and_intersect(self):
+        class RangeIndexTestModelCursor(RangeIndexTestModel):
+            namespace = 'contrib-collection-cursor'
+            collection_manager = ExtendedCollectionManager
+
+        for i in range(6):
+            RangeIndexTestModelCursor(name='foo%s' % i, category='ab'[i % 2], value=10 - i)
+        collection = RangeIndexTestModelCursor.collection(category='a').sort(by='value')
+        page = collection.intersect(['1', '3', '5', '6']).values('value').after()
+        self.assertEqual(list(page[:1]), [{'value': '6'}])
+        page = page.after(page.next_cursor)
+        self.assertEqual(list(page[:5]), [{'value': '8'}, {'value': '10'}])
+        self.assertEqual(len(collection.after(page.next_cursor)), 0)
@@ -1,10 +1,32 @@
 # -*- coding:utf-8 -*-
 from __future__ import unicode_literals
 
+import io
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
 import threading
 import time
-
-from limpyd.contrib.database import PipelineDatabase, _Pipeline
+import unittest
+try:
+    from shutil import which
+except ImportError:  # python 2
+    from distutils.spawn import find_executable as which
+
+from redis import Redis
+from redis.backoff import NoBackoff
+from redis.exceptions import ConnectionError
+from redis.retry import Retry
+
+from limpyd.contrib.collection import ExtendedCollectionManager
+from limpyd.contrib.dump import dump, load
+from limpyd.contrib.database import (PipelineDatabase, RedisClusterDatabase, ShardedRedisDatabase,
+                                     _Pipeline)
+from limpyd.contrib.indexes import EqualIndexWith
+from limpyd.database import RedisDatabase
+from limpyd.exceptions import ImplementationError, UniquenessError
 from limpyd import model, fields
 
 from ..base import LimpydBaseTest, TEST_CONNECTION_SETTINGS
@@ -124,3 +146,380 @@ class PipelineTest(LimpydBaseTest):
 
             names = pipe.execute()
             self.assertEqual(names, ["rosalie", "velocipede", "velocipede"])  # trhee in the pipeline, with one from the thread
+
+
+class HashTagsDatabase(RedisDatabase):
+    hash_tags = True
+
+
+hash_tags_database = HashTagsDatabase(**TEST_CONNECTION_SETTINGS)
+
+
+class Boat(model.RedisModel):
+    database = hash_tags_database
+    namespace = 'database-contrib-tests'
+
+    name = fields.InstanceHashField(indexable=True, unique=True)
+    port = fields.StringField(indexable=True)
+
+
+class Sailor(model.RedisModel):
+    database = hash_tags_database
+    namespace = 'database-contrib-tests'
+    hash_tag = 'crews'
+
+    name = fields.StringField(indexable=True)
+
+
+class HashTagsTest(LimpydBaseTest):
+    database = hash_tags_database
+
+    def test_keys_of_a_model_should_share_the_same_hash_tag(self):
+        boat = Boat(name='Pen Duick', port='Brest')
+        self.assertEqual(set(self.connection.keys()), {
+            '{database-contrib-tests:boat}:collection',
+            '{database-contrib-tests:boat}:max_pk',
+            '{database-contrib-tests:boat}:1:hash',
+            '{database-contrib-tests:boat}:1:port',
+            '{database-contrib-tests:boat}:name:Pen Duick',
+            '{database-contrib-tests:boat}:port:Brest',
+        })
+        self.assertEqual(boat.get_field('port').key, '{database-contrib-tests:boat}:1:port')
+
+    def test_hash_tag_of_the_model_should_be_used_if_defined(self):
+        sailor = Sailor(name='Eric')
+        self.assertEqual(sailor.name.key, '{crews}database-contrib-tests:sailor:1:name')
+
+    def test_models_should_work_with_hash_tags(self):
+        boat1 = Boat(name='Pen Duick', port='Brest')
+        Boat(name='Rainbow Warrior', port='Brest')
+        Boat(name='Pourquoi Pas', port='Saint-Malo')
+        self.assertEqual(set(Boat.collection(port='Brest')), {'1', '2'})
+        self.assertEqual(set(Boat.collection(port__in=['Brest', 'Saint-Malo'], name='Pen Duick')), {'1'})
+        self.assertEqual(Boat.get(name='Pourquoi Pas').port.get(), 'Saint-Malo')
+        boat1.delete()
+        self.assertEqual(set(Boat.collection(port='Brest')), {'2'})
+        self.assertFalse([key for key in self.connection.keys() if not key.startswith('{')])
+
+
+class ClusterBoat(model.RedisModel):
+    database = RedisClusterDatabase(host='localhost')  # port set when the cluster is started
+    namespace = 'database-contrib-tests'
+
+    name = fields.InstanceHashField(indexable=True, unique=True)
+    port = fields.StringField(indexable=True)
+    crew = fields.SetField(indexable=True)
+
+
+class RedisClusterTest(unittest.TestCase):
+    """Tests on a local cluster of 3 redis nodes, started for these tests"""
+
+    nb_nodes = 3
+    # seconds to wait for the nodes, then the cluster, to be ready
+    timeout = float(os.environ.get('LIMPYD_TEST_CLUSTER_TIMEOUT', 60))
+
+    @classmethod
+    def setUpClass(cls):
+        redis_server = which('redis-server')
+        if not redis_server:
+            raise unittest.SkipTest('redis-server is needed to start a cluster')
+
+        cls.directory = tempfile.mkdtemp()
+        cls.nodes = []
+        try:
+            ports = cls.get_free_ports(cls.nb_nodes)
+            for port in ports:
+                subprocess.check_call([
+                    redis_server, '--port', str(port), '--cluster-enabled', 'yes', '--daemonize', 'yes',
+                    '--cluster-config-file', os.path.join(cls.directory, 'nodes-%s.conf' % port),
+                    '--dir', cls.directory, '--save', '', '--appendonly', 'no',
+                ])
+                cls.nodes.append(Redis(port=port, decode_responses=True, retry=Retry(NoBackoff(), 0)))
+
+            # wait for the nodes to be up, then create the cluster with one third of the slots by node
+            for node in cls.nodes:
+                cls.wait_for(lambda: cls.ping(node))
+            slots_by_node = 16384 // len(cls.nodes) + 1
+            for index, node in enumerate(cls.nodes):
+                node.cluster('meet', '127.0.0.1', ports[0])
+                node.cluster('addslots', *range(index * slots_by_node, min(16384, (index + 1) * slots_by_node)))
+            for node in cls.nodes:
+                cls.wait_for(lambda: node.cluster('info')['cluster_state'] == 'ok')
+        except Exception:
+            cls.tearDownClass()
+            raise
+
+        ClusterBoat.database.reset(host='localhost', port=ports[0])
+
+    @classmethod
+    def tearDownClass(cls):
+        for node in cls.nodes:
+            try:
+                node.shutdown(nosave=True)
+            except ConnectionError:
+                pass
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    @staticmethod
+    def get_free_ports(count):
+        """Return `count` free ports, with the ports of the cluster bus (+10000) also free"""
+        ports = []
+        while len(ports) < count:
+            sockets = []
+            try:
+                sock = socket.socket()
+                sockets.append(sock)
+                sock.bind(('127.0.0.1', 0))
+                port = sock.getsockname()[1]
+                if port + 10000 > 65535 or port in ports:
+                    continue
+                bus_sock = socket.socket()
+                sockets.append(bus_sock)
+                bus_sock.bind(('127.0.0.1', port + 10000))
+            except socket.error:
+                continue
+            finally:
+                for sock in sockets:
+                    sock.close()
+            ports.append(port)
+        return ports
+
+    @staticmethod
+    def ping(node):
+        try:
+            return node.ping()
+        except ConnectionError:
+            return False
+
+    @classmethod
+    def wait_for(cls, condition):
+        start = time.time()
+        while not condition():
+            if time.time() - start > cls.timeout:
+                raise RuntimeError('The redis cluster is not ready after %s seconds' % cls.timeout)
+            time.sleep(0.1)
+
+    def setUp(self):
+        self.database = ClusterBoat.database
+        self.database.connection.flushall(target_nodes='primaries')
+
+    def test_models_should_work_on_a_cluster(self):
+        boat1 = ClusterBoat(name='Pen Duick', port='Brest')
+        boat2 = ClusterBoat(name='Rainbow Warrior', port='Brest')
+        ClusterBoat(name='Pourquoi Pas', port='Saint-Malo')
+        boat1.crew.sadd('Eric', 'Yves')
+        boat2.crew.sadd('Eric')
+
+        self.assertEqual(set(ClusterBoat.collection(port='Brest')), {'1', '2'})
+        self.assertEqual(set(ClusterBoat.collection(port='Brest', crew='Yves')), {'1'})
+        self.assertEqual(set(ClusterBoat.collection(port__in=['Brest', 'Saint-Malo'])), {'1', '2', '3'})
+        self.assertEqual(ClusterBoat.get(name='Pourquoi Pas').port.get(), 'Saint-Malo')
+        with self.assertRaises(UniquenessError):
+            ClusterBoat(name='Pen Duick')
+
+        with self.database.batch_writes():
+            boat1.port.set('Lorient')
+            boat2.crew.srem('Eric')
+        self.assertEqual(set(ClusterBoat.collection(port='Lorient')), {'1'})
+        self.assertEqual(set(ClusterBoat.collection(crew='Eric')), {'1'})
+
+        boat1.delete()
+        self.assertEqual(set(ClusterBoat.collection(crew='Eric')), set())
+        self.assertEqual(set(self.database.scan_keys('*:1:*')), set())
+
+    def test_keys_of_a_model_should_be_in_the_same_slot(self):
+        boat = ClusterBoat(name='Pen Duick', port='Brest')
+        boat.crew.sadd('Eric')
+        connection = self.database.connection
+        slots = {connection.keyslot(key) for key in self.database.scan_keys()}
+        self.assertEqual(slots, {connection.keyslot(ClusterBoat.get_field('name').sort_wildcard)})
+
+
+sharded_database = ShardedRedisDatabase(shards=[
+    TEST_CONNECTION_SETTINGS,
+    dict(TEST_CONNECTION_SETTINGS, db=14),
+])
+
+
+class ShardedBoat(model.RedisModel):
+    database = sharded_database
+    namespace = 'database-contrib-tests'
+    collection_manager = ExtendedCollectionManager
+
+    name = fields.InstanceHashField(indexable=True)
+    length = fields.InstanceHashField()
+    port = fields.StringField(indexable=True)
+    crew = fields.SetField(indexable=True)
+
+
+def get_sharded_boats_lengths(pks):
+    return {boat.name.hget(): boat.length.hget() for boat in ShardedBoat.from_pks(pks)}
+
+
+class ShardedRedisDatabaseTest(LimpydBaseTest):
+    database = sharded_database
+
+    def setUp(self):
+        super(ShardedRedisDatabaseTest, self).setUp()
+        self.database.get_shard_connection(1).flushdb()
+
+    def tearDown(self):
+        self.database.get_shard_connection(1).flushdb()
+        super(ShardedRedisDatabaseTest, self).tearDown()
+
+    def create_boats(self):
+        for name, length, port in [('Pen Duick', 15, 'Brest'), ('Rainbow Warrior', 40, 'Brest'),
+                                   ('Pourquoi Pas', 40, 'Saint-Malo'), ('Belem', 58, 'Nantes'),
+                                   ('Hermione', 65, 'Rochefort'), ('Kurun', 9, 'Brest')]:
+            ShardedBoat(name=name, length=length, port=port)
+
+    def test_unique_fields_and_indexes_should_be_refused(self):
+        with self.assertRaises(ImplementationError):
+            class UniqueShardedBoat(model.RedisModel):
+                database = sharded_database
+                namespace = 'database-contrib-tests'
+                name = fields.InstanceHashField(unique=True)
+
+        with self.assertRaises(ImplementationError):
+            class UniqueTogetherShardedBoat(model.RedisModel):
+                database = sharded_database
+                namespace = 'database-contrib-tests'
+                port = fields.InstanceHashField()
+                name = fields.InstanceHashField(indexable=True, indexes=[
+                    EqualIndexWith.configure(other_fields=['port'], unique=True)])
+
+        class UniqueBoat(model.RedisModel):
+            database = RedisDatabase(**TEST_CONNECTION_SETTINGS)
+            namespace = 'database-contrib-tests'
+            name = fields.InstanceHashField(unique=True)
+        with self.assertRaises(ImplementationError):
+            UniqueBoat.use_database(sharded_database)
+
+        # the pk is unique, but in all the shards
+        class NamedShardedBoat(model.RedisModel):
+            database = sharded_database
+            namespace = 'database-contrib-tests'
+            name = fields.PKField()
+
+    def test_instances_should_be_stored_on_the_shard_of_their_pk(self):
+        self.create_boats()
+        pks_by_shard = {0: set(), 1: set()}
+        for pk in map(str, range(1, 7)):
+            pks_by_shard[self.database.get_shard_index(pk)].add(pk)
+        self.assertTrue(pks_by_shard[0] and pks_by_shard[1])
+
+        for index, pks in pks_by_shard.items():
+            connection = self.database.get_shard_connection(index)
+            self.assertEqual(connection.smembers(ShardedBoat.get_field('pk').collection_key), pks)
+            for pk in pks:
+                self.assertTrue(connection.exists(ShardedBoat.lazy_connect(pk).get_field('port').key))
+        # pks are generated on the first shard only
+        self.assertEqual(self.connection.get(ShardedBoat.make_key(ShardedBoat._name, 'max_pk')), '6')
+        self.assertEqual(ShardedBoat.get_field('pk').collection(), set(map(str, range(1, 7))))
+
+        self.assertEqual(ShardedBoat.get(5).name.hget(), 'Hermione')
+        self.assertEqual(ShardedBoat.get(name='Belem').port.get(), 'Nantes')
+        self.assertTrue(ShardedBoat.exists(pk=6))
+        self.assertFalse(ShardedBoat.exists(pk=7))
+
+    def test_collections_should_merge_the_results_of_all_shards(self):
+        self.create_boats()
+        self.assertEqual(set(ShardedBoat.collection(port='Brest')), {'1', '2', '6'})
+        self.assertEqual(len(ShardedBoat.collection(port='Brest')), 3)
+        self.assertEqual(len(ShardedBoat.collection()), 6)
+        self.assertEqual(set(ShardedBoat.collection(port='Brest', pk=2)), {'2'})
+        self.assertEqual(set(ShardedBoat.collection(port='Nantes', pk=2)), set())
+
+        self.assertEqual(list(ShardedBoat.collection().sort()), ['1', '2', '3', '4', '5', '6'])
+        self.assertEqual(ShardedBoat.collection().sort()[1:4], ['2', '3', '4'])
+        self.assertEqual(ShardedBoat.collection().sort(by='-pk')[0], '6')
+        self.assertEqual(list(ShardedBoat.collection().sort(by='length')), ['6', '1', '2', '3', '4', '5'])
+        self.assertEqual(ShardedBoat.collection().sort(by='-length')[:4], ['5', '4', '3', '2'])
+        self.assertEqual(ShardedBoat.collection().sort(by='name', alpha=True)[-2:], ['3', '2'])
+        self.assertEqual(list(ShardedBoat.collection(port='Brest').sort(by='-name', alpha=True).values_list('name', flat=True)),
+                         ['Rainbow Warrior', 'Pen Duick', 'Kurun'])
+        self.assertEqual([boat.name.hget() for boat in ShardedBoat.collection(port='Brest').sort(by='length').instances()],
+                         ['Kurun', 'Pen Duick', 'Rainbow Warrior'])
+
+    def test_buffered_saves_should_be_done_on_each_shard(self):
+        self.create_boats()
+        for boat in ShardedBoat.collection(port='Brest').instances():
+            boat.buffered = True
+            boat.port.set('Lorient')
+            boat.name.hset(boat.name.hget().upper())
+            boat.save()
+        self.assertEqual(set(ShardedBoat.collection(port='Lorient')), {'1', '2', '6'})
+        self.assertEqual(set(ShardedBoat.collection(port='Brest')), set())
+        self.assertEqual(set(ShardedBoat.collection(name='KURUN', port='Lorient')), {'6'})
+
+    def test_updates_and_deletions_should_be_done_on_each_shard(self):
+        self.create_boats()
+        ShardedBoat.get(1).crew.sadd('Eric', 'Yves')
+        ShardedBoat.get(2).crew.sadd('Eric')
+
+        self.assertEqual(ShardedBoat.collection(port='Brest').update(port='Lorient'), 3)
+        self.assertEqual(set(ShardedBoat.collection(port='Lorient')), {'1', '2', '6'})
+        self.assertEqual(set(ShardedBoat.collection(port='Brest')), set())
+
+        with self.database.batch_writes() as batches:
+            for boat in ShardedBoat.collection(port='Lorient').instances():
+                boat.port.set('Brest')
+        self.assertEqual(sorted(batches), [0, 1])
+        self.assertEqual(set(ShardedBoat.collection(port='Brest')), {'1', '2', '6'})
+
+        self.assertEqual(ShardedBoat.collection(crew='Eric').delete(), 2)
+        self.assertEqual(set(ShardedBoat.collection()), {'3', '4', '5', '6'})
+        self.assertEqual(set(ShardedBoat.collection(port='Brest')), {'6'})
+        self.assertEqual(set(self.database.scan_keys('*:1:*')), set())
+
+    def test_adding_a_shard_should_only_move_some_pks(self):
+        pks = [str(pk) for pk in range(1000)]
+        database = ShardedRedisDatabase(shards=self.database.shards + [dict(TEST_CONNECTION_SETTINGS, db=13)])
+        moved = [pk for pk in pks if database.get_shard_index(pk) != self.database.get_shard_index(pk)]
+        self.assertTrue(all(database.get_shard_index(pk) == 2 for pk in moved))
+        self.assertTrue(200 < len(moved) < 450)
+
+    def test_threads_of_shards_should_be_stopped_on_close_and_reset(self):
+        database = ShardedRedisDatabase(shards=self.database.shards)
+        self.assertEqual(database.map_shards(lambda: database.connection.ping()), [True, True])
+        pool = database._pool
+        database.close_pool()
+        self.assertIsNone(database._pool)
+        self.assertFalse(any(worker.is_alive() for worker in pool._pool))
+
+        database.map_shards(lambda: database.connection.ping())
+        pool = database._pool
+        database.reset(shards=self.database.shards + [dict(TEST_CONNECTION_SETTINGS, db=13)])
+        self.assertFalse(any(worker.is_alive() for worker in pool._pool))
+        self.assertEqual(database.map_shards(lambda: database.connection.ping()), [True, True, True])
+        database.close_pool()
+
+    def test_map_reduce_should_read_all_shards(self):
+        self.create_boats()
+        lengths = {}
+        for result in ShardedBoat.map_reduce(get_sharded_boats_lengths, processes=2, chunk_size=2):
+            lengths.update(result)
+        self.assertEqual(lengths, {'Pen Duick': '15', 'Rainbow Warrior': '40', 'Pourquoi Pas': '40',
+                                   'Belem': '58', 'Hermione': '65', 'Kurun': '9'})
+
+    def test_dump_and_load_should_use_all_shards(self):
+        self.create_boats()
+        stream = io.StringIO()
+        self.assertEqual(dump(ShardedBoat, stream, chunk_size=2), 6)
+        keys_by_shard = [set(self.database.get_shard_connection(index).keys()) for index in (0, 1)]
+
+        for index in (0, 1):
+            self.database.get_shard_connection(index).flushdb()
+        stream.seek(0)
+        self.assertEqual(load(ShardedBoat, stream, chunk_size=4), 6)
+        self.assertEqual([set(self.database.get_shard_connection(index).keys()) for index in (0, 1)],
+                         keys_by_shard)
+        self.assertEqual(set(ShardedBoat.collection(port='Brest')), {'1', '2', '6'})
+        self.assertEqual(ShardedBoat.get(name='Belem').length.hget(), '58')
+
+    def test_unsupported_collections_should_raise(self):
+        self.create_boats()
+        with self.assertRaises(ImplementationError):
+            list(ShardedBoat.collection().sort(by=['port', 'name'], alpha=True))
+        with self.assertRaises(ImplementationError):
+            ShardedBoat.collection().sort(by='length').after()[:2]
@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+
+from limpyd import fields
+from limpyd.contrib.dump import dump, load
+from limpyd.indexes import NumberRangeIndex
+
+from ..base import LimpydBaseTest
+from ..model import TestRedisModel
+
+
+class Ship(TestRedisModel):
+    namespace = 'contrib-dump'
+    name = fields.StringField(indexable=True, unique=True)
+    power = fields.InstanceHashField(indexable=True)
+    length = fields.InstanceHashField(indexable=True, indexes=[NumberRangeIndex])
+    crew = fields.SetField(indexable=True)
+    ports = fields.ListField()
+    ranks = fields.SortedSetField()
+    specs = fields.HashField(indexable=True)
+
+
+class DumpLoadTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(DumpLoadTest, self).setUp()
+        self.ship1 = Ship(name='Pen Duick', power='sail', length=15)
+        self.ship1.crew.sadd('Eric', 'Yves')
+        self.ship1.ports.rpush('Brest', 'Lorient', 'Brest')
+        self.ship1.ranks.zadd(first=1, second=2.5)
+        self.ship1.specs.hmset(mast='wood', hull='wood')
+        self.ship2 = Ship(name='Rainbow Warrior', power='engine')
+
+    def dump_and_flush(self, **kwargs):
+        stream = io.StringIO()
+        count = dump(Ship, stream, **kwargs)
+        self.assertEqual(count, 2)
+        self.connection.flushdb()
+        stream.seek(0)
+        return stream
+
+    def assert_ships_loaded(self):
+        ship1 = Ship.get(name='Pen Duick')
+        self.assertEqual(ship1.pk.get(), '1')
+        self.assertEqual(ship1.hmget('power', 'length'), ['sail', '15'])
+        self.assertEqual(ship1.crew.smembers(), {'Eric', 'Yves'})
+        self.assertEqual(ship1.ports.lrange(0, -1), ['Brest', 'Lorient', 'Brest'])
+        self.assertEqual(ship1.ranks.zrange(0, -1, withscores=True), [('first', 1), ('second', 2.5)])
+        self.assertEqual(ship1.specs.hgetall(), {'mast': 'wood', 'hull': 'wood'})
+
+        ship2 = Ship.get(name='Rainbow Warrior')
+        self.assertEqual(ship2.hmget('power', 'length'), ['engine', None])
+        self.assertEqual(ship2.crew.smembers(), set())
+
+        # indexes are rebuilt
+        self.assertEqual(set(Ship.collection(power='sail')), {'1'})
+        self.assertEqual(set(Ship.collection(length__gt=10)), {'1'})
+        self.assertEqual(set(Ship.collection(crew='Yves')), {'1'})
+        self.assertEqual(set(Ship.collection(specs__mast='wood')), {'1'})
+
+        # new instances do not reuse loaded pks
+        self.assertEqual(Ship(name='Pourquoi Pas').pk.get(), '3')
+
+    def test_dump_should_write_one_json_object_per_line(self):
+        stream = self.dump_and_flush()
+        lines = sorted(stream.getvalue().splitlines())
+        self.assertEqual(json.loads(lines[0]), {
+            'pk': '1',
+            'name': 'Pen Duick',
+            'power': 'sail',
+            'length': '15',
+            'crew': ['Eric', 'Yves'],
+            'ports': ['Brest', 'Lorient', 'Brest'],
+            'ranks': {'first': 1, 'second': 2.5},
+            'specs': {'mast': 'wood', 'hull': 'wood'},
+        })
+        self.assertEqual(json.loads(lines[1])['crew'], [])
+        self.assertEqual(json.loads(lines[1])['length'], None)
+
+    def test_load_should_restore_ndjson_dump(self):
+        stream = self.dump_and_flush(chunk_size=1)
+        self.assertEqual(load(Ship, stream, chunk_size=1), 2)
+        self.assert_ships_loaded()
+
+    def test_load_should_restore_csv_dump(self):
+        stream = self.dump_and_flush(format='csv')
+        self.assertEqual(stream.getvalue().splitlines()[0], 'pk,name,power,length,crew,ports,ranks,specs')
+        self.assertEqual(load(Ship, stream, format='csv'), 2)
+        self.assert_ships_loaded()
+
+    def test_dump_can_be_limited_to_some_fields(self):
+        stream = self.dump_and_flush(fields=['name', 'crew'])
+        self.assertEqual(set(json.loads(stream.readline())), {'pk', 'name', 'crew'})
+        stream.seek(0)
+        load(Ship, stream)
+        self.assertEqual(Ship.get(name='Pen Duick').power.hget(), None)
+
+    def test_load_can_skip_indexing(self):
+        stream = self.dump_and_flush()
+        load(Ship, stream, index=False)
+        self.assertEqual(set(Ship.collection()), {'1', '2'})
+        self.assertEqual(set(Ship.collection(power='sail')), set())
+        Ship.get_field('power').rebuild_indexes()
+        self.assertEqual(set(Ship.collection(power='sail')), {'1'})
+
+    def test_load_should_not_leave_temporary_keys(self):
+        stream = self.dump_and_flush()
+        load(Ship, stream)
+        self.assertFalse([key for key in self.connection.keys() if 'loading' in key])
+
+    def test_invalid_format_or_fields_should_raise(self):
+        with self.assertRaises(ValueError):
+            dump(Ship, io.StringIO(), format='xml')
+        with self.assertRaises(ValueError):
+            dump(Ship, io.StringIO(), fields=['foo'])
+        with self.assertRaises(ValueError):
+            load(Ship, io.StringIO('{"pk": "5", "foo": "bar"}\n'))
+        with self.assertRaises(ValueError):
+            load(Ship, io.StringIO('{"name": "bar"}\n'))
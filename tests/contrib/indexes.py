@@ -638,6 +638,20 @@ class ScoredEqualIndexTestCase(LimpydBaseTest):
         ])
         self.connection.delete(tmp_key)
 
+    def test_collection_update(self):
+
+        zrange = lambda value: self.connection.zrange(ScoredEqualIndexModel.get_field('queue_name').get_index().get_storage_key(value), 0, -1, withscores=True)
+
+        obj1 = ScoredEqualIndexModel(priority=1, queue_name='foo')
+        obj2 = ScoredEqualIndexModel(priority=-2, queue_name='foo')
+        obj3 = ScoredEqualIndexModel(priority=-1, queue_name='bar')
+
+        # pks are moved one by one, keeping their score
+        self.assertEqual(ScoredEqualIndexModel.collection(queue_name='foo').update(queue_name='baz'), 2)
+        self.assertListEqual(zrange('foo'), [])
+        self.assertListEqual(zrange('baz'), [(obj2.pk.get(), -2.0), (obj1.pk.get(), 1.0)])
+        self.assertListEqual(zrange('bar'), [(obj3.pk.get(), -1.0)])
+
     def test_uniqueness(self):
         class ScoredEqualIndexModel2(TestRedisModel):
             collection_manager = ExtendedCollectionManager
@@ -1364,3 +1378,70 @@ class EqualIndexWithTestCase(LimpydBaseTest):
         queue = Queue(name='foo', priority=1)
         Queue(name='foo', priority=2)
         list
+
+
+class BufferedEqualIndexWithModel(TestRedisModel):
+    buffered = True
+    priority = fields.InstanceHashField()
+    name = fields.InstanceHashField(
+        indexable=True,
+        indexes=[EqualIndexWith.configure(other_fields=['priority'])]
+    )
+
+
+class BufferedScoredEqualIndexModel(TestRedisModel):
+    collection_manager = ExtendedCollectionManager
+    buffered = True
+    priority = fields.InstanceHashField()
+    queue_name = fields.InstanceHashField(
+        indexable=True,
+        indexes=[ScoredEqualIndex.configure(score_field='priority')]
+    )
+
+
+class BufferedMultiFieldsIndexesTestCase(LimpydBaseTest):
+
+    def test_save_should_index_with_the_new_values_of_the_other_fields(self):
+        obj = BufferedEqualIndexWithModel(name='foo', priority='1')
+        pk = obj.pk.get()
+        self.assertSetEqual(set(BufferedEqualIndexWithModel.collection(name='foo', priority='1')), {pk})
+
+        obj.name.hset('bar')
+        obj.priority.hset('2')
+        obj.save()
+        self.assertSetEqual(set(BufferedEqualIndexWithModel.collection(name='bar', priority='2')), {pk})
+        for name, priority in (('foo', '1'), ('foo', '2'), ('bar', '1')):
+            self.assertSetEqual(set(BufferedEqualIndexWithModel.collection(name=name, priority=priority)), set())
+        self.assertEqual(len(self.connection.keys('*equal-with*')), 1)
+
+    def test_save_should_score_with_the_new_value_of_the_score_field(self):
+        index = BufferedScoredEqualIndexModel.get_field('queue_name').get_index()
+        zrange = lambda value: self.connection.zrange(index.get_storage_key(value), 0, -1, withscores=True)
+
+        obj = BufferedScoredEqualIndexModel(queue_name='foo', priority=1)
+        self.assertListEqual(zrange('foo'), [(obj.pk.get(), 1.0)])
+        obj.queue_name.hset('bar')
+        obj.priority.hset(5)
+        obj.save()
+        self.assertListEqual(zrange('foo'), [])
+        self.assertListEqual(zrange('bar'), [(obj.pk.get(), 5.0)])
+
+
+class UpdateMultiFieldsIndexesTestCase(LimpydBaseTest):
+
+    def test_update_should_index_with_the_new_values_of_the_other_fields(self):
+        pks = {EqualIndexWithOneFieldModel(name=str(i), priority=str(i + 1)).pk.get() for i in range(2)}
+        EqualIndexWithOneFieldModel.collection().update(name='3', priority='3')
+        self.assertSetEqual(set(EqualIndexWithOneFieldModel.collection(name='3', priority='3')), pks)
+        self.assertSetEqual(set(EqualIndexWithOneFieldModel.collection(name='3', priority='1')), set())
+        self.assertSetEqual(set(EqualIndexWithOneFieldModel.collection(name='1', priority='3')), set())
+        self.assertEqual(len(self.connection.keys('*equal-with*')), 1)
+
+    def test_update_should_score_with_the_new_value_of_the_score_field(self):
+        index = ScoredEqualIndexModel.get_field('queue_name').get_index()
+        zrange = lambda value: self.connection.zrange(index.get_storage_key(value), 0, -1, withscores=True)
+
+        obj = ScoredEqualIndexModel(queue_name='foo', priority=1)
+        ScoredEqualIndexModel.collection().update(queue_name='bar', priority=5)
+        self.assertListEqual(zrange('foo'), [])
+        self.assertListEqual(zrange('bar'), [(obj.pk.get(), 5.0)])
@@ -4,7 +4,7 @@ from future.builtins import object
 
 from limpyd import model, fields
 from limpyd.exceptions import *
-from limpyd.contrib.related import (RelatedModel, RelatedCollection,
+from limpyd.contrib.related import (RelatedModel, RelatedCollection, RelatedCollectionDescriptor,
                                     FKStringField, FKInstanceHashField, M2MSetField,
                                     M2MListField, M2MSortedSetField)
 from limpyd.contrib.collection import ExtendedCollectionManager
@@ -235,6 +235,34 @@ class RelatedCollectionTest(LimpydBaseTest):
         self.assertEqual(test1, test2)
         self.assertEqual(test2, {core_devs._pk})
 
+    def test_related_collections_should_be_created_on_access(self):
+        self.assertTrue(isinstance(Person.membership, RelatedCollectionDescriptor))
+        ybon = Person(name='ybon')
+        self.assertNotIn('membership', ybon.__dict__)
+
+        membership = ybon.membership
+        self.assertTrue(isinstance(membership, RelatedCollection))
+        self.assertIs(membership.instance, ybon)
+        self.assertIs(membership.related_field, Group.get_field('members'))
+        # saved on the instance for the next accesses
+        self.assertIs(ybon.membership, membership)
+        self.assertIsNot(Person(name='twidi').membership, membership)
+
+    def test_related_collections_of_relations_declared_later_should_be_added(self):
+        class Singer(TestRedisModel):
+            name = fields.PKField()
+
+        elvis = Singer(name='elvis')
+        self.assertEqual(elvis.related_collections, [])
+
+        class Song(TestRedisModel):
+            name = fields.PKField()
+            singer = FKStringField(Singer, related_name='songs')
+
+        Song(name='love me tender', singer=elvis)
+        self.assertEqual(elvis.related_collections, ['songs'])
+        self.assertEqual(set(elvis.songs()), {'love me tender'})
+
 
 class MultiValuesCollectionTest(LimpydBaseTest):
 
@@ -410,6 +438,39 @@ class FKTest(LimpydBaseTest):
         core_devs.delete()
         self.assertSetEqual(set(ybon.owned_groups()), set())
 
+    def test_deleting_an_object_should_clear_the_fk_by_chunks(self):
+        main_group = Group(name='limpyd groups')
+        subgroups = [Group(name='group %d' % i, parent=main_group) for i in range(5)]
+        other_group = Group(name='other', parent=subgroups[0])
+
+        # a stale index entry must not clear a fk now pointing to another object
+        index = Group.get_field('parent')._indexes[0]
+        self.connection.sadd(index.get_storage_key(main_group._pk), other_group._pk)
+
+        with self.assertNumCommands(max_num=40):
+            main_group.children.remove_instance(chunk_size=2)
+
+        for subgroup in subgroups:
+            self.assertIsNone(subgroup.parent.get())
+        self.assertEqual(other_group.parent.get(), subgroups[0]._pk)
+        self.assertSetEqual(set(subgroups[0].children()), {other_group._pk})
+
+    def test_deleting_a_collection_must_clear_the_related_fields(self):
+        main_group = Group(name='limpyd groups')
+        core_devs = Group(name='limpyd core devs', parent=main_group)
+        ybon = Person(name='ybon')
+        twidi = Person(name='twidi')
+        core_devs.owner.hset(ybon)
+        core_devs.members.sadd(ybon, twidi)
+
+        self.assertEqual(Person.collection().delete(), 2)
+        self.assertIsNone(core_devs.owner.hget())
+        self.assertEqual(core_devs.members.smembers(), set())
+
+        self.assertEqual(Group.collection(name='limpyd groups').delete(), 1)
+        self.assertIsNone(core_devs.parent.get())
+        self.assertSetEqual(set(Group.collection(parent=main_group._pk)), set())
+
 
 class M2MSetTest(LimpydBaseTest):
 
@@ -475,6 +536,20 @@ class M2MSetTest(LimpydBaseTest):
         self.assertSetEqual(set(twidi.membership()), set([]))
         self.assertSetEqual(set(ybon.membership()), set([]))
 
+    def test_deleting_an_object_should_clean_m2m_by_chunks(self):
+        ybon = Person(name='ybon')
+        twidi = Person(name='twidi')
+        groups = [Group(name='group %d' % i) for i in range(5)]
+        for group in groups:
+            group.members.sadd(ybon, twidi)
+
+        ybon.membership.remove_instance(chunk_size=2)
+
+        self.assertSetEqual(set(ybon.membership()), set())
+        self.assertSetEqual(set(twidi.membership()), {group._pk for group in groups})
+        for group in groups:
+            self.assertEqual(group.members.smembers(), {twidi._pk})
+
 
 class M2MListTest(LimpydBaseTest):
 
@@ -493,6 +568,17 @@ class M2MListTest(LimpydBaseTest):
         self.assertSetEqual(set(ybon.members_set2()), {core_devs._pk})
         self.assertSetEqual(set(twidi.members_set2()), {core_devs._pk})
 
+    def test_deleting_an_object_must_clean_list_m2m(self):
+        core_devs = M2MListTest.Group2(name='limpyd core devs')
+        ybon = Person(name='ybon')
+        twidi = Person(name='twidi')
+
+        core_devs.members.rpush(ybon, twidi, ybon)
+        ybon.delete()
+
+        self.assertEqual(core_devs.members.lrange(0, -1), [twidi._pk])
+        self.assertSetEqual(set(twidi.members_set2()), {core_devs._pk})
+
 
 class M2MSortedSetTest(LimpydBaseTest):
 
@@ -526,6 +612,305 @@ class M2MSortedSetTest(LimpydBaseTest):
         self.assertEqual(core_devs.members.zrevrangebyscore(25, 15), [ybon._pk])
 
 
+class SelectRelatedTest(LimpydBaseTest):
+
+    class Team(TestRedisModel):
+        name = fields.InstanceHashField()
+        city = fields.StringField()
+
+    class Player(TestRedisModel):
+        name = fields.InstanceHashField(indexable=True)
+        team = FKInstanceHashField('Team', related_name='players')
+        rival = FKStringField('self', related_name='rivals')
+
+    def setUp(self):
+        super(SelectRelatedTest, self).setUp()
+        self.teams = [SelectRelatedTest.Team(name='team %d' % i, city='city %d' % i) for i in range(3)]
+        self.players = [
+            SelectRelatedTest.Player(name='player %d' % i, team=self.teams[i % 3])
+            for i in range(6)
+        ]
+        self.players[0].rival.set(self.players[1])
+        SelectRelatedTest.Player(name='free player')
+
+    def test_values_can_get_fields_of_related_instances(self):
+        collection = SelectRelatedTest.Player.collection().sort(by='name', alpha=True)
+        # the sort, then one pipeline to read the 6 values of the teams and the name of the rival
+        with self.assertNumCommands(8):
+            values = list(collection.values('name', 'team__name', 'team__city', 'team__pk', 'rival__name'))
+        self.assertEqual(values[0], {
+            'name': 'free player',
+            'team__name': None,
+            'team__city': None,
+            'team__pk': None,
+            'rival__name': None,
+        })
+        self.assertEqual(values[1], {
+            'name': 'player 0',
+            'team__name': 'team 0',
+            'team__city': 'city 0',
+            'team__pk': self.teams[0]._pk,
+            'rival__name': 'player 1',
+        })
+        self.assertEqual(values[6]['team__name'], 'team 2')
+
+        self.assertEqual(
+            list(collection.values_list('team__name', flat=True)[1:3]),
+            ['team 0', 'team 1']
+        )
+
+    def test_values_with_invalid_related_names_should_raise(self):
+        with self.assertRaises(ValueError):
+            SelectRelatedTest.Player.collection().values('name__foo')
+        with self.assertRaises(ValueError):
+            SelectRelatedTest.Player.collection().values('team__foo')
+        with self.assertRaises(ValueError):
+            SelectRelatedTest.Player.collection().values('team__players')
+
+    def test_instances_can_select_related_instances(self):
+        collection = SelectRelatedTest.Player.collection().sort(by='name', alpha=True)
+        # the sort, then one pipeline to check the existence of the 3 players, 3 teams and the
+        # rival, and to read the values of the 3 teams and the rival (a hmget and a get each)
+        with self.assertNumCommands(15):
+            players = list(collection.instances(select_related=['team', 'rival'])[1:4])
+            teams = [player.team.instance() for player in players]
+            rival = players[0].rival.instance()
+            # the values of the related instances were read in the pipeline
+            self.assertEqual([team.name.hget() for team in teams], ['team 0', 'team 1', 'team 2'])
+            self.assertEqual([team.city.get() for team in teams], ['city 0', 'city 1', 'city 2'])
+            self.assertEqual(rival.name.hget(), 'player 1')
+            self.assertEqual(rival.team.hget(), self.teams[1]._pk)
+            self.assertIsNone(rival.rival.get())
+
+        self.assertEqual([player._pk for player in players], [player._pk for player in self.players[:3]])
+        self.assertTrue(all(player.connected for player in players))
+        self.assertEqual([team._pk for team in teams], [team._pk for team in self.teams])
+        self.assertTrue(all(isinstance(team, SelectRelatedTest.Team) and team.connected for team in teams))
+        self.assertEqual(rival._pk, self.players[1]._pk)
+
+        # an updated foreign key does not use the selected instance anymore
+        players[0].team.hset(self.teams[2])
+        self.assertEqual(players[0].team.instance()._pk, self.teams[2]._pk)
+
+        # updated fields do not use the prefetched values anymore
+        teams[0].name.hset('new team 0')
+        teams[0].city.set('new city 0')
+        rival.hmset(name='new player 1')
+        with self.assertNumCommands(3):
+            self.assertEqual(teams[0].name.hget(), 'new team 0')
+            self.assertEqual(teams[0].city.get(), 'new city 0')
+            self.assertEqual(rival.name.hget(), 'new player 1')
+
+    def test_select_related_should_validate_foreign_keys(self):
+        with self.assertRaises(ValueError):
+            SelectRelatedTest.Player.collection().instances(select_related=['name'])
+        with self.assertRaises(ValueError):
+            Group.collection().instances(select_related=['members'])
+
+
+class PrefetchRelatedTest(LimpydBaseTest):
+
+    class Band(TestRedisModel):
+        name = fields.PKField()
+        musicians = M2MListField(Person, related_name='bands')
+        fans = M2MSetField(Person, related_name='favorite_bands')
+        leader = FKStringField(Person, related_name='led_bands')
+
+    def setUp(self):
+        super(PrefetchRelatedTest, self).setUp()
+        self.persons = [Person(name='person %d' % i) for i in range(4)]
+        self.bands = [PrefetchRelatedTest.Band(name='band %d' % i) for i in range(3)]
+        self.bands[0].musicians.rpush(self.persons[2], self.persons[0])
+        self.bands[0].fans.sadd(self.persons[3])
+        self.bands[1].musicians.rpush(self.persons[0], self.persons[1])
+        self.bands[1].leader.set(self.persons[1])
+
+    def test_instances_can_prefetch_m2m_instances(self):
+        collection = PrefetchRelatedTest.Band.collection().sort(by='name', alpha=True)
+        # the sort, a pipeline to check the 3 bands and get 3 lists and 3 sets, then another one
+        # to check the 4 distinct related persons
+        with self.assertNumCommands(14):
+            bands = list(collection.instances(prefetch_related=['musicians', 'fans']))
+            musicians = [band.musicians.instances() for band in bands]
+            fans = [band.fans.instances() for band in bands]
+
+        self.assertEqual([[person._pk for person in band_musicians] for band_musicians in musicians], [
+            ['person 2', 'person 0'],
+            ['person 0', 'person 1'],
+            [],
+        ])
+        self.assertEqual([[person._pk for person in band_fans] for band_fans in fans], [
+            ['person 3'],
+            [],
+            [],
+        ])
+        # instances are created once for each related pk
+        self.assertIs(musicians[0][1], musicians[1][0])
+        self.assertTrue(musicians[0][1].connected)
+
+        # an updated field does not use the prefetched instances anymore
+        bands[2].fans.sadd(self.persons[0])
+        self.assertEqual([person._pk for person in bands[2].fans.instances()], ['person 0'])
+
+    def test_prefetch_related_can_be_used_with_select_related(self):
+        collection = PrefetchRelatedTest.Band.collection(name='band 1')
+        bands = list(collection.instances(select_related=['leader'], prefetch_related=['musicians']))
+        with self.assertNumCommands(0):
+            self.assertEqual(bands[0].leader.instance()._pk, 'person 1')
+            self.assertEqual(len(bands[0].musicians.instances()), 2)
+
+    def test_prefetch_should_skip_missing_instances(self):
+        self.bands[0].musicians.rpush('foo')
+        bands = list(PrefetchRelatedTest.Band.collection(name='band 0').instances(
+            prefetch_related=['musicians']))
+        self.assertEqual([person._pk for person in bands[0].musicians.instances()], ['person 2', 'person 0'])
+
+    def test_m2m_instances_without_prefetch_should_load_them(self):
+        self.assertEqual([person._pk for person in self.bands[1].musicians.instances()],
+                         ['person 0', 'person 1'])
+
+    def test_prefetch_related_should_validate_m2m_fields(self):
+        with self.assertRaises(ValueError):
+            PrefetchRelatedTest.Band.collection().instances(prefetch_related=['leader'])
+        with self.assertRaises(ValueError):
+            PrefetchRelatedTest.Band.collection().instances(prefetch_related=['foo'])
+
+
+class JoinFilterTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(JoinFilterTest, self).setUp()
+        self.ybon = Person(name='ybon', age=30)
+        self.twidi = Person(name='twidi', age=40)
+        self.foo = Person(name='foo', age=30)
+        self.core_devs = Group(name='core devs', status='private', owner=self.ybon)
+        self.fan_boys = Group(name='fan boys', status='public', owner=self.twidi)
+        self.others = Group(name='others', status='private', owner=self.foo)
+        self.core_devs.members.sadd(self.ybon, self.twidi)
+        self.fan_boys.members.sadd(self.foo)
+        self.ybon.prefered_group.set(self.core_devs)
+        self.twidi.prefered_group.set(self.fan_boys)
+        self.foo.prefered_group.set(self.others)
+
+    def test_filter_on_fields_of_a_foreign_key(self):
+        self.assertEqual(set(Person.collection(prefered_group__status='private')), {'ybon', 'foo'})
+        self.assertEqual(set(Group.collection(owner__age=40)), {'fan boys'})
+        self.assertEqual(set(Group.collection(owner__age__in=[30, 50])), {'core devs', 'others'})
+        self.assertEqual(set(Group.collection(owner__age=50)), set())
+
+    def test_filter_on_fields_of_a_m2m_field(self):
+        self.assertEqual(set(Group.collection(members__age=30)), {'core devs', 'fan boys'})
+        self.assertEqual(set(Group.collection(members__age=40, status='private')), {'core devs'})
+
+    def test_filter_can_follow_many_relations(self):
+        self.assertEqual(set(Person.collection(prefered_group__owner__age=30)), {'ybon', 'foo'})
+        self.assertEqual(set(Person.collection(prefered_group__owner__pk='twidi')), {'twidi'})
+
+    def test_suffixes_of_the_related_field_should_still_work(self):
+        self.assertEqual(set(Person.collection(prefered_group__in=['core devs', 'others'])), {'ybon', 'foo'})
+        self.assertEqual(set(Person.collection(prefered_group__eq=self.fan_boys)), {'twidi'})
+
+    def test_join_should_be_done_in_redis(self):
+        with self.assertNumCommands(max_num=20):
+            result = set(Person.collection(prefered_group__status='private', age=30))
+        self.assertEqual(result, {'ybon', 'foo'})
+        self.assertFalse([key for key in self.connection.keys() if 'join' in key or 'tmp' in key])
+
+    def test_join_on_an_unknown_field_should_raise(self):
+        with self.assertRaises(ImplementationError):
+            Person.collection(prefered_group__foo='bar')
+
+
+class Club(TestRedisModel):
+    name = fields.StringField()
+    president = FKStringField(Person, related_name='presided_clubs', count_related=True)
+    players = M2MListField(Person, related_name='played_clubs', count_related=True)
+
+
+class RelatedCountTest(LimpydBaseTest):
+    """ Test the counters of related instances maintained with count_related """
+
+    def test_count_should_follow_fk_updates(self):
+        ybon = Person(name='ybon')
+        twidi = Person(name='twidi')
+        club1 = Club(name='club1', president=ybon)
+        club2 = Club(name='club2', president=ybon)
+        self.assertEqual(ybon.presided_clubs.count(), 2)
+        self.assertEqual(twidi.presided_clubs.count(), 0)
+
+        club2.president.set(twidi)
+        self.assertEqual(ybon.presided_clubs.count(), 1)
+        self.assertEqual(twidi.presided_clubs.count(), 1)
+
+        # setting the same value again must not count it twice
+        club2.president.set(twidi)
+        self.assertEqual(twidi.presided_clubs.count(), 1)
+
+        club1.delete()
+        self.assertEqual(ybon.presided_clubs.count(), 0)
+        self.assertEqual(self.connection.hgetall(Club.get_field('president').get_index().get_count_key()),
+                         {'twidi': '1'})
+
+    def test_count_should_follow_m2m_updates(self):
+        ybon = Person(name='ybon')
+        twidi = Person(name='twidi')
+        club1 = Club(name='club1')
+        club2 = Club(name='club2')
+        club1.players.rpush(ybon, twidi, ybon)
+        club2.players.rpush(ybon)
+        self.assertEqual(ybon.played_clubs.count(), 2)
+        self.assertEqual(twidi.played_clubs.count(), 1)
+
+        club1.players.lrem(0, ybon)
+        self.assertEqual(ybon.played_clubs.count(), 1)
+
+        club2.players.delete()
+        self.assertEqual(ybon.played_clubs.count(), 0)
+
+        twidi.delete()
+        self.assertEqual(club1.players.lrange(0, -1), [])
+
+    def test_count_should_be_a_single_command(self):
+        ybon = Person(name='ybon')
+        for name in ('club1', 'club2', 'club3'):
+            Club(name=name, president=ybon)
+        with self.assertNumCommands(1):
+            self.assertEqual(ybon.presided_clubs.count(), 3)
+
+    def test_count_without_counters_should_count_the_collection(self):
+        ybon = Person(name='ybon')
+        Group(name='group1', owner=ybon)
+        Group(name='group2', owner=ybon)
+        self.assertEqual(ybon.owned_groups.count(), 2)
+
+    def test_filtering_should_still_work_with_counters(self):
+        ybon = Person(name='ybon')
+        club1 = Club(name='club1', president=ybon)
+        Club(name='club2')
+        self.assertEqual(set(Club.collection(president=ybon)), {club1._pk})
+        self.assertEqual(set(ybon.presided_clubs()), {club1._pk})
+
+    def test_count_by_and_facets_should_work_on_a_counted_field(self):
+        ybon = Person(name='ybon')
+        twidi = Person(name='twidi')
+        Club(name='club1', president=ybon)
+        Club(name='club2', president=ybon)
+        Club(name='club3', president=twidi)
+        self.assertEqual(Club.collection().count_by('president'), {'ybon': 2, 'twidi': 1})
+        self.assertEqual(Club.collection().facets('president'),
+                         {'president': {'ybon': 2, 'twidi': 1}})
+
+    def test_counters_should_be_rebuilt_with_the_index(self):
+        ybon = Person(name='ybon')
+        Club(name='club1', president=ybon)
+        Club(name='club2', president=ybon)
+        index = Club.get_field('president').get_index()
+        self.connection.delete(index.get_count_key(), index.get_storage_key(ybon._pk))
+        self.assertEqual(ybon.presided_clubs.count(), 0)
+        index.rebuild()
+        self.assertEqual(ybon.presided_clubs.count(), 2)
+
+
 class DatabaseTest(LimpydBaseTest):
     def test_database_could_transfer_its_models_and_relations_to_another(self):
         """
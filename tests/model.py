@@ -5,14 +5,23 @@ from future import standard_library
 standard_library.install_hooks()
 
 from datetime import datetime
+import json
+import multiprocessing
+import operator
+import os
 import threading
 import time
 import unittest
 import future.utils
 import six
 
+from redis.backoff import NoBackoff
+from redis.exceptions import ResponseError
+from redis.retry import Retry
+
 from limpyd import model, fields
 from limpyd import fields
+from limpyd.database import LazyResult
 from limpyd.exceptions import *
 
 from .base import LimpydBaseTest, TEST_CONNECTION_SETTINGS
@@ -420,6 +429,30 @@ class Bike4(TestRedisModel, metaclass=TestMetaClass):
 
         self.assertSetEqual(set(db.scan_keys('fo*', count=1)), keys)
 
+    def test_batch_writes(self):
+        db = model.RedisDatabase(**TEST_CONNECTION_SETTINGS)
+        db.connection.set('foo', 1)
+
+        with db.batch_writes() as batch:
+            db.connection.set('foo', 2)
+            db.connection.sadd('bar', 1)
+            # reads are done directly
+            self.assertEqual(db.connection.get('foo'), '1')
+            self.assertFalse(db.connection.exists('bar'))
+            # nested calls use the same batch
+            with db.batch_writes() as nested_batch:
+                self.assertIs(nested_batch, batch)
+                db.connection.incr('foo')
+
+        self.assertEqual(batch.results, [True, 1, 3])
+        self.assertEqual(db.connection.get('foo'), '3')
+
+        with self.assertRaises(ValueError):
+            with db.batch_writes():
+                db.connection.set('foo', 4)
+                raise ValueError
+        self.assertEqual(db.connection.get('foo'), '3')
+
 
 class GetAttrTest(LimpydBaseTest):
 
@@ -786,6 +819,51 @@ class DeleteTest(LimpydBaseTest):
         self.assertEqual(len(Train.collection(kind="Corail")), 1)
         self.assertEqual(len(Train.collection()), 1)
 
+    def test_model_delete_should_deindex_all_kind_of_fields(self):
+
+        class Train(TestRedisModel):
+            namespace = "test_model_delete_should_deindex_all_kind_of_fields"
+            name = fields.InstanceHashField(unique=True)
+            kind = fields.StringField(indexable=True)
+            stations = fields.SetField(indexable=True)
+            stops = fields.ListField(indexable=True)
+            schedule = fields.HashField(indexable=True)
+
+        train1 = Train(name="Occitan", kind="Corail")
+        train1.stations.sadd("Paris", "Toulouse")
+        train1.stops.rpush("Paris", "Limoges")
+        train1.schedule.hmset(monday="8:00")
+        train2 = Train(name="Teoz", kind="Corail")
+        train2.stations.sadd("Paris")
+
+        train1.delete()
+
+        self.assertEqual(set(Train.collection()), {train2._pk})
+        self.assertEqual(set(Train.collection(kind="Corail")), {train2._pk})
+        self.assertEqual(set(Train.collection(stations="Paris")), {train2._pk})
+        self.assertEqual(set(Train.collection(stations="Toulouse")), set())
+        self.assertEqual(set(Train.collection(stops="Limoges")), set())
+        self.assertEqual(set(Train.collection(schedule__monday="8:00")), set())
+        # remaining keys: pk collection, max pk, train2 hash, name, kind and
+        # stations indexes, kind and stations fields
+        self.assertEqual(self.count_keys(), 8)
+
+    def test_model_delete_should_not_depend_on_the_number_of_fields(self):
+
+        class Train(TestRedisModel):
+            namespace = "test_model_delete_should_not_depend_on_the_number_of_fields"
+            name = fields.InstanceHashField()
+            kind = fields.StringField()
+            wagons = fields.StringField()
+            stations = fields.SetField()
+
+        train = Train(name="Occitan", kind="Corail", wagons=10, stations=["Paris"])
+
+        # no indexed fields: one MULTI/EXEC with DEL and SREM
+        with self.assertNumCommands(4):
+            train.delete()
+        self.assertEqual(self.count_keys(), 1)  # max pk
+
 
 class ConnectionTest(LimpydBaseTest):
 
@@ -811,6 +889,261 @@ class ConnectionTest(LimpydBaseTest):
         boat = Boat(name="Pen Duick I", length=15.1, launched=1898)
         self.assertEqual(bike.connection, boat.connection)
 
+    def test_forked_process_should_use_its_own_connection(self):
+        database = Bike.database
+        connection = database.connection
+        self.assertEqual(database._connection_pid, os.getpid())
+        self.assertIn(os.getpid(), database._connections)
+        Bike(name="rosalie", wheels=4)
+
+        pool = multiprocessing.get_context('fork').Pool(1)
+        try:
+            child = pool.apply(get_connection_cache_and_first_bike_name, (id(connection), ))
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertNotEqual(child['pid'], os.getpid())
+        # limpyd created a new client for the child, and forgot the ones of the parent
+        self.assertEqual(child['connection_pid'], child['pid'])
+        self.assertEqual(child['cached_pids'], [child['pid']])
+        self.assertTrue(child['new_client'])
+        self.assertEqual(child['name'], "rosalie")
+
+        # the parent process still uses its own connection
+        self.assertIs(database.connection, connection)
+        self.assertEqual(database._connection_pid, os.getpid())
+        self.assertIn(os.getpid(), database._connections)
+        self.assertEqual(Bike(1).name.get(), "rosalie")
+
+    def test_pool_and_socket_options_can_be_defined(self):
+        settings = dict(TEST_CONNECTION_SETTINGS, max_connections=3, socket_timeout=5, socket_keepalive=True)
+        database = model.RedisDatabase(**settings)
+        connection = database.connection
+        self.assertIsNot(connection, self.connection)
+        self.assertEqual(connection.connection_pool.max_connections, 3)
+        self.assertEqual(connection.connection_pool.connection_kwargs['socket_timeout'], 5)
+        self.assertTrue(connection.connection_pool.connection_kwargs['socket_keepalive'])
+        self.assertTrue(connection.ping())
+
+
+def get_connection_cache_and_first_bike_name(parent_connection_id):
+    database = Bike.database
+    connection = database.connection
+    return {
+        'pid': os.getpid(),
+        'connection_pid': database._connection_pid,
+        'cached_pids': list(database._connections),
+        'new_client': id(connection) != parent_connection_id,
+        'name': Bike(1).name.get(),
+    }
+
+
+REPLICA_CONNECTION_SETTINGS = dict(TEST_CONNECTION_SETTINGS, db=14)
+replicated_database = model.RedisDatabase(read_replicas=[REPLICA_CONNECTION_SETTINGS],
+                                          **TEST_CONNECTION_SETTINGS)
+
+
+class ReplicatedBoat(model.RedisModel):
+    database = replicated_database
+    namespace = "tests"
+
+    name = fields.StringField(indexable=True)
+    power = fields.InstanceHashField(indexable=True)
+    crew = fields.SetField()
+
+
+class ReadReplicasTest(LimpydBaseTest):
+    """
+    The "replica" is another database of the test server, without replication,
+    to know where data is read from
+    """
+    database = replicated_database
+
+    def setUp(self):
+        super(ReadReplicasTest, self).setUp()
+        self.replica = self.database.connect(**REPLICA_CONNECTION_SETTINGS)
+        self.replica.flushdb()
+
+    def tearDown(self):
+        self.replica.flushdb()
+        super(ReadReplicasTest, self).tearDown()
+
+    def test_getters_should_read_from_replicas(self):
+        boat = ReplicatedBoat(name="Pen Duick", power="sail")
+        self.replica.set(boat.name.key, "stale")
+        self.assertEqual(boat.name.get(), "stale")
+        self.assertEqual(boat.hmget("power"), [None])
+        self.assertEqual(boat.power.hget(), None)
+        # expire is a getter of fields, but writes data
+        boat.crew.sadd("Eric")
+        boat.crew.expire(1000)
+        self.assertTrue(0 < self.connection.ttl(boat.crew.key) <= 1000)
+
+        with self.database.read_your_writes():
+            self.assertEqual(boat.name.get(), "Pen Duick")
+            self.assertEqual(boat.hmget("power"), ["sail"])
+        self.assertEqual(boat.name.get(), "stale")
+
+        # no replica can acknowledge the writes, so reads are sent to the main server
+        with self.database.read_your_writes(wait=True, timeout=10):
+            self.assertEqual(boat.name.get(), "Pen Duick")
+
+    def test_indexes_should_be_maintained_with_values_read_from_the_main_server(self):
+        boat = ReplicatedBoat(name="Pen Duick", power="sail")
+        self.replica.set(boat.name.key, "stale")
+        boat.name.set("Rainbow Warrior")
+        boat.hmset(power="engine")
+        with self.database.read_your_writes():
+            self.assertEqual(set(ReplicatedBoat.collection(name="Pen Duick")), set())
+            self.assertEqual(set(ReplicatedBoat.collection(name="Rainbow Warrior")), {"1"})
+            self.assertEqual(set(ReplicatedBoat.collection(power="sail")), set())
+            self.assertEqual(set(ReplicatedBoat.collection(power="engine")), {"1"})
+
+    def test_collections_should_read_from_replicas_without_temporary_keys(self):
+        ReplicatedBoat(name="Pen Duick", power="sail")
+        ReplicatedBoat(name="Rainbow Warrior", power="sail")
+        # read from the replica
+        self.assertEqual(set(ReplicatedBoat.collection(power="sail")), set())
+        self.assertEqual(len(ReplicatedBoat.collection()), 0)
+        self.assertEqual(list(ReplicatedBoat.collection().sort(by="name", alpha=True)), [])
+        # temporary keys are created and read on the main server
+        self.assertEqual(set(ReplicatedBoat.collection(power="sail", name="Pen Duick")), {"1"})
+        self.assertEqual(len(ReplicatedBoat.collection(pk=2, power="sail")), 1)
+        self.assertEqual(self.replica.dbsize(), 0)
+
+    def test_main_connection_should_be_used_in_batches(self):
+        with self.database.batch_writes() as batch:
+            self.assertIs(self.database.read_connection, batch)
+
+    def test_replicas_should_be_chosen_by_the_read_strategy(self):
+        other_replica = dict(TEST_CONNECTION_SETTINGS, db=13)
+        database = model.RedisDatabase(read_replicas=[REPLICA_CONNECTION_SETTINGS, other_replica],
+                                       **TEST_CONNECTION_SETTINGS)
+        dbs = [database.read_connection.connection_pool.connection_kwargs['db'] for __ in range(4)]
+        self.assertEqual(dbs, [14, 13, 14, 13])
+
+        unreachable_replica = dict(TEST_CONNECTION_SETTINGS, port=1, retry=Retry(NoBackoff(), 0))
+        database = model.RedisDatabase(read_replicas=[unreachable_replica, other_replica],
+                                       read_strategy='least-latency', **TEST_CONNECTION_SETTINGS)
+        dbs = [database.read_connection.connection_pool.connection_kwargs['db'] for __ in range(2)]
+        self.assertEqual(dbs, [13, 13])
+
+        with self.assertRaises(ImplementationError):
+            model.RedisDatabase(read_replicas=[other_replica], read_strategy='random')
+
+
+class AutoPipelineTest(LimpydBaseTest):
+
+    def setUp(self):
+        super(AutoPipelineTest, self).setUp()
+        self.boats = [Boat(name="boat%s" % i, launched=1990 + i) for i in range(5)]
+
+    def test_reads_should_be_sent_together_when_a_result_is_asked(self):
+        with self.database.auto_pipeline() as auto_pipeline:
+            names = [boat.name.get() for boat in self.boats]
+            powers = [boat.power.hget() for boat in self.boats]
+            values = self.boats[0].hmget('power')
+            self.assertEqual(auto_pipeline.executions, 0)
+            self.assertIsInstance(names[0], LazyResult)
+            self.assertFalse(names[0].ready)
+
+            self.assertEqual(names[0].result, "boat0")
+            self.assertEqual(auto_pipeline.executions, 1)
+            self.assertTrue(all(name.ready for name in names))
+            self.assertEqual([name.result for name in names], ["boat0", "boat1", "boat2", "boat3", "boat4"])
+            self.assertEqual([power.result for power in powers], ["sail"] * 5)
+            self.assertEqual(values.result, ["sail"])
+            self.assertEqual(auto_pipeline.executions, 1)
+
+    def test_lazy_results_should_not_stand_for_their_value(self):
+        with self.database.auto_pipeline():
+            length = self.boats[0].length.get()
+        self.assertIsNone(length.result)
+        self.assertEqual(repr(length), "<LazyResult None>")
+        with self.assertRaises(TypeError):
+            json.dumps(length)
+        with self.assertRaises(TypeError):
+            bool(length)
+        with self.assertRaises(TypeError):
+            length == None  # noqa: E711
+        with self.assertRaises(TypeError):
+            length != None  # noqa: E711
+        with self.assertRaises(TypeError):
+            len(length)
+        with self.assertRaises(TypeError):
+            iter(length)
+        with self.assertRaises(TypeError):
+            'foo' in length
+        # it can still be used as a key, by identity
+        self.assertEqual({length: 1}[length], 1)
+
+    def test_other_commands_should_be_sent_after_the_queued_reads(self):
+        boat = self.boats[0]
+        with self.database.auto_pipeline() as auto_pipeline:
+            name = boat.name.get()
+            length = boat.length.get()
+            boat.name.set("Pen Duick")
+            boat.length.set(15)
+            self.assertEqual(auto_pipeline.executions, 1)
+            self.assertEqual(name.result, "boat0")
+            self.assertIsNone(length.result)
+            name, length = boat.name.get(), boat.length.get()
+            self.assertEqual(name.result, "Pen Duick")
+            self.assertEqual(length.result, "15")
+            self.assertEqual(set(Boat.collection(launched=1990)), {"1"})
+            self.assertEqual(auto_pipeline.executions, 2)
+        self.assertEqual(set(Boat.collection(name="Pen Duick")), {"1"})
+
+    def test_reads_should_be_sent_at_thresholds(self):
+        with self.database.auto_pipeline(max_commands=3) as auto_pipeline:
+            names = [boat.name.get() for boat in self.boats]
+            self.assertEqual(auto_pipeline.executions, 1)
+        self.assertEqual(auto_pipeline.executions, 2)
+        self.assertEqual([name.result for name in names], ["boat0", "boat1", "boat2", "boat3", "boat4"])
+
+        with self.database.auto_pipeline(max_delay=0) as auto_pipeline:
+            self.boats[0].name.get()
+            self.boats[1].name.get()
+            self.assertEqual(auto_pipeline.executions, 1)
+
+    def test_values_needed_by_limpyd_should_not_be_lazy(self):
+        boat = self.boats[0]
+        with self.database.auto_pipeline() as auto_pipeline:
+            self.assertEqual(boat.name.proxy_get(), "boat0")
+            self.assertNotIsInstance(boat.name.proxy_get(), LazyResult)
+            with self.database.read_your_writes():
+                self.assertIsNone(boat.length.get())
+            with self.database.batch_writes():
+                self.assertIsNone(boat.length.get())
+            # nested calls use the same auto pipeline
+            with self.database.auto_pipeline() as nested_auto_pipeline:
+                self.assertIs(nested_auto_pipeline, auto_pipeline)
+            self.assertIsNone(boat.length.get().result)
+            # result of commands are passed to post_command
+            self.assertEqual(PostCommandTest.MyModel(name="foo").name.hget().result, "modifed_result")
+
+    def test_indexes_should_be_updated_with_the_values_read_by_limpyd(self):
+        email = Email(headers={"from": "foo@example.com", "to": "bar@example.com"})
+        with self.database.auto_pipeline():
+            email.headers.hset("from", "baz@example.com")
+            email.headers.hmset(to="qux@example.com")
+            email.headers.hdel("to")
+        self.assertEqual(email.headers.hgetall(), {"from": "baz@example.com"})
+        self.assertEqual(set(Email.collection(headers__from="foo@example.com")), set())
+        self.assertEqual(set(Email.collection(headers__from="baz@example.com")), {email.pk.get()})
+        self.assertEqual(set(Email.collection(headers__to="bar@example.com")), set())
+        self.assertEqual(set(Email.collection(headers__to="qux@example.com")), set())
+
+    def test_errors_should_be_raised_when_the_result_is_asked(self):
+        email = Email()
+        self.connection.set(email.headers.key, "foo")
+        with self.database.auto_pipeline():
+            headers = email.headers.hgetall()
+            name = self.boats[0].name.get()
+        self.assertEqual(name.result, "boat0")
+        with self.assertRaises(ResponseError):
+            headers.result
+
 
 class FieldExistenceTest(LimpydBaseTest):
 
@@ -880,6 +1213,98 @@ class ProxyTest(LimpydBaseTest):
         self.assertEqual(boat.power.hget(), "engine")
 
 
+class BufferedBoat(TestRedisModel):
+    buffered = True
+
+    name = fields.StringField(unique=True)
+    power = fields.InstanceHashField(indexable=True, default="sail")
+    launched = fields.InstanceHashField(indexable=True)
+    length = fields.InstanceHashField()
+
+
+class BufferedModeTest(BaseModelTest):
+
+    model = BufferedBoat
+
+    def test_values_are_written_only_on_save(self):
+        boat = BufferedBoat(name="Pen Duick I")
+        boat.launched.hset(1898)
+        boat.length.hset(15)
+        self.assertEqual(boat.dirty_fields, {'launched', 'length'})
+        self.assertIsNone(self.connection.hget(boat.key, 'launched'))
+        self.assertCollection([], launched=1898)
+
+        self.assertTrue(boat.save())
+        self.assertEqual(boat.dirty_fields, set())
+        self.assertEqual(self.connection.hmget(boat.key, ['launched', 'length']), ['1898', '15'])
+        self.assertCollection([boat._pk], launched=1898)
+        self.assertFalse(boat.save())
+
+    def test_getter_should_return_buffered_value(self):
+        boat = BufferedBoat(name="Pen Duick II", launched=1964)
+        boat.launched.hset(1965)
+        self.assertEqual(boat.launched.hget(), '1965')
+        self.assertEqual(self.connection.hget(boat.key, 'launched'), '1964')
+
+    def test_creation_should_be_saved_at_once(self):
+        boat = BufferedBoat(name="Pen Duick III", launched=1967, length=17)
+        self.assertEqual(boat.dirty_fields, set())
+        self.assertEqual(boat.power.hget(), "sail")
+        self.assertCollection([boat._pk], power="sail", launched=1967)
+        self.assertEqual(BufferedBoat.get(name="Pen Duick III")._pk, boat._pk)
+
+    def test_save_should_deindex_previous_values(self):
+        boat = BufferedBoat(name="Pen Duick IV", launched=1968)
+        boat.power.hset("engine")
+        boat.launched.hset(1969)
+        boat.save()
+        self.assertCollection([], power="sail")
+        self.assertCollection([], launched=1968)
+        self.assertCollection([boat._pk], power="engine", launched=1969)
+
+    def test_hmset_should_be_buffered(self):
+        boat = BufferedBoat(name="Pen Duick V")
+        boat.hmset(power="engine", launched=1969)
+        self.assertEqual(boat.dirty_fields, {'power', 'launched'})
+        self.assertEqual(boat.hmget('power', 'launched'), ['engine', '1969'])
+        self.assertEqual(boat.dirty_fields, set())
+        self.assertCollection([boat._pk], power="engine", launched=1969)
+
+    def test_other_commands_should_save_first(self):
+        boat = BufferedBoat(name="Pen Duick VI", length=22)
+        boat.length.hset(23)
+        boat.length.hincrby(1)
+        self.assertEqual(boat.dirty_fields, set())
+        self.assertEqual(self.connection.hget(boat.key, 'length'), '24')
+
+    def test_save_should_check_uniqueness(self):
+        BufferedBoat(name="Pen Duick")
+        boat = BufferedBoat(name="Pen Duick bis", launched=1935)
+        boat.name.set("Pen Duick")
+        boat.launched.hset(1936)
+        with self.assertRaises(UniquenessError):
+            boat.save()
+        # nothing was written
+        self.assertEqual(boat.name.get(), "Pen Duick")
+        self.assertEqual(self.connection.get(boat.name.key), "Pen Duick bis")
+        self.assertCollection([boat._pk], launched=1935)
+        self.assertCollection([boat._pk], name="Pen Duick bis")
+
+    def test_save_should_write_values_in_one_transaction(self):
+        boat = BufferedBoat(name="Pen Duick VII")
+        boat.length.hset(23)
+        # no indexed fields: MULTI, HMSET, EXEC
+        with self.assertNumCommands(3):
+            boat.save()
+        self.assertEqual(self.connection.hget(boat.key, 'length'), '23')
+
+    def test_delete_should_forget_buffered_values(self):
+        boat = BufferedBoat(name="Pen Duick VIII")
+        boat.launched.hset(1974)
+        boat.delete()
+        self.assertEqual(self.count_keys(), 1)  # the max_pk key
+
+
 class ScanTest(LimpydBaseTest):
 
     def test_instance_scan(self):
@@ -916,5 +1341,51 @@ class ScanTest(LimpydBaseTest):
         })
 
 
+class Sailor(TestRedisModel):
+    namespace = 'map-reduce'
+    name = fields.PKField()
+    rank = fields.StringField()
+
+
+def sum_wheels(pks):
+    return sum(int(bike.wheels.get()) for bike in Bike.from_pks(pks))
+
+
+def get_pks_and_pid(pks):
+    return [(pk, os.getpid()) for pk in pks]
+
+
+class MapReduceTest(LimpydBaseTest):
+
+    def test_map_reduce_should_reduce_results_of_all_chunks(self):
+        for wheels in range(1, 21):
+            Bike(name='bike %s' % wheels, wheels=wheels)
+        Bike.get(name='bike 5').delete()
+
+        self.assertEqual(Bike.map_reduce(sum_wheels, operator.add, processes=2, chunk_size=3), 205)
+        self.assertEqual(Bike.map_reduce(sum_wheels, operator.add, initial=1000, chunk_size=50), 1205)
+
+    def test_map_reduce_without_reducer_should_return_all_results(self):
+        for index in range(10):
+            Bike(name='bike %s' % index)
+        results = Bike.map_reduce(get_pks_and_pid, processes=2, chunk_size=4)
+        self.assertEqual(len(results), 3)
+        pks_and_pids = [entry for result in results for entry in result]
+        self.assertEqual(sorted(int(pk) for pk, __ in pks_and_pids), list(range(1, 11)))
+        # run in worker processes
+        self.assertNotIn(os.getpid(), {pid for __, pid in pks_and_pids})
+
+    def test_map_reduce_should_scan_models_without_auto_pk(self):
+        for name in 'abcdefg':
+            Sailor(name=name, rank=1)
+        results = Sailor.map_reduce(get_pks_and_pid, operator.add, processes=3, chunk_size=2)
+        self.assertEqual(sorted(pk for pk, __ in results), list('abcdefg'))
+
+    def test_map_reduce_on_empty_model(self):
+        self.assertEqual(Bike.map_reduce(sum_wheels, operator.add), None)
+        self.assertEqual(Bike.map_reduce(sum_wheels, operator.add, initial=0), 0)
+        self.assertEqual(Bike.map_reduce(sum_wheels), [])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -5,7 +5,7 @@ from future.builtins import str
 
 from platform import python_implementation
 
-from limpyd.utils import make_key, unique_key
+from limpyd.utils import make_key, merge_sorted, unique_key
 
 from .base import LimpydBaseTest
 
@@ -45,6 +45,16 @@ class UniqueKeyTest(LimpydBaseTest):
         self.assertNotEqual(key1, key2)
 
 
+class MergeSortedTest(LimpydBaseTest):
+
+    def test_sorted_iterables_should_be_merged(self):
+        self.assertEqual(merge_sorted([[1, 4, 7], [], [2, 3, 9], [5]], key=int), [1, 2, 3, 4, 5, 7, 9])
+
+    def test_merge_should_handle_reverse_order_and_equal_keys(self):
+        merged = merge_sorted([[('b', 1), ('a', 1)], [('c', 2), ('b', 2)]], key=lambda entry: entry[0], reverse=True)
+        self.assertEqual(merged, [('c', 2), ('b', 1), ('b', 2), ('a', 1)])
+
+
 class LimpydBaseTestTest(LimpydBaseTest):
     """
     Test parts of LimpydBaseTest
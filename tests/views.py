@@ -0,0 +1,187 @@
+# -*- coding:utf-8 -*-
+from __future__ import unicode_literals
+
+from limpyd import fields
+from limpyd.exceptions import ImplementationError
+from limpyd.views import View
+
+from .base import LimpydBaseTest
+from .model import TestRedisModel
+
+
+class Article(TestRedisModel):
+    namespace = 'views'
+    name = fields.InstanceHashField(indexable=True)
+    status = fields.InstanceHashField()
+    date = fields.StringField()
+
+    materialized_views = [
+        View('active_by_date', filters={'status': 'active'}, sort='date'),
+        View('active_recent', filters={'status': 'active'}, sort='-date'),
+        View('drafts', filters={'status': 'draft'}),
+    ]
+
+
+class BufferedArticle(TestRedisModel):
+    namespace = 'views'
+    buffered = True
+    status = fields.InstanceHashField()
+    date = fields.InstanceHashField()
+
+    materialized_views = [View('active_by_date', filters={'status': 'active'}, sort='date')]
+
+
+class NamedArticle(TestRedisModel):
+    namespace = 'views'
+    name = fields.PKField()
+    status = fields.InstanceHashField()
+    date = fields.StringField()
+
+    materialized_views = [View('active_by_date', filters={'status': 'active'}, sort='date')]
+
+
+class SubArticle(Article):
+    namespace = 'views'
+    materialized_views = [View('old', sort='-date')]
+
+
+class ViewTest(LimpydBaseTest):
+
+    def test_view_should_follow_updates(self):
+        view = Article.get_view('active_by_date')
+        article1 = Article(name='foo', status='active', date=30)
+        article2 = Article(name='bar', status='draft', date=10)
+        article3 = Article(name='baz', status='active', date=20)
+        article4 = Article(name='qux', status='active')  # no date, not in the view
+
+        self.assertEqual(view.pks(), ['3', '1'])
+        self.assertEqual(view.count(), 2)
+
+        article2.status.hset('active')
+        self.assertEqual(view.pks(), ['2', '3', '1'])
+
+        article1.date.set(5)
+        self.assertEqual(view.pks(), ['1', '2', '3'])
+
+        article3.status.hset('archived')
+        self.assertEqual(view.pks(), ['1', '2'])
+
+        article4.date.set(15)
+        self.assertEqual(view.pks(), ['1', '2', '4'])
+
+        article2.delete()
+        self.assertEqual(view.pks(), ['1', '4'])
+
+        article1.hdel('status')
+        self.assertEqual(view.pks(), ['4'])
+
+    def test_view_should_handle_many_fields_updated_at_once(self):
+        view = Article.get_view('active_by_date')
+        article = Article(name='foo', status='draft', date=10)
+        self.assertEqual(view.pks(), [])
+
+        Article.collection(pk=article.pk.get()).update(status='active', date=20)
+        self.assertEqual(view.pks(), ['1'])
+
+        article = BufferedArticle(status='active', date=10)
+        self.assertEqual(BufferedArticle.get_view('active_by_date').pks(), ['1'])
+        article.status.hset('draft')
+        self.assertEqual(BufferedArticle.get_view('active_by_date').pks(), ['1'])
+        article.save()
+        self.assertEqual(BufferedArticle.get_view('active_by_date').pks(), [])
+
+    def test_view_should_be_sliced_and_ordered(self):
+        for date in range(10):
+            Article(status='active', date=date)
+        Article(status='draft')
+        Article(status='draft')
+
+        self.assertEqual(Article.get_view('active_by_date').pks(2, 3), ['3', '4', '5'])
+        self.assertEqual(Article.get_view('active_recent').pks(0, 3), ['10', '9', '8'])
+        self.assertEqual(Article.get_view('active_recent').pks(9), ['1'])
+        self.assertEqual(Article.get_view('active_recent').pks(0, 0), [])
+        self.assertEqual(Article.get_view('drafts').pks(), ['11', '12'])
+
+        instances = Article.get_view('active_recent').instances(0, 2)
+        self.assertEqual([instance.date.get() for instance in instances], ['9', '8'])
+
+    def test_reading_a_view_should_be_a_single_zrange(self):
+        for date in range(10):
+            Article(status='active', date=date)
+        with self.assertNumCommands(1):
+            Article.get_view('active_by_date').pks(0, 5)
+
+    def test_fields_of_a_view_should_not_be_filterable_if_not_indexable(self):
+        Article(name='foo', status='active', date=1)
+        self.assertEqual(set(Article.collection(name='foo')), {'1'})
+        with self.assertRaises(ImplementationError):
+            list(Article.collection(status='active'))
+        # the fields keep their own ``indexable`` flag
+        self.assertTrue(Article.get_field('name').indexable)
+        self.assertFalse(Article.get_field('status').indexable)
+        self.assertFalse(Article.get_field('date').indexable)
+
+    def test_views_should_not_use_the_name_of_fields(self):
+        class Video(TestRedisModel):
+            namespace = 'views'
+            views = fields.InstanceHashField()
+            materialized_views = [View('viewed', sort='views')]
+
+        video = Video(views=10)
+        self.assertEqual(video.views.hget(), '10')
+        self.assertEqual(Video.get_view('viewed').pks(), [video.pk.get()])
+
+    def test_views_should_be_inherited(self):
+        SubArticle(status='active', date=1)
+        SubArticle(status='draft', date=2)
+        Article(status='active', date=3)
+
+        self.assertEqual(SubArticle.get_view('active_by_date').pks(), ['1'])
+        self.assertEqual(SubArticle.get_view('old').pks(), ['2', '1'])
+        self.assertEqual(Article.get_view('active_by_date').pks(), ['1'])
+        with self.assertRaises(ValueError):
+            Article.get_view('old')
+
+    def test_view_can_be_rebuilt(self):
+        for date in range(5):
+            Article(status='active', date=date)
+        view = Article.get_view('active_by_date')
+        self.connection.delete(*view.get_storage_keys())
+        self.connection.zadd(view.key, {'foo': 1})
+        self.assertEqual(view.pks(), ['foo'])
+
+        view.rebuild(chunk_size=2)
+        self.assertEqual(view.pks(), ['1', '2', '3', '4', '5'])
+
+        Article.get(1).status.hset('draft')
+        self.assertEqual(view.pks(), ['2', '3', '4', '5'])
+
+    def test_view_with_string_pks_can_be_rebuilt(self):
+        for name, date in (('foo', '3'), ('bar', '1'), ('baz', '2')):
+            NamedArticle(name=name, status='active', date=date)
+        NamedArticle(name='qux', status='draft', date='4')
+        view = NamedArticle.get_view('active_by_date')
+        self.connection.delete(*view.get_storage_keys())
+        self.assertEqual(view.pks(), [])
+
+        view.rebuild(chunk_size=2)
+        self.assertEqual(view.pks(), ['bar', 'baz', 'foo'])
+
+    def test_view_fields_must_be_valid(self):
+        with self.assertRaises(ImplementationError):
+            class ViewOnMissingField(TestRedisModel):
+                namespace = 'views'
+                status = fields.InstanceHashField()
+                materialized_views = [View('foo', filters={'foo': 'bar'})]
+
+        with self.assertRaises(ImplementationError):
+            class ViewOnMultiValuesField(TestRedisModel):
+                namespace = 'views'
+                tags = fields.SetField()
+                materialized_views = [View('foo', filters={'tags': 'bar'})]
+
+        with self.assertRaises(ImplementationError):
+            class ViewWithoutFields(TestRedisModel):
+                namespace = 'views'
+                status = fields.InstanceHashField()
+                materialized_views = [View('foo')]